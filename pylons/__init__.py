@@ -1,7 +1,6 @@
 """Base objects to be exported for use in Controllers"""
-from paste.registry import StackedObjectProxy
-
 from pylons.configuration import config
+from pylons.context import ContextObjectProxy
 
 __all__ = ['app_globals', 'cache', 'config', 'request', 'response',
            'session', 'tmpl_context', 'url']
@@ -23,12 +22,12 @@ def __figure_version():
         
 __version__ = __figure_version()
 
-app_globals = StackedObjectProxy(name="app_globals")
-cache = StackedObjectProxy(name="cache")
-request = StackedObjectProxy(name="request")
-response = StackedObjectProxy(name="response")
-session = StackedObjectProxy(name="session")
-tmpl_context = StackedObjectProxy(name="tmpl_context or C")
-url = StackedObjectProxy(name="url")
+app_globals = ContextObjectProxy('app_globals', name="app_globals")
+cache = ContextObjectProxy('cache', name="cache")
+request = ContextObjectProxy('request', name="request")
+response = ContextObjectProxy('response', name="response")
+session = ContextObjectProxy('session', name="session")
+tmpl_context = ContextObjectProxy('tmpl_context', name="tmpl_context or C")
+url = ContextObjectProxy('url', name="url")
 
-translator = StackedObjectProxy(name="translator")
+translator = ContextObjectProxy('translator', name="translator")
@@ -0,0 +1,429 @@
+"""Caching helpers shared by the Pylons cache functions
+
+:func:`~pylons.decorators.cache.beaker_cache` and
+:func:`~pylons.templating.cached_template` store their content with
+Beaker. When asked to (with their ``local_expire`` argument), they
+also keep recently used content in :data:`local_cache`, a bounded
+per-process LRU cache, for a short time. Hot keys are then served
+without going to the Beaker backend, and without unpickling them.
+
+The size of :data:`local_cache` is set by the ``cache_local_max_entries``
+and ``cache_local_max_bytes`` options, read when the PylonsApp is
+created.
+
+Given a ``stale_grace`` period, they regenerate expired content with
+:func:`get_with_grace`: only one caller at a time regenerates it, and
+other callers are served the stale content meanwhile.
+
+Given ``tags``, :func:`~pylons.decorators.cache.beaker_cache` adds the
+*generations* of its namespace and tags to its keys, which
+:func:`get_generations` reads from the cache backend. Moving a tag or
+namespace to a new generation with :func:`new_generation` makes all
+the entries keyed on the old one unreachable, whatever their number,
+and Beaker drops them when they expire.
+
+Both count their hits and misses, and the time taken and size of the
+content they create, per namespace, in :data:`cache_stats`. The
+:func:`cache_stats_app` WSGI app returns these statistics as JSON.
+
+"""
+import bisect
+import cgi
+import logging
+import random
+import threading
+import time
+
+import simplejson
+from beaker import cache as beaker_cache
+
+__all__ = ['CacheStats', 'GENERATIONS_NAMESPACE', 'LocalCache',
+           'cache_stats', 'cache_stats_app', 'estimate_size',
+           'get_generations', 'get_local', 'get_with_grace', 'local_cache',
+           'new_generation', 'put_local']
+
+log = logging.getLogger(__name__)
+
+try:
+    from pylons.shmcache import SharedMemoryNamespaceManager
+except ImportError:
+    # No fcntl module on this platform
+    pass
+else:
+    beaker_cache.clsmap.setdefault('shm', SharedMemoryNamespaceManager)
+
+# Beaker namespace of the generations of tags and namespaces
+GENERATIONS_NAMESPACE = 'pylons.caching.generations'
+
+# Indexes into the linked list entries of LocalCache
+PREV, NEXT, KEY, VALUE, EXPIRES, SIZE = range(6)
+
+def estimate_size(value):
+    """Return the approximate size in bytes of ``value``
+
+    Strings count their length, containers the sizes of their contents;
+    other objects count a nominal 16 bytes.
+
+    """
+    if isinstance(value, str):
+        return len(value)
+    elif isinstance(value, unicode):
+        return len(value) * 2
+    elif isinstance(value, dict):
+        return sum([estimate_size(key) + estimate_size(val)
+                    for key, val in value.iteritems()])
+    elif isinstance(value, (list, tuple)):
+        return sum([estimate_size(item) for item in value])
+    return 16
+
+
+class LocalCache(object):
+    """Thread-safe, in-process LRU cache bounded by number of entries
+    and (approximate) size in bytes
+
+    ``max_entries``
+        Maximum number of entries to hold, or None for no limit.
+    ``max_bytes``
+        Maximum total size of the entries (see :func:`estimate_size`),
+        or None for no limit.
+
+    When either limit is passed, the least recently used entries are
+    evicted. Entries may also be given an expiry time.
+
+    """
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key):
+        """Return the value stored under ``key``, raising KeyError if
+        there isn't one or it has expired"""
+        self._lock.acquire()
+        try:
+            entry = self._entries[key]
+            expires = entry[EXPIRES]
+            if expires is not None and expires <= time.time():
+                self._remove(entry)
+                raise KeyError(key)
+            # Move the entry to the front of the list
+            root = self._root
+            if root[NEXT] is not entry:
+                entry[PREV][NEXT] = entry[NEXT]
+                entry[NEXT][PREV] = entry[PREV]
+                first = root[NEXT]
+                entry[PREV], entry[NEXT] = root, first
+                first[PREV] = root[NEXT] = entry
+            return entry[VALUE]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, expire=None, size=None):
+        """Store ``value`` under ``key``
+
+        ``expire``
+            Seconds until the entry expires, or None to keep it until
+            evicted.
+        ``size``
+            Size of the value in bytes, defaults to the
+            :func:`estimate_size` of it.
+
+        Values larger than ``max_bytes`` aren't stored.
+
+        """
+        if size is None:
+            size = estimate_size(value)
+        if expire is not None:
+            expire = time.time() + expire
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            root = self._root
+            first = root[NEXT]
+            entry = [root, first, key, value, expire, size]
+            first[PREV] = root[NEXT] = self._entries[key] = entry
+            self.size += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        """Remove the entry stored under ``key``, if any"""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all the entries"""
+        self._lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self._lock.release()
+
+    def resize(self, max_entries=None, max_bytes=None):
+        """Change the limits of the cache, evicting entries as
+        needed"""
+        self._lock.acquire()
+        try:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def _clear(self):
+        self._entries = {}
+        root = self._root = []
+        root[:] = [root, root, None, None, None, 0]
+        self.size = 0
+
+    def _remove(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+        del self._entries[entry[KEY]]
+        self.size -= entry[SIZE]
+
+    def _evict(self):
+        root = self._root
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        while (max_entries is not None and
+               len(self._entries) > max_entries) or \
+              (max_bytes is not None and self.size > max_bytes):
+            self._remove(root[PREV])
+
+
+local_cache = LocalCache(max_entries=1000, max_bytes=16 * 1024 * 1024)
+
+
+class CacheStats(object):
+    """Thread-safe statistics of the use of cache namespaces
+
+    For each namespace, counts the ``hits`` (of which ``local_hits``
+    were served from :data:`local_cache`) and ``misses``, and the time
+    taken (``create_time``, in seconds) and size (``create_bytes``, see
+    :func:`estimate_size`) of the content created on misses. The
+    ``create_histogram`` counts the misses by the time taken, in the
+    ``buckets`` bounded by :attr:`latency_buckets`, the last one being
+    for the slower ones.
+
+    """
+    latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def hit(self, namespace, local=False):
+        """Count a hit in ``namespace``, served from :data:`local_cache`
+        if ``local``"""
+        self._lock.acquire()
+        try:
+            stats = self._get(namespace)
+            stats['hits'] += 1
+            if local:
+                stats['local_hits'] += 1
+        finally:
+            self._lock.release()
+
+    def miss(self, namespace, create_time, create_bytes):
+        """Count a miss in ``namespace``, whose content took
+        ``create_time`` seconds to create, and is ``create_bytes`` in
+        size"""
+        bucket = bisect.bisect_left(self.latency_buckets, create_time)
+        self._lock.acquire()
+        try:
+            stats = self._get(namespace)
+            stats['misses'] += 1
+            stats['create_time'] += create_time
+            stats['create_bytes'] += create_bytes
+            stats['create_histogram'][bucket] += 1
+        finally:
+            self._lock.release()
+
+    def get_stats(self, namespace=None):
+        """Return a dict of the statistics of ``namespace``, or of dicts
+        of the statistics of every namespace by name"""
+        self._lock.acquire()
+        try:
+            if namespace is not None:
+                return self._copy(self._get(namespace))
+            return dict([(name, self._copy(stats))
+                         for name, stats in self._stats.iteritems()])
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Reset the statistics of all the namespaces"""
+        self._lock.acquire()
+        try:
+            self._stats = {}
+        finally:
+            self._lock.release()
+
+    def _get(self, namespace):
+        stats = self._stats.get(namespace)
+        if stats is None:
+            stats = self._stats[namespace] = dict(
+                hits=0, local_hits=0, misses=0, create_time=0.0,
+                create_bytes=0,
+                create_histogram=[0] * (len(self.latency_buckets) + 1))
+        return stats
+
+    def _copy(self, stats):
+        stats = dict(stats, create_histogram=stats['create_histogram'][:])
+        stats['buckets'] = list(self.latency_buckets)
+        return stats
+
+
+cache_stats = CacheStats()
+
+def cache_stats_app(environ, start_response):
+    """WSGI app returning the statistics of :data:`cache_stats` as JSON
+
+    The ``namespace`` query argument limits them to one namespace. To
+    serve it, delegate to it from a controller action::
+
+        def cache_stats(self, environ, start_response):
+            return cache_stats_app(environ, start_response)
+
+    """
+    query = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+    namespace = query.get('namespace', [None])[0]
+    body = simplejson.dumps(cache_stats.get_stats(namespace))
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def get_local(namespace, key, cache_type=None):
+    """Return the value stored for ``key`` in the Beaker cache
+    ``namespace`` from :data:`local_cache`, raising KeyError if it
+    isn't there"""
+    return local_cache.get((namespace, cache_type, key))
+
+
+def put_local(namespace, key, value, local_expire, cache_type=None,
+              expire=None, created=None):
+    """Store ``value``, stored for ``key`` in the Beaker cache
+    ``namespace``, in :data:`local_cache` for ``local_expire`` seconds
+
+    The local copy won't outlive the Beaker copy when given its
+    ``expire`` time (in seconds, None for never) and the time it was
+    ``created``, which defaults to now.
+
+    """
+    local_key = (namespace, cache_type, key)
+    if expire is not None:
+        if created is None:
+            created = time.time()
+        local_expire = min(local_expire, created + expire - time.time())
+        if local_expire <= 0:
+            local_cache.remove(local_key)
+            return
+    local_cache.put(local_key, value, expire=local_expire)
+
+
+def get_with_grace(cache, key, createfunc, expire, grace, starttime=None):
+    """Return the entry stored for ``key`` in the Beaker ``cache``,
+    calling ``createfunc`` to create it when missing or expired
+
+    Entries are dicts holding the time they were ``created``, which
+    ``createfunc`` must return. They're fresh for ``expire`` seconds,
+    and then stale for ``grace`` seconds, after which Beaker drops
+    them. Entries created before ``starttime`` are ignored.
+
+    Only one caller (per process, or per host with backends whose
+    creation locks are file based) creates an entry at a time. When a
+    stale entry exists, the other callers are served it without
+    waiting; otherwise they wait for the new entry.
+
+    """
+    entry = _get_entry(cache, key, starttime)
+    lock = cache.namespace.get_creation_lock(_lock_key(key))
+    if entry is not None:
+        if time.time() - entry['created'] < expire:
+            return entry
+        if not lock.acquire(wait=False):
+            log.debug("Returning stale cache copy with key: %s", key)
+            return entry
+    else:
+        lock.acquire()
+    try:
+        # See if someone created the entry while we waited
+        entry = _get_entry(cache, key, starttime)
+        if entry is not None and time.time() - entry['created'] < expire:
+            return entry
+        entry = createfunc()
+        cache.put(key, entry, expiretime=expire + grace)
+        return entry
+    finally:
+        lock.release()
+
+
+def _get_entry(cache, key, starttime):
+    """Return the :func:`get_with_grace` entry stored for ``key`` in
+    ``cache``, or None"""
+    try:
+        entry = cache.get_value(key)
+    except KeyError:
+        return None
+    if not isinstance(entry, dict) or 'created' not in entry:
+        return None
+    if starttime is not None and entry['created'] < starttime:
+        return None
+    return entry
+
+
+def _lock_key(key):
+    # Encoded as Beaker encodes keys
+    if isinstance(key, unicode):
+        key = key.encode('ascii', 'backslashreplace')
+    return key
+
+
+def get_generations(cache_manager, names, **b_kwargs):
+    """Return the current generations of ``names``, joined in a string
+
+    Generations are stored in the :data:`GENERATIONS_NAMESPACE`
+    namespace of the Beaker ``cache_manager``, created with
+    ``b_kwargs`` (the ``type`` of backend, etc.). Names without one
+    (never invalidated, or evicted by the backend) get a new
+    generation.
+
+    """
+    cache = cache_manager.get_cache(GENERATIONS_NAMESPACE, **b_kwargs)
+    return '.'.join([cache.get_value(name, createfunc=_make_generation)
+                     for name in names])
+
+
+def new_generation(cache_manager, name, **b_kwargs):
+    """Move ``name`` to a new generation, invalidating the entries keyed
+    on the current one (see :func:`get_generations`)"""
+    cache = cache_manager.get_cache(GENERATIONS_NAMESPACE, **b_kwargs)
+    cache.put(name, _make_generation())
+
+
+def _make_generation():
+    # Unique rather than incremented, so an evicted generation isn't
+    # started over, and processes creating one at once can't race
+    return '%x%08x' % (int(time.time() * 1000000), random.getrandbits(32))
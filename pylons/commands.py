@@ -14,6 +14,8 @@ Commands available:
     Create a REST Controller and accompanying functional test
 ``shell``
     Open an interactive shell with the Pylons app loaded
+``warmcache``
+    Request the app's cache warming urls
 
 Example usage::
     
@@ -40,19 +42,27 @@ Example usage::
 
 """
 import os
+import Queue
+import re
 import sys
+import threading
+import time
+import urllib
 
 import paste.fixture
 import paste.registry
-from paste.deploy import loadapp
+from paste.deploy import appconfig, loadapp
 from paste.script.command import Command, BadCommand
 from paste.script.filemaker import FileOp
+from routes.util import URLGenerator
 from tempita import paste_script_template_renderer
 
 import pylons
 import pylons.util as util
+from pylons.wsgiapp import warmup
 
-__all__ = ['ControllerCommand', 'RestControllerCommand', 'ShellCommand']
+__all__ = ['ControllerCommand', 'RestControllerCommand', 'ShellCommand',
+           'WarmCacheCommand', 'expand_urls', 'warm_urls']
 
 def can_import(name):
     """Attempt to __import__ the specified package/module, returning
@@ -583,3 +593,186 @@ class ShellCommand(Command):
                 shell.interact(banner)
             finally:
                 paste.registry.restorer.restoration_end()
+
+
+class WarmCacheCommand(Command):
+    """Request the app's cache warming urls
+
+    The optional CONFIG_FILE argument specifies the config file to use.
+    CONFIG_FILE defaults to 'development.ini'.
+
+    The urls are read from the cache_warm_urls option of the app's
+    config, one per line, and from the -u options. A url may contain
+    {name} placeholders, or be the name of a route, followed by the
+    lists of their values, as in::
+
+        cache_warm_urls =
+            /
+            /products/{id} id=1,2,3
+            product_page id=1,2,3 page=1,2
+
+    which are requested for every combination of the values. The urls
+    are requested through the app, in this process, so caches only kept
+    in memory aren't warmed for other processes.
+
+    Example::
+
+        $ paster warmcache -c 8 production.ini
+
+    """
+    summary = __doc__.splitlines()[0]
+    usage = '\n' + __doc__
+
+    min_args = 0
+    max_args = 1
+    group_name = 'pylons'
+
+    parser = Command.standard_parser(simulate=True)
+    parser.add_option('-u', '--url',
+                      action='append',
+                      dest='urls',
+                      default=[],
+                      help="Also request URL (may be repeated)")
+    parser.add_option('-c', '--concurrency',
+                      type='int',
+                      dest='concurrency',
+                      default=4,
+                      help="Number of urls to request at once (default 4)")
+    parser.add_option('-q',
+                      action='count',
+                      dest='quiet',
+                      default=0,
+                      help=("Do not load logging configuration from the "
+                            "config file"))
+
+    def command(self):
+        """Main command to warm the caches"""
+        if len(self.args) == 0:
+            # Assume the .ini file is ./development.ini
+            config_file = 'development.ini'
+            if not os.path.isfile(config_file):
+                raise BadCommand('%sError: CONFIG_FILE not found at: .%s%s\n'
+                                 'Please specify a CONFIG_FILE' % \
+                                 (self.parser.get_usage(), os.path.sep,
+                                  config_file))
+        else:
+            config_file = self.args[0]
+
+        config_name = 'config:%s' % config_file
+        here_dir = os.getcwd()
+
+        if not self.options.quiet:
+            # Configure logging from the config file
+            self.logging_file_config(config_file)
+
+        sys.path.insert(0, here_dir)
+        wsgiapp = loadapp(config_name, relative_to=here_dir)
+        config = getattr(wsgiapp, 'config', None) or pylons.config
+        lines = appconfig(config_name, relative_to=here_dir).get(
+            'cache_warm_urls', '').splitlines() + self.options.urls
+        try:
+            urls = expand_urls(lines, config.get('routes.map'))
+        except (KeyError, ValueError), e:
+            raise BadCommand('Error: invalid cache_warm_urls: %s' % e)
+        if not urls:
+            raise BadCommand('Error: no urls to request, set the '
+                             'cache_warm_urls option or use -u')
+
+        start = time.time()
+        results = warm_urls(wsgiapp, urls, self.options.concurrency)
+        failed = 0
+        for url, status, elapsed in results:
+            if status is None or status[:1] in ('4', '5'):
+                failed += 1
+            print '%-20s %8.3fs  %s' % (status or 'FAILED', elapsed, url)
+        print 'Requested %d urls in %.3fs, %d failed' % (
+            len(results), time.time() - start, failed)
+        if failed:
+            return 1
+
+
+def expand_urls(lines, mapper=None):
+    """Return the urls of the ``lines`` of the cache_warm_urls option of
+    :class:`WarmCacheCommand`, generating named routes with ``mapper``
+    """
+    urls = []
+    for line in lines:
+        parts = line.split()
+        if not parts or parts[0].startswith('#'):
+            continue
+        pattern = parts[0]
+        params = []
+        for part in parts[1:]:
+            if '=' not in part:
+                raise ValueError("expected name=values, got %r" % part)
+            name, values = part.split('=', 1)
+            params.append([(name, value) for value in values.split(',')])
+        for combination in _combinations(params):
+            kwargs = dict(combination)
+            if pattern.startswith('/'):
+                urls.append(_fill_url(pattern, kwargs))
+            elif mapper is None:
+                raise ValueError("no routes mapper to generate %r with" %
+                                 pattern)
+            else:
+                url = URLGenerator(mapper, {'HTTP_HOST': 'localhost'})
+                urls.append(url(pattern, **kwargs))
+    return urls
+
+
+def warm_urls(app, urls, concurrency=1, extra_environ=None):
+    """Request ``urls`` through the WSGI ``app`` with
+    :func:`~pylons.wsgiapp.warmup`, ``concurrency`` at a time
+
+    Returns a list of ``(url, status, seconds)`` tuples, in the order
+    of ``urls``.
+
+    """
+    results = [None] * len(urls)
+    queue = Queue.Queue()
+    for item in enumerate(urls):
+        queue.put(item)
+
+    def request_urls():
+        while True:
+            try:
+                i, url = queue.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            status = warmup(app, [url], extra_environ)[0][1]
+            results[i] = (url, status, time.time() - start)
+
+    threads = [threading.Thread(target=request_urls)
+               for i in range(max(1, min(concurrency, len(urls))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _combinations(params):
+    """Return every combination of one item of each list in
+    ``params``"""
+    combinations = [[]]
+    for items in params:
+        combinations = [combination + [item] for combination in combinations
+                        for item in items]
+    return combinations
+
+
+def _fill_url(pattern, params):
+    """Replace the {name} placeholders of ``pattern`` with ``params``,
+    adding the others as query args"""
+    params = params.copy()
+    def replace(match):
+        return urllib.quote(params.pop(match.group(1)))
+    url = re.sub(r'\{(\w+)\}', replace, pattern)
+    if params:
+        if '?' in url:
+            url += '&'
+        else:
+            url += '?'
+        url += urllib.urlencode(sorted(params.items()))
+    return url
@@ -17,10 +17,11 @@ import copy
 import logging
 import os
 
-from paste.config import DispatchingConfig
 from paste.deploy.converters import asbool
 from webhelpers.mimehelper import MIMETypes
 
+from pylons.context import ContextConfig
+
 
 default_template_engine = 'mako'
 
@@ -34,7 +35,7 @@ response_defaults = dict(content_type='text/html',
 log = logging.getLogger(__name__)
 
 
-config = DispatchingConfig()
+config = ContextConfig()
 
 class PylonsConfig(dict):
     """Pylons configuration object
@@ -62,6 +63,14 @@ class PylonsConfig(dict):
         objects for registering with Pylons. If these are present then
         PylonsApp will use them from environ rather than using default
         middleware from Beaker. Valid keys are: ``session, cache``
+    ``pylons.context_globals``
+        Whether PylonsApp should bind the request's
+        :class:`~pylons.util.PylonsContext` to the current thread for
+        the Pylons globals to resolve from (see :mod:`pylons.context`),
+        rather than registering each of them with ``paste.registry``.
+        The ``RegistryManager`` middleware is then only needed by code
+        that uses the registry directly (such as the interactive
+        debugger's restorer). Defaults to False.
     ``pylons.strict_tmpl_context``
         Whether or not the ``tmpl_context`` object should throw an
         attribute error when access is attempted to an attribute that
@@ -97,6 +106,7 @@ class PylonsConfig(dict):
         'pylons.environ_config': dict(session='beaker.session', 
                                       cache='beaker.cache'),
         'pylons.app_globals': None,
+        'pylons.context_globals': False,
         'pylons.h': None,
         'pylons.request_options': request_defaults.copy(),
         'pylons.response_options': response_defaults.copy(),
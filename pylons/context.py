@@ -0,0 +1,96 @@
+"""Per-thread binding of the Pylons context
+
+The Pylons globals (:data:`~pylons.request`, :data:`~pylons.response`,
+:data:`~pylons.tmpl_context`, etc.) are normally registered one by one
+with ``paste.registry`` for every request. When the
+``pylons.context_globals`` option is enabled, PylonsApp instead binds
+the request's :class:`~pylons.util.PylonsContext` to the current thread
+with :func:`bind_context`, and each global resolves to the attribute of
+the same name on it.
+
+The globals fall back to their ``paste.registry`` registrations when no
+context is bound, or the bound context lacks the attribute, so code
+pushing objects onto them directly keeps working. A
+:class:`ContextAttribute` registered with ``paste.registry`` is
+resolved when the global is used, so lazily created attributes of the
+context aren't created by registering them.
+
+"""
+import threading
+
+from paste.config import DispatchingConfig
+from paste.registry import NoDefault, StackedObjectProxy
+
+__all__ = ['ContextAttribute', 'ContextConfig', 'ContextObjectProxy',
+           'bind_context', 'current_context']
+
+_local = threading.local()
+
+def bind_context(context):
+    """Bind ``context`` to the current thread, returning the context
+    that was previously bound (or None)
+
+    Binding None unbinds the context. Restore the previous context
+    when done with the new one, which allows nested requests::
+
+        previous = bind_context(pylons_obj)
+        try:
+            # handle the request
+        finally:
+            bind_context(previous)
+
+    """
+    previous = getattr(_local, 'context', None)
+    _local.context = context
+    return previous
+
+
+def current_context():
+    """Return the context bound to the current thread, or None"""
+    return getattr(_local, 'context', None)
+
+
+class ContextAttribute(object):
+    """Stand-in for the ``attr`` attribute of ``context``, for
+    registering with ``paste.registry``
+    
+    :class:`ContextObjectProxy` resolves it to the attribute on access.
+    
+    """
+    __slots__ = ('context', 'attr')
+
+    def __init__(self, context, attr):
+        self.context = context
+        self.attr = attr
+
+
+class ContextObjectProxy(StackedObjectProxy):
+    """StackedObjectProxy resolving to the ``attr`` attribute of the
+    bound context, if any"""
+    def __init__(self, attr, default=NoDefault, name="Default"):
+        StackedObjectProxy.__init__(self, default=default, name=name)
+        self.__dict__['_context_attr'] = attr
+
+    def _current_obj(self):
+        context = getattr(_local, 'context', None)
+        if context is not None:
+            obj = getattr(context, self._context_attr, NoDefault)
+            if obj is not NoDefault:
+                return obj
+        obj = StackedObjectProxy._current_obj(self)
+        if obj.__class__ is ContextAttribute:
+            return getattr(obj.context, obj.attr)
+        return obj
+
+
+class ContextConfig(DispatchingConfig):
+    """DispatchingConfig resolving to the ``config`` attribute of the
+    bound context, if any"""
+    def _current_obj(self):
+        context = getattr(_local, 'context', None)
+        if context is not None:
+            conf = getattr(context, 'config', NoDefault)
+            if conf is not NoDefault:
+                return conf
+        return DispatchingConfig._current_obj(self)
+    current = current_conf = _current_obj
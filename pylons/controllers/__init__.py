@@ -1,3 +1,4 @@
 """Standard Controllers intended for subclassing by web developers"""
 from pylons.controllers.core import WSGIController
 from pylons.controllers.xmlrpc import XMLRPCController
+from pylons.controllers.jsonrpc import JSONRPCController
@@ -6,11 +6,85 @@ import types
 from webob.exc import HTTPException, HTTPNotFound
 
 import pylons
+from pylons.context import bind_context
+from pylons.controllers.util import StreamingBody, _is_file_wrapper
 
-__all__ = ['WSGIController']
+__all__ = ['DispatchPlan', 'WSGIController']
 
 log = logging.getLogger(__name__)
 
+def make_arg_binder(func):
+    """Create a function that picks the keyword arguments ``func``
+    accepts out of a dict of available arguments
+    
+    Functions accepting ``**kwargs`` are handed the full dict.
+    
+    """
+    argspec = inspect.getargspec(func)
+    if argspec[2]:
+        def bind_args(kargs):
+            return kargs
+    else:
+        argnames = tuple(argspec[0][isinstance(func, types.MethodType)
+                                    and 1 or 0:])
+        def bind_args(kargs):
+            return dict((name, kargs[name]) for name in argnames
+                        if name in kargs)
+    return bind_args
+
+
+class DispatchPlan(object):
+    """Dispatch information for a :class:`WSGIController` subclass
+    
+    Built once per controller class (on its first request) so that
+    dispatching a request doesn't need to reflect on the controller.
+    
+    ``actions``
+        Set of the public action names. Names starting with an
+        underscore and ``start_response`` are never actions.
+    ``has_before``, ``has_after``
+        Whether the class defines the ``__before__`` and ``__after__``
+        hooks.
+    
+    Argument binders (see :func:`make_arg_binder`) are precomputed for
+    the actions and hooks, and created on demand for other methods
+    passed to :meth:`WSGIController._inspect_call`. Actions are looked
+    up on the controller for each request, so methods replaced on the
+    class after its first request (e.g. by ``mock.patch.object``) are
+    still used.
+    
+    """
+    def __init__(self, cls):
+        self.has_before = hasattr(cls, '__before__')
+        self.has_after = hasattr(cls, '__after__')
+        self.actions = set()
+        self.binders = {}
+        seen = set()
+        for klass in cls.__mro__:
+            for name, value in klass.__dict__.iteritems():
+                if name in seen:
+                    continue
+                seen.add(name)
+                if name.startswith('_') or name == 'start_response' or \
+                   not isinstance(value, types.FunctionType):
+                    continue
+                self.actions.add(name)
+        for name in ('__before__', '__after__'):
+            hook = getattr(cls, name, None)
+            if isinstance(hook, types.MethodType):
+                self.get_binder(hook)
+        for name in self.actions:
+            self.get_binder(getattr(cls, name))
+
+    def get_binder(self, func):
+        """Return the argument binder for ``func``"""
+        key = getattr(func, 'im_func', func)
+        try:
+            return self.binders[key]
+        except KeyError:
+            bind_args = self.binders[key] = make_arg_binder(func)
+            return bind_args
+
 
 class WSGIController(object):
     """WSGI Controller that follows WSGI spec for calling and return
@@ -37,6 +111,16 @@ class WSGIController(object):
         :class:`~webob.exc.HTTPException` (such as those raised by
         ``redirect_to`` and ``abort``) are expected; e.g. ``__after__``
         will be called on redirects.
+    
+    Actions may stream their response by returning an iterator, such as
+    a generator yielding chunks of the page (unicode chunks, like the
+    output of the render functions, are encoded with the response
+    charset). The chunks are sent as they are produced, after the
+    headers and cookies of :data:`~pylons.response`. The Pylons globals
+    remain available to the iterator, and ``__after__`` is called once
+    the response has been sent, when it can no longer change it. Files
+    wrapped with the server's ``wsgi.file_wrapper`` are returned as
+    they are, so the server can send them efficiently.
         
     Each action to be called is inspected with :meth:`_inspect_call` so
     that it is only passed the arguments in the Routes match dict that
@@ -48,8 +132,34 @@ class WSGIController(object):
     Controller will raise an "Action Not Found" error if in debug mode,
     otherwise a ``404 Not Found`` error will be returned.
     
+    Controllers that keep no state between requests may set the class
+    attribute ``reuse_instances`` to True. PylonsApp will then keep one
+    instance per thread and reuse it for later requests instead of
+    creating a new one, calling ``__reset__`` on it once the response
+    to each request is closed. The default ``__reset__`` removes the
+    per-request attributes Pylons sets on the controller; override it
+    (calling the base version) to clear any other attributes your
+    actions set.
+    
     """
     _pylons_log_debug = False
+    reuse_instances = False
+
+    def __reset__(self):
+        """Prepare a reused controller instance for another request"""
+        self.__dict__.pop('_py_object', None)
+        self.__dict__.pop('start_response', None)
+
+    def _after_streaming(self):
+        """Call ``__after__`` once a streamed response has been sent"""
+        previous_context = bind_context(self._py_object)
+        try:
+            after = self._inspect_call(self.__after__)
+        finally:
+            bind_context(previous_context)
+        if hasattr(after, '_exception') and self._pylons_log_debug:
+            log.debug("Ignoring the response of __after__, the streamed "
+                      "response has already been sent")
 
     def _perform_call(self, func, args):
         """Hide the traceback for everything above this method"""
@@ -67,37 +177,17 @@ class WSGIController(object):
         decorator preserved the function signature.
         
         """
-        # Check to see if the class has a cache of argspecs yet
-        try:
-            cached_argspecs = self.__class__._cached_argspecs
-        except AttributeError:
-            self.__class__._cached_argspecs = cached_argspecs = {}
-        
-        try:
-            argspec = cached_argspecs[func.im_func]
-        except KeyError:
-            argspec = cached_argspecs[func.im_func] = inspect.getargspec(func)
+        bind_args = self._get_dispatch_plan().get_binder(func)
         kargs = self._get_method_args()
                 
         log_debug = self._pylons_log_debug
-        c = self._py_object.tmpl_context
         environ = self._py_object.request.environ
-        args = None
+        args = bind_args(kargs)
         
-        if argspec[2]:
-            if self._py_object.config['pylons.tmpl_context_attach_args']:
-                for k, val in kargs.iteritems():
-                    setattr(c, k, val)
-            args = kargs
-        else:
-            args = {}
-            argnames = argspec[0][isinstance(func, types.MethodType)
-                                  and 1 or 0:]
-            for name in argnames:
-                if name in kargs:
-                    if self._py_object.config['pylons.tmpl_context_attach_args']:
-                        setattr(c, name, kargs[name])
-                    args[name] = kargs[name]
+        if args and self._py_object.config['pylons.tmpl_context_attach_args']:
+            c = self._py_object.tmpl_context
+            for k, val in args.iteritems():
+                setattr(c, k, val)
         if log_debug:
             log.debug("Calling %r method with keyword args: **%r",
                       func.__name__, args)
@@ -120,6 +210,17 @@ class WSGIController(object):
 
         return result
     
+    def _get_dispatch_plan(cls):
+        """Return the :class:`DispatchPlan` for this controller class,
+        building it on first use"""
+        try:
+            return cls.__dict__['_pylons_dispatch_plan']
+        except KeyError:
+            plan = DispatchPlan(cls)
+            cls._pylons_dispatch_plan = plan
+            return plan
+    _get_dispatch_plan = classmethod(_get_dispatch_plan)
+    
     def _get_method_args(self):
         """Retrieve the method arguments to use with inspect call
         
@@ -151,11 +252,19 @@ class WSGIController(object):
         if log_debug:
             log.debug("Looking for %r method to handle the request",
                       action_method)
-        try:
-            func = getattr(self, action_method, None)
-        except UnicodeEncodeError:
-            func = None
-        if action_method != 'start_response' and callable(func):
+        if action_method in self._get_dispatch_plan().actions and \
+           action_method not in self.__dict__:
+            func = getattr(self, action_method)
+        else:
+            # Not a plain method on the class (an instance attribute,
+            # some other callable, or a __getattr__ provided action)
+            try:
+                func = getattr(self, action_method, None)
+            except UnicodeEncodeError:
+                func = None
+            if action_method == 'start_response' or not callable(func):
+                func = None
+        if func is not None:
             # Store function used to handle request
             req.environ['pylons.action_method'] = func
             
@@ -176,6 +285,7 @@ class WSGIController(object):
                 
         # Keep a local reference to the req/response objects
         self._py_object = environ['pylons.pylons']
+        plan = self._get_dispatch_plan()
 
         # Keep private methods private
         try:
@@ -203,7 +313,7 @@ class WSGIController(object):
             return start_response(status, headers, exc_info)
         self.start_response = repl_start_response
         
-        if hasattr(self, '__before__'):
+        if plan.has_before:
             response = self._inspect_call(self.__before__)
             if hasattr(response, '_exception'):
                 return response(environ, self.start_response)
@@ -218,13 +328,18 @@ class WSGIController(object):
                 if log_debug:
                     log.debug("Controller returned a string "
                               ", writing it to pylons.response")
-                py_response.body = py_response.body + response
+                if py_response.content_length == 0:
+                    py_response.body = response
+                else:
+                    py_response.write(response)
             elif isinstance(response, unicode):
                 if log_debug:
                     log.debug("Controller returned a unicode string "
                               ", writing it to pylons.response")
-                py_response.unicode_body = py_response.unicode_body + \
-                        response
+                if py_response.content_length == 0:
+                    py_response.unicode_body = response
+                else:
+                    py_response.write(response)
             elif hasattr(response, 'wsgi_response'):
                 # It's an exception that got tossed.
                 if log_debug:
@@ -235,6 +350,7 @@ class WSGIController(object):
                         response.headers.add(name, value)
                     else:
                         response.headers.setdefault(name, value)
+                self._py_object.response = response
                 try:
                     registry = environ['paste.registry']
                     registry.replace(pylons.response, response)
@@ -249,10 +365,20 @@ class WSGIController(object):
                 if log_debug:
                     log.debug("Assuming controller returned an iterable, "
                               "setting it as pylons.response.app_iter")
+                if not isinstance(response, (list, tuple)) and \
+                   not _is_file_wrapper(environ, response):
+                    response = StreamingBody(response, py_response.charset)
                 py_response.app_iter = response
             response = py_response
         
-        if hasattr(self, '__after__'):
+        body = getattr(response, 'app_iter', None)
+        if isinstance(body, StreamingBody):
+            # Keep the Pylons globals available to the streamed body, and
+            # call __after__ once it's sent
+            body.context = self._py_object
+            if plan.has_after:
+                body.on_close.append(self._after_streaming)
+        elif plan.has_after:
             after = self._inspect_call(self.__after__)
             if hasattr(after, '_exception'):
                 return after(environ, self.start_response)
@@ -0,0 +1,233 @@
+"""The base WSGI JSONRPCController"""
+import base64
+import logging
+import time
+import xmlrpclib
+
+import simplejson
+
+from pylons.controllers import WSGIController
+from pylons.controllers.xmlrpc import XMLRPCController
+
+__all__ = ['JSONRPCController']
+
+log = logging.getLogger(__name__)
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+def jsonrpc_result(id, result):
+    """Return a JSON-RPC 2.0 response object for ``result``"""
+    return {'jsonrpc': '2.0', 'result': result, 'id': id}
+
+
+def jsonrpc_error(id, code, message):
+    """Return a JSON-RPC 2.0 error response object"""
+    return {'jsonrpc': '2.0', 'error': {'code': code, 'message': message},
+            'id': id}
+
+
+def encode_xmlrpc_value(obj):
+    """Return a JSON serializable version of the xmlrpclib ``obj``, for
+    the ``default`` of simplejson.dumps
+    
+    xmlrpclib.DateTime values are encoded as ISO 8601 strings, and
+    xmlrpclib.Binary values as base64 strings.
+    
+    """
+    if isinstance(obj, xmlrpclib.DateTime):
+        try:
+            return time.strftime('%Y-%m-%dT%H:%M:%S',
+                                 time.strptime(obj.value, '%Y%m%dT%H:%M:%S'))
+        except ValueError:
+            return obj.value
+    if isinstance(obj, xmlrpclib.Binary):
+        return base64.b64encode(obj.data)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+class JSONRPCController(XMLRPCController):
+    """JSON-RPC Controller that speaks WSGI
+
+    This controller handles `JSON-RPC 2.0
+    <http://www.jsonrpc.org/specification>`_ requests, including batch
+    requests and notifications, with the methods of an
+    :class:`~pylons.controllers.xmlrpc.XMLRPCController`. Method
+    names, signatures, private methods, the ``system.*`` introspection
+    methods and the ``max_body_length`` limit all work as they do for
+    XML-RPC, so the same methods can be served over both protocols by
+    subclassing one controller from the other::
+
+        class MyXML(XMLRPCController):
+            def userstatus(self):
+                return 'basic string'
+            userstatus.signature = [ ['string'] ]
+
+        class MyJSON(JSONRPCController, MyXML):
+            pass
+
+    Params may be given by position or by name. Named params are
+    matched to the method's arguments, and must name all of them up to
+    the last one given so that the signature can be checked.
+
+    Gzip compressed requests and responses are handled as they are
+    for XML-RPC. Requests with an empty body get a parse error.
+
+    The calls of a batch request run like those of ``system.multicall``,
+    concurrently when ``multicall_threads`` is set. A method returning
+    an xmlrpclib.Fault results in an error with its faultCode and
+    faultString. Results are encoded with :func:`encode_xmlrpc_value`,
+    so methods may return xmlrpclib.DateTime and xmlrpclib.Binary
+    values; one that can't be encoded results in an internal error.
+
+    """
+    body_format = 'JSON'
+    method_not_found_fault = METHOD_NOT_FOUND
+    bad_signature_fault = INVALID_PARAMS
+    internal_error_fault = INTERNAL_ERROR
+
+    def __call__(self, environ, start_response):
+        """Parse a JSON-RPC body, and call the requested methods with
+        the appropriate arguments"""
+        length = self._get_body_length(environ)
+        if length == 0:
+            body = ''
+        else:
+            body = ''.join(self._read_body(environ, length))
+        try:
+            if not body:
+                raise ValueError("Empty body")
+            self._jsonrpc_request = simplejson.loads(body)
+            self._jsonrpc_parse_error = None
+        except ValueError, e:
+            if self._pylons_log_debug:
+                log.debug("Invalid JSON body, returning parse error: %s", e)
+            self._jsonrpc_request = None
+            self._jsonrpc_parse_error = str(e)
+        self.rpc_kargs = dict(environ=environ, start_response=start_response)
+        return WSGIController.__call__(self, environ, start_response)
+
+    def _get_body_length(self, environ):
+        """Return the Content-Length of the request, 0 when it has no
+        body, or None for a chunked request
+        
+        Empty requests get a parse error rather than the 411 or 413
+        error of XML-RPC requests.
+        
+        """
+        length = environ.get('CONTENT_LENGTH')
+        if (not length or int(length) == 0) and \
+           'chunked' not in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            if self._pylons_log_debug:
+                log.debug("Empty request body, returning parse error")
+            return 0
+        return XMLRPCController._get_body_length(self, environ)
+
+    def _dispatch_call(self):
+        """Call the methods of the request parsed by __call__"""
+        environ = self.rpc_kargs['environ']
+        data = self._jsonrpc_request
+        if self._jsonrpc_parse_error is not None:
+            output = jsonrpc_error(None, PARSE_ERROR,
+                                   "Parse error: %s" %
+                                   self._jsonrpc_parse_error)
+        elif isinstance(data, list) and data:
+            output = [result for result in
+                      self._run_calls(self._jsonrpc_call, data, environ)
+                      if result is not None]
+        elif isinstance(data, list):
+            output = jsonrpc_error(None, INVALID_REQUEST, "Empty batch")
+        else:
+            output = self._jsonrpc_call(data)
+
+        response = self._py_object.response
+        if not output:
+            # Only notifications, which get no response
+            response.status_int = 204
+            response.headers.pop('Content-Type', None)
+            return ''
+        response.content_type = 'application/json'
+        body, encoding = self._encode_body(environ,
+                                           self._dump_output(output))
+        if encoding:
+            response.content_encoding = encoding
+        if self.gzip_min_length is not None:
+            response.headers.add('Vary', 'Accept-Encoding')
+        return body
+
+    def _dump_output(self, output):
+        """Serialize the response ``output``, replacing the response
+        objects that can't be with internal errors"""
+        try:
+            return simplejson.dumps(output, default=encode_xmlrpc_value)
+        except (TypeError, ValueError), e:
+            if isinstance(output, list):
+                return '[%s]' % ', '.join([self._dump_output(item)
+                                           for item in output])
+            log.error("Failed to serialize the result of JSON-RPC request "
+                      "%r", output['id'], exc_info=True)
+            return simplejson.dumps(jsonrpc_error(
+                output['id'], INTERNAL_ERROR,
+                "%s:%s" % (e.__class__.__name__, e)))
+
+    def _jsonrpc_call(self, request):
+        """Call the method of a single JSON-RPC request object, returning
+        the response object (or None for a notification)"""
+        if not isinstance(request, dict):
+            return jsonrpc_error(None, INVALID_REQUEST,
+                                 "Request must be an object")
+        id = request.get('id')
+        orig_method = request.get('method')
+        params = request.get('params', ())
+        if request.get('jsonrpc') != '2.0' or \
+           not isinstance(orig_method, basestring) or \
+           not isinstance(params, (list, tuple, dict)):
+            return jsonrpc_error(id, INVALID_REQUEST, "Invalid Request")
+        if isinstance(params, list):
+            params = tuple(params)
+
+        kargs = self.rpc_kargs
+        result = self._call_method(orig_method, params, kargs['environ'],
+                                   kargs['start_response'])
+        if 'id' not in request:
+            return None
+        if isinstance(result, xmlrpclib.Fault):
+            return jsonrpc_error(id, result.faultCode, result.faultString)
+        return jsonrpc_result(id, result)
+
+    def _prepare_call(self, orig_method, rpc_args, environ, start_response):
+        """Look up the method called ``orig_method`` and check
+        ``rpc_args`` against its signature, converting named params to
+        positional ones first"""
+        if isinstance(rpc_args, dict):
+            func = self._find_method(self._find_method_name(orig_method))
+            if func:
+                rpc_args = self._positional_args(func, rpc_args)
+                if isinstance(rpc_args, xmlrpclib.Fault):
+                    return rpc_args
+            else:
+                rpc_args = ()
+        return XMLRPCController._prepare_call(self, orig_method, rpc_args,
+                                              environ, start_response)
+
+    def _positional_args(self, func, params):
+        """Return a tuple of the named ``params`` in the order of the
+        arguments of ``func``, or an xmlrpclib.Fault when they don't
+        match them"""
+        argnames = self._get_method_registry().get_call_info(func)[0]
+        unknown = [name for name in params if name not in argnames]
+        if unknown:
+            return xmlrpclib.Fault(INVALID_PARAMS, "Unknown params %r" %
+                                   sorted(unknown))
+        args = []
+        for name in argnames:
+            if name not in params:
+                break
+            args.append(params[name])
+        if len(args) != len(params):
+            return xmlrpclib.Fault(INVALID_PARAMS, "Missing param %r" %
+                                   argnames[len(args)])
+        return tuple(args)
@@ -15,9 +15,11 @@ Functions available:
 """
 import base64
 import binascii
+import gzip
 import hmac
 import logging
 import re
+import types
 try:
     import cPickle as pickle
 except ImportError:
@@ -26,15 +28,17 @@ try:
     from hashlib import sha1
 except ImportError:
     import sha as sha1
+from cStringIO import StringIO
 
 from webob import Request as WebObRequest
 from webob import Response as WebObResponse
 from webob.exc import status_map
 
 import pylons
+from pylons.context import bind_context
 
-__all__ = ['abort', 'etag_cache', 'redirect', 'redirect_to', 'Request',
-           'Response']
+__all__ = ['abort', 'accepts_gzip', 'etag_cache', 'gzip_body', 'not_modified',
+           'redirect', 'redirect_to', 'Request', 'Response', 'StreamingBody']
 
 log = logging.getLogger(__name__)
 
@@ -104,7 +108,21 @@ class Response(WebObResponse):
         return self.body
     
     def write(self, content):
-        self.body_file.write(content)
+        """Append ``content`` to the response body
+        
+        A streamed body (see :class:`StreamingBody`) isn't read into
+        memory, ``content`` is sent after it.
+        
+        """
+        app_iter = self.app_iter
+        if isinstance(app_iter, list):
+            self.body_file.write(content)
+            return
+        if isinstance(content, unicode):
+            content = content.encode(self.charset)
+        if not isinstance(app_iter, StreamingBody):
+            app_iter = self.app_iter = StreamingBody(app_iter, self.charset)
+        app_iter.extra.append(content)
     
     def wsgi_response(self):
         return self.status, self.headers, self.body
@@ -123,6 +141,79 @@ class Response(WebObResponse):
         self.set_cookie(name, sig + base64.encodestring(pickled), **kwargs)
 
 
+class StreamingBody(object):
+    """Response body streamed from the iterable ``app_iter``
+    
+    Unicode chunks are encoded with ``charset`` (unless it's None), and
+    the chunks in the ``extra`` list (see :meth:`Response.write`) are
+    sent once ``app_iter`` is exhausted.
+    
+    When ``context`` (a :class:`~pylons.util.PylonsContext`) is set, it
+    is bound to the thread (see :mod:`pylons.context`) whenever
+    ``app_iter`` is advanced or closed, so the Pylons globals remain
+    available to a generator after the request handling has returned.
+    
+    Closing the body closes ``app_iter`` and then calls the callables
+    in the ``on_close`` list, in order (without binding ``context``).
+    
+    """
+    def __init__(self, app_iter, charset, context=None):
+        self.app_iter = app_iter
+        self.charset = charset
+        self.context = context
+        self.extra = []
+        self.on_close = []
+    
+    def __iter__(self):
+        charset = self.charset
+        app_iter = self._call_bound(iter, self.app_iter)
+        while True:
+            try:
+                chunk = self._call_bound(app_iter.next)
+            except StopIteration:
+                break
+            if charset is not None and isinstance(chunk, unicode):
+                chunk = chunk.encode(charset)
+            yield chunk
+        for chunk in self.extra:
+            yield chunk
+    
+    def close(self):
+        on_close, self.on_close = self.on_close, []
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self._call_bound(self.app_iter.close)
+        finally:
+            self._run_on_close(on_close)
+    
+    def _run_on_close(self, on_close):
+        """Call the first of the ``on_close`` callables, and then the
+        rest of them even if it raises"""
+        if on_close:
+            try:
+                on_close.pop(0)()
+            finally:
+                self._run_on_close(on_close)
+    
+    def _call_bound(self, func, *args):
+        """Call ``func`` with ``context`` bound to the thread"""
+        if self.context is None:
+            return func(*args)
+        previous_context = bind_context(self.context)
+        try:
+            return func(*args)
+        finally:
+            bind_context(previous_context)
+
+
+def _is_file_wrapper(environ, app_iter):
+    """Return whether ``app_iter`` is a file wrapped with the server's
+    ``wsgi.file_wrapper``"""
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    return isinstance(file_wrapper, (type, types.ClassType)) and \
+        isinstance(app_iter, file_wrapper)
+
+
 def etag_cache(key=None):
     """Use the HTTP Entity Tag cache for Browser side caching
     
@@ -155,14 +246,52 @@ def etag_cache(key=None):
     response.headers['ETag'] = '"%s"' % key
     if str(key) in if_none_matches:
         log.debug("ETag match, returning 304 HTTP Not Modified Response")
-        response.headers.pop('Content-Type', None)
-        response.headers.pop('Cache-Control', None)
-        response.headers.pop('Pragma', None)
-        raise status_map[304]().exception
+        not_modified(response)
     else:
         log.debug("ETag didn't match, returning response object")
 
 
+def not_modified(response):
+    """Raise a ``304`` HTTP Not Modified exception, first removing the
+    headers a 304 response shouldn't have from ``response``
+    
+    Used by :func:`etag_cache` and the ``conditional`` option of
+    :func:`~pylons.decorators.cache.beaker_cache`.
+    
+    """
+    response.headers.pop('Content-Type', None)
+    response.headers.pop('Cache-Control', None)
+    response.headers.pop('Pragma', None)
+    raise status_map[304]().exception
+
+
+def accepts_gzip(accept_encoding):
+    """Returns whether an Accept-Encoding header value accepts gzip"""
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            param = param.split('=', 1)
+            if param[0].strip() == 'q' and len(param) == 2:
+                try:
+                    return float(param[1]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def gzip_body(body, compresslevel=6):
+    """Returns ``body`` gzip compressed"""
+    buf = StringIO()
+    zfile = gzip.GzipFile(mode='wb', compresslevel=compresslevel,
+                          fileobj=buf)
+    zfile.write(body)
+    zfile.close()
+    return buf.getvalue()
+
+
 def forward(wsgi_app):
     """Forward the request to a WSGI application. Returns its response.
     
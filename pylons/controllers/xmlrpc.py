@@ -1,15 +1,27 @@
 """The base WSGI XMLRPCController"""
+import copy
 import inspect
 import logging
+import os
+import Queue
+import threading
 import types
 import xmlrpclib
-
+import zlib
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from paste.deploy.converters import asbool
+from paste.registry import Registry
 from paste.response import replace_header
 
+from pylons.context import bind_context, current_context
 from pylons.controllers import WSGIController
-from pylons.controllers.util import abort, Response
+from pylons.controllers.util import abort, accepts_gzip, gzip_body, Response
 
-__all__ = ['XMLRPCController']
+__all__ = ['XMLRPCController', 'XMLRPCMethodRegistry']
 
 log = logging.getLogger(__name__)
 
@@ -30,12 +42,104 @@ def xmlrpc_sig(args):
     return signature
 
 
+# Exact types unmarshalled by xmlrpclib, to avoid the isinstance checks
+# of xmlrpc_sig for them
+_XMLRPC_TYPES = {str: 'string', unicode: 'string', list: 'array',
+                 bool: 'boolean', int: 'int', float: 'double',
+                 dict: 'struct', xmlrpclib.DateTime: 'dateTime.iso8601',
+                 xmlrpclib.Binary: 'base64'}
+
+def make_signature_validator(signatures):
+    """Create a function checking whether a tuple of args provided by
+    xmlrpclib matches one of the ``signatures`` of a method
+    
+    ``signatures`` is in the format of the signature attribute of
+    XMLRPCController methods.
+    
+    """
+    by_arity = {}
+    for sig in signatures:
+        by_arity.setdefault(len(sig) - 1, set()).add(tuple(sig[1:]))
+    def validate(args):
+        params = by_arity.get(len(args))
+        if params is None:
+            return False
+        try:
+            return tuple([_XMLRPC_TYPES[arg.__class__]
+                          for arg in args]) in params
+        except KeyError:
+            return tuple(xmlrpc_sig(args)) in params
+    return validate
+
+
 def xmlrpc_fault(code, message):
     """Convienence method to return a Pylons response XMLRPC Fault"""
     fault = xmlrpclib.Fault(code, message)
     return Response(body=xmlrpclib.dumps(fault, methodresponse=True))
 
 
+def _fault_struct(fault):
+    """Return the struct representing ``fault`` in a
+    ``system.multicall`` response"""
+    return {'faultCode': fault.faultCode, 'faultString': fault.faultString}
+
+
+class XMLRPCMethodRegistry(object):
+    """The XML-RPC methods of an :class:`XMLRPCController` subclass
+    
+    Built once per controller class (on its first request) so that
+    calls don't need to reflect on the controller.
+    
+    ``methods``
+        Dict of internal method names to the functions implementing
+        them. Names starting with an underscore are never methods.
+    ``names``
+        Sorted list of the internal method names.
+    
+    The argument names and a signature validator (see
+    :func:`make_signature_validator`) are precomputed for the methods,
+    and created on demand for methods found otherwise.
+    
+    .. note::
+        The registry reflects the class as it was when first used.
+        Methods added to the class afterwards are still found, but
+        replacing an existing method or its signature requires
+        deleting the class's ``_pylons_xmlrpc_methods`` attribute.
+    
+    """
+    def __init__(self, cls):
+        self.methods = {}
+        self.call_info = {}
+        seen = set()
+        for klass in cls.__mro__:
+            for name, value in klass.__dict__.iteritems():
+                if name in seen:
+                    continue
+                seen.add(name)
+                if name.startswith('_') or \
+                   not isinstance(value, types.FunctionType):
+                    continue
+                self.methods[name] = value
+                self.get_call_info(value)
+        self.names = sorted(self.methods)
+
+    def get_call_info(self, func):
+        """Return a tuple of the argument names of ``func`` (excluding
+        self) and its signature validator, or None if it has no
+        signature"""
+        key = getattr(func, 'im_func', func)
+        try:
+            return self.call_info[key]
+        except KeyError:
+            argnames = inspect.getargspec(func)[0][1:]
+            signature = getattr(func, 'signature', None)
+            validate = None
+            if signature is not None:
+                validate = make_signature_validator(signature)
+            info = self.call_info[key] = (argnames, validate)
+            return info
+
+
 class XMLRPCController(WSGIController):
     """XML-RPC Controller that speaks WSGI
     
@@ -94,13 +198,65 @@ class XMLRPCController(WSGIController):
     enabling it allows translating ``None`` to XML (an extension to the
     XML-RPC specification)
 
+    Request bodies are parsed incrementally, ``read_chunk_size`` bytes
+    at a time, and may be at most ``max_body_length`` bytes. Requests
+    without a Content-Length are accepted when they use chunked
+    Transfer-Encoding (which the WSGI server must de-chunk). Bodies
+    with a gzip Content-Encoding are decompressed as they're read, and
+    ``max_body_length`` applies to both their compressed and
+    decompressed size.
+
+    Responses are gzip compressed (at ``gzip_compresslevel``) for
+    clients accepting it when they're at least ``gzip_min_length``
+    bytes long. This is disabled by default; set ``gzip_min_length``
+    to a number of bytes to enable it.
+
+    ``system.multicall`` runs several calls in one request, each
+    through the same signature checks as a single call, and returns
+    an array holding a one element array with each call's result or a
+    fault struct. Setting the class variable ``multicall_threads`` to
+    a positive number runs the calls concurrently on up to that many
+    threads (the request's own, and those of a worker pool shared by
+    the process), with the Pylons globals of the request available in
+    each.
+    Every call runs on a shallow copy of the controller, so only
+    enable it for methods that don't depend on each other.
+
+    The fault codes returned for unknown methods, bad argument
+    signatures and exceptions raised by the methods of a multicall are
+    the class variables ``method_not_found_fault``,
+    ``bad_signature_fault`` and ``internal_error_fault``.
+
+    The responses of methods with a ``cache_expire`` attribute (a
+    number of seconds, or "never") are cached in the Beaker cache
+    (used the same way as by
+    :func:`~pylons.decorators.cache.beaker_cache`), keyed on the method
+    and its params. A cached response is returned as is, without
+    calling the method or marshalling its result again. The
+    ``cache_type`` attribute selects the Beaker cache type to use.
+    Faults aren't cached, and ``system.multicall`` calls don't use the
+    cache::
+
+        def lookup(self, id):
+            return LookUpThing(id)
+        lookup.signature = [['struct', 'int']]
+        lookup.cache_expire = 300
+
     .. note::
 
         Requiring a signature is optional.
     
     """
     allow_none = False
+    body_format = 'XML'
     max_body_length = 4194304
+    read_chunk_size = 65536
+    multicall_threads = 0
+    gzip_min_length = None
+    gzip_compresslevel = 6
+    method_not_found_fault = 0
+    bad_signature_fault = 0
+    internal_error_fault = 1
 
     def _get_method_args(self):
         return self.rpc_kargs
@@ -108,96 +264,268 @@ class XMLRPCController(WSGIController):
     def __call__(self, environ, start_response):
         """Parse an XMLRPC body for the method, and call it with the
         appropriate arguments"""
+        length = self._get_body_length(environ)
+        rpc_args, orig_method = self._parse_body(environ, length)
+
+        prepared = self._prepare_call(orig_method, rpc_args, environ,
+                                      start_response)
+        if isinstance(prepared, xmlrpclib.Fault):
+            return xmlrpc_fault(prepared.faultCode, prepared.faultString)(
+                environ, start_response)
+        self._func, self.rpc_kargs = prepared
+        self._rpc_args = rpc_args
+
+        # Now that we know the method is valid, and the args are valid,
+        # we can dispatch control to the default WSGIController
+        status = []
+        headers = []
+        exc_info = []
+        def change_content(new_status, new_headers, new_exc_info=None):
+            status.append(new_status)
+            headers.extend(new_headers)
+            exc_info.append(new_exc_info)
+        output = WSGIController.__call__(self, environ, change_content)
+        body = ''.join(output)
+        if hasattr(output, 'close'):
+            output.close()
+        body, encoding = self._encode_body(environ, body)
+        if encoding:
+            replace_header(headers, 'Content-Encoding', encoding)
+        if self.gzip_min_length is not None:
+            headers.append(('Vary', 'Accept-Encoding'))
+        replace_header(headers, 'Content-Length', str(len(body)))
+        replace_header(headers, 'Content-Type', 'text/xml')
+        start_response(status[0], headers, exc_info[0])
+        return [body]
+
+    def _encode_body(self, environ, body):
+        """Return a tuple of the response ``body``, compressed if the
+        client accepts it, and its Content-Encoding (or None)"""
+        if self.gzip_min_length is None or \
+           len(body) < self.gzip_min_length or \
+           not accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING', '')):
+            return body, None
+        if self._pylons_log_debug:
+            log.debug("Compressing %s byte response with gzip", len(body))
+        return gzip_body(body, self.gzip_compresslevel), 'gzip'
+
+    def _get_body_length(self, environ):
+        """Return the Content-Length of the request, or None for a
+        chunked request
+        
+        Aborts with a 411 error when the length is missing and with a
+        413 error when it's larger than ``max_body_length``.
+        
+        """
         # Pull out the length, return an error if there is no valid
         # length or if the length is larger than the max_body_length.
         log_debug = self._pylons_log_debug
         length = environ.get('CONTENT_LENGTH')
         if length:
             length = int(length)
+        elif 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # Read the (server de-chunked) body until it ends
+            if log_debug:
+                log.debug("Chunked request body, reading until the end")
+            length = None
         else:
             # No valid Content-Length header found
             if log_debug:
                 log.debug("No Content-Length found, returning 411 error")
             abort(411)
-        if length > self.max_body_length or length == 0:
+        if length is not None and (length > self.max_body_length or
+                                   length == 0):
             if log_debug:
                 log.debug("Content-Length larger than max body length. Max: "
                           "%s, Sent: %s. Returning 413 error",
                           self.max_body_length, length)
-            abort(413, "XML body too large")
-
-        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
-        rpc_args, orig_method = xmlrpclib.loads(body)
+            abort(413, "%s body too large" % self.body_format)
+        return length
 
+    def _prepare_call(self, orig_method, rpc_args, environ, start_response):
+        """Look up the method called ``orig_method`` and check
+        ``rpc_args`` against its signature
+        
+        Returns a tuple of the method and the keyword arguments to call
+        it with, or an xmlrpclib.Fault when the method doesn't exist or
+        the arguments don't match its signature.
+        
+        """
+        log_debug = self._pylons_log_debug
         method = self._find_method_name(orig_method)
         func = self._find_method(method)
         if not func:
             if log_debug:
                 log.debug("Method: %r not found, returning xmlrpc fault",
                           method)
-            return xmlrpc_fault(0, "No such method name %r" %
-                                method)(environ, start_response)
+            return xmlrpclib.Fault(self.method_not_found_fault,
+                                   "No such method name %r" % method)
 
         # Signature checking for params
-        if hasattr(func, 'signature'):
+        argnames, validate = self._get_method_registry().get_call_info(func)
+        if validate is not None:
             if log_debug:
                 log.debug("Checking XMLRPC argument signature")
-            valid_args = False
-            params = xmlrpc_sig(rpc_args)
-            for sig in func.signature:
-                # Next sig if we don't have the same amount of args
-                if len(sig)-1 != len(rpc_args):
-                    continue
-
-                # If the params match, we're valid
-                if params == sig[1:]:
-                    valid_args = True
-                    break
-
-            if not valid_args:
+            if not validate(rpc_args):
                 if log_debug:
                     log.debug("Bad argument signature recieved, returning "
                               "xmlrpc fault")
                 msg = ("Incorrect argument signature. %r recieved does not "
                        "match %r signature for method %r" % \
-                           (params, func.signature, orig_method))
-                return xmlrpc_fault(0, msg)(environ, start_response)
+                           (xmlrpc_sig(rpc_args), func.signature,
+                            orig_method))
+                return xmlrpclib.Fault(self.bad_signature_fault, msg)
 
         # Change the arg list into a keyword dict based off the arg
         # names in the functions definition
-        arglist = inspect.getargspec(func)[0][1:]
-        kargs = dict(zip(arglist, rpc_args))
+        kargs = dict(zip(argnames, rpc_args))
         kargs['action'], kargs['environ'] = method, environ
         kargs['start_response'] = start_response
-        self.rpc_kargs = kargs
-        self._func = func
+        return func, kargs
+
+    def _parse_body(self, environ, length):
+        """Parse the XML-RPC request body, returning a tuple of the
+        params and the method name
         
-        # Now that we know the method is valid, and the args are valid,
-        # we can dispatch control to the default WSGIController
-        status = []
-        headers = []
-        exc_info = []
-        def change_content(new_status, new_headers, new_exc_info=None):
-            status.append(new_status)
-            headers.extend(new_headers)
-            exc_info.append(new_exc_info)
-        output = WSGIController.__call__(self, environ, change_content)
-        output = list(output)
-        headers.append(('Content-Length', str(len(output[0]))))
-        replace_header(headers, 'Content-Type', 'text/xml')
-        start_response(status[0], headers, exc_info[0])
-        return output
+        The body is fed to an incremental parser as it's read (see
+        :meth:`_read_body`), so it's never held in memory whole. Empty
+        bodies are aborted with a 400 error.
+        
+        """
+        parser, unmarshaller = xmlrpclib.getparser()
+        empty = True
+        for chunk in self._read_body(environ, length):
+            parser.feed(chunk)
+            empty = False
+        if empty:
+            abort(400, "Empty XML body")
+        parser.close()
+        return unmarshaller.close(), unmarshaller.getmethodname()
+
+    def _read_body(self, environ, length):
+        """Iterate over the request body, read from ``wsgi.input``
+        ``read_chunk_size`` bytes at a time and decompressed when it has
+        a gzip Content-Encoding
+        
+        A ``length`` of None reads until the end of the stream. Bodies
+        longer than ``max_body_length`` (before or after decompression)
+        are aborted with a 413 error, and corrupt ones with a 400 error.
+        Other Content-Encodings are aborted with a 415 error.
+        
+        """
+        log_debug = self._pylons_log_debug
+        input = environ['wsgi.input']
+        encoding = environ.get('HTTP_CONTENT_ENCODING', 'identity')
+        encoding = encoding.strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'identity':
+            decompressor = None
+        else:
+            if log_debug:
+                log.debug("Unsupported Content-Encoding %r, returning 415 "
+                          "error", encoding)
+            abort(415, "Unsupported Content-Encoding")
+
+        read = decoded = 0
+        while True:
+            if length is not None and read >= length:
+                chunk = ''
+            else:
+                size = self.read_chunk_size
+                if length is not None:
+                    size = min(size, length - read)
+                chunk = input.read(size)
+                read += len(chunk)
+            if decompressor is not None:
+                try:
+                    if chunk:
+                        # Don't decompress more than we'd accept
+                        limit = self.max_body_length - decoded + 1
+                        data = decompressor.decompress(chunk, limit)
+                    else:
+                        data = decompressor.flush()
+                except zlib.error, e:
+                    if log_debug:
+                        log.debug("Invalid gzip body, returning 400 error: "
+                                  "%s", e)
+                    abort(400, "Invalid gzip body")
+            else:
+                data = chunk
+            decoded += len(data)
+            if read > self.max_body_length or \
+               decoded > self.max_body_length:
+                if log_debug:
+                    log.debug("Body larger than max body length. Max: %s. "
+                              "Returning 413 error", self.max_body_length)
+                abort(413, "%s body too large" % self.body_format)
+            if data:
+                yield data
+            if not chunk:
+                break
 
     def _dispatch_call(self):
         """Dispatch the call to the function chosen by __call__"""
-        raw_response = self._inspect_call(self._func)
-        if not isinstance(raw_response, xmlrpclib.Fault):
+        func = self._func
+        expire = getattr(func, 'cache_expire', None)
+        cache = None
+        if expire is not None and \
+           asbool(self._py_object.config.get('cache_enabled', 'True')):
+            cache, cache_key = self._get_response_cache(func)
+            try:
+                response = cache.get(cache_key)
+            except KeyError:
+                pass
+            else:
+                if self._pylons_log_debug:
+                    log.debug("Returning cached response for %r",
+                              func.__name__)
+                return response
+
+        raw_response = self._inspect_call(func)
+        if isinstance(raw_response, xmlrpclib.Fault):
+            cache = None
+        else:
             raw_response = (raw_response,)
 
         response = xmlrpclib.dumps(raw_response, methodresponse=True,
                                    allow_none=self.allow_none)
+        if cache is not None:
+            if expire == 'never':
+                expire = None
+            cache.put(cache_key, response, expiretime=expire)
         return response
 
+    def _get_response_cache(self, func):
+        """Return a tuple of the Beaker cache and the key to cache the
+        response of calling ``func`` with the current request's params
+        under
+        
+        The cache's namespace is the controller class (as used by
+        :func:`~pylons.decorators.cache.beaker_cache`) and the key the
+        method name followed by a hash of the marshalled params.
+        
+        """
+        py_obj = self._py_object
+        cache_obj = getattr(py_obj.app_globals, 'cache', None)
+        if not cache_obj:
+            cache_obj = getattr(py_obj, 'cache', None)
+        if not cache_obj:
+            raise Exception('No CacheMiddleware or cache object on '
+                            ' app_globals was found')
+        cls = self.__class__
+        b_kwargs = {}
+        cache_type = getattr(func, 'cache_type', None)
+        if cache_type:
+            b_kwargs['type'] = cache_type
+        cache = cache_obj.get_cache('%s.%s' % (cls.__module__, cls.__name__),
+                                    **b_kwargs)
+        params = xmlrpclib.dumps(tuple(self._rpc_args), allow_none=True)
+        if isinstance(params, unicode):
+            params = params.encode('utf-8')
+        cache_key = '%s %s' % (func.__name__, md5(params).hexdigest())
+        return cache, cache_key
+
     def _find_method(self, name):
         """Locate a method in the controller by the specified name and
         return it"""
@@ -209,6 +537,9 @@ class XMLRPCController(WSGIController):
 
         if self._pylons_log_debug:
             log.debug("Looking for XMLRPC method: %r", name)
+        func = self._get_method_registry().methods.get(name)
+        if func is not None and name not in self.__dict__:
+            return func.__get__(self, self.__class__)
         try:
             func = getattr(self, name, None)
         except UnicodeEncodeError:
@@ -216,6 +547,17 @@ class XMLRPCController(WSGIController):
         if isinstance(func, types.MethodType):
             return func
 
+    def _get_method_registry(cls):
+        """Return the :class:`XMLRPCMethodRegistry` for this controller
+        class, building it on first use"""
+        try:
+            return cls.__dict__['_pylons_xmlrpc_methods']
+        except KeyError:
+            registry = XMLRPCMethodRegistry(cls)
+            cls._pylons_xmlrpc_methods = registry
+            return registry
+    _get_method_registry = classmethod(_get_method_registry)
+
     def _find_method_name(self, name):
         """Locate a method in the controller by the appropriate name
         
@@ -236,14 +578,8 @@ class XMLRPCController(WSGIController):
 
     def system_listMethods(self):
         """Returns a list of XML-RPC methods for this XML-RPC resource"""
-        methods = []
-        for method in dir(self):
-            meth = getattr(self, method)
-
-            if not method.startswith('_') and isinstance(meth,
-                                                         types.MethodType):
-                methods.append(self._publish_method_name(method))
-        return methods
+        return [self._publish_method_name(name)
+                for name in self._get_method_registry().names]
     system_listMethods.signature = [['array']]
 
     def system_methodSignature(self, name):
@@ -275,6 +611,148 @@ class XMLRPCController(WSGIController):
         return xmlrpclib.Fault(0, "No such method name")
     system_methodHelp.signature = [['string', 'string']]
 
+    def system_multicall(self, calls):
+        """Calls each of the methods in an array of structs holding a
+        methodName and params array, returning an array of their
+        results
+
+        Each result is an array holding the value the method returned,
+        or a struct with the faultCode and faultString of a fault.
+        
+        """
+        kargs = self.rpc_kargs
+        environ, start_response = kargs['environ'], kargs['start_response']
+        def multicall(call):
+            try:
+                orig_method = call['methodName']
+                rpc_args = tuple(call['params'])
+            except (KeyError, TypeError):
+                return _fault_struct(xmlrpclib.Fault(
+                    0, "system.multicall calls must be structs with a "
+                    "methodName and params"))
+            if orig_method == 'system.multicall':
+                return _fault_struct(xmlrpclib.Fault(
+                    0, "Recursive system.multicall forbidden"))
+            result = self._call_method(orig_method, rpc_args, environ,
+                                       start_response)
+            if isinstance(result, xmlrpclib.Fault):
+                return _fault_struct(result)
+            return [result]
+        return self._run_calls(multicall, calls, environ)
+    system_multicall.signature = [['array', 'array']]
+
+    def _call_method(self, orig_method, rpc_args, environ, start_response):
+        """Call the method called ``orig_method`` with ``rpc_args``,
+        returning its result or an xmlrpclib.Fault
+        
+        Used for the individual calls of a batch. Exceptions raised by
+        the method are returned as an ``internal_error_fault`` fault,
+        and HTTP exceptions as a fault with their status code.
+        
+        """
+        prepared = self._prepare_call(orig_method, rpc_args, environ,
+                                      start_response)
+        if isinstance(prepared, xmlrpclib.Fault):
+            return prepared
+        func, kargs = prepared
+
+        # Keep the per call state of each call apart
+        controller = copy.copy(self)
+        controller.rpc_kargs = kargs
+        func = func.im_func.__get__(controller, controller.__class__)
+        try:
+            result = controller._inspect_call(func)
+        except xmlrpclib.Fault, fault:
+            return fault
+        except Exception, e:
+            log.error("Call to %r failed", orig_method, exc_info=True)
+            return xmlrpclib.Fault(self.internal_error_fault,
+                                   "%s:%s" % (e.__class__.__name__, e))
+        if getattr(result, '_exception', False):
+            response = result.wsgi_response
+            return xmlrpclib.Fault(response.status_int, response.status)
+        return result
+
+    def _run_calls(self, run_call, calls, environ):
+        """Return the results of ``run_call`` for each of ``calls``, in
+        order
+        
+        Runs them concurrently on up to ``multicall_threads`` threads,
+        when set: the request's thread and the threads of the process
+        wide multicall pool, with the Pylons globals of the request set
+        up in each.
+        
+        """
+        threads = min(self.multicall_threads, len(calls))
+        if threads <= 1:
+            return [run_call(call) for call in calls]
+
+        # The Pylons globals are bound per thread; set up each pool
+        # thread with the ones of this request
+        context = current_context()
+        registrations = []
+        registry = environ.get('paste.registry')
+        if registry is not None:
+            for reglist in registry.reglist:
+                registrations.extend(reglist.values())
+
+        results = [None] * len(calls)
+        pending = Queue.Queue()
+        for index in xrange(len(calls)):
+            pending.put(index)
+        # Number of helpers running, or None once the calls are done
+        helpers = [0]
+        helpers_done = threading.Condition()
+
+        def run_calls():
+            while True:
+                try:
+                    index = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                results[index] = run_call(calls[index])
+
+        def help_run_calls():
+            helpers_done.acquire()
+            try:
+                if helpers[0] is None:
+                    # Started after all the calls were done
+                    return
+                helpers[0] += 1
+            finally:
+                helpers_done.release()
+            previous = bind_context(context)
+            thread_registry = Registry()
+            thread_registry.prepare()
+            thread_registry.multiregister(registrations)
+            try:
+                run_calls()
+            finally:
+                thread_registry.cleanup()
+                bind_context(previous)
+                helpers_done.acquire()
+                try:
+                    helpers[0] -= 1
+                    helpers_done.notify()
+                finally:
+                    helpers_done.release()
+
+        pool = _get_multicall_pool()
+        pool.grow(self.multicall_threads - 1)
+        for i in xrange(threads - 1):
+            pool.put(help_run_calls)
+        # Run calls in this thread too, so the multicall progresses
+        # while the pool is busy with other requests
+        run_calls()
+        helpers_done.acquire()
+        try:
+            while helpers[0]:
+                helpers_done.wait()
+            helpers[0] = None
+        finally:
+            helpers_done.release()
+        return results
+
 
 class MethodHelp(object):
     """Wrapper for formatting doc strings from XMLRPCController
@@ -297,3 +775,61 @@ class MethodHelp(object):
             return ''
         return doc
     getdoc = staticmethod(getdoc)
+
+
+class _WorkerPool(object):
+    """Daemon threads running the callables put on the pool"""
+    def __init__(self):
+        # The threads only exist in the process that started them
+        self.pid = os.getpid()
+        self.tasks = Queue.Queue()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def grow(self, size):
+        """Start more threads, if needed, to have ``size`` of them"""
+        self.lock.acquire()
+        try:
+            while self.size < size:
+                worker = threading.Thread(target=self._work)
+                worker.setDaemon(True)
+                worker.start()
+                self.size += 1
+        finally:
+            self.lock.release()
+
+    def put(self, task):
+        """Run ``task`` on the next free thread"""
+        self.tasks.put(task)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                task()
+            except:
+                log.error("Multicall pool task failed", exc_info=True)
+
+
+_multicall_pool = None
+_multicall_pool_lock = threading.Lock()
+
+def _get_multicall_pool():
+    """Return the process wide pool running the calls of multicalls,
+    creating it on first use
+    
+    A forked process gets a new pool, as the threads of the parent's
+    pool don't run in it.
+    
+    The pool grows to one thread less than the largest
+    ``multicall_threads`` of the controllers using it.
+    
+    """
+    global _multicall_pool
+    _multicall_pool_lock.acquire()
+    try:
+        if _multicall_pool is None or _multicall_pool.pid != os.getpid():
+            _multicall_pool = _WorkerPool()
+        return _multicall_pool
+    finally:
+        _multicall_pool_lock.release()
@@ -2,19 +2,41 @@
 import inspect
 import logging
 import time
+import zlib
+from email.Utils import formatdate, mktime_tz, parsedate_tz
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 from decorator import decorator
 from paste.deploy.converters import asbool
 
+import pylons
+from pylons.caching import _lock_key, cache_stats, estimate_size, \
+    get_generations, get_local, get_with_grace, new_generation, put_local
+from pylons.controllers.util import IF_NONE_MATCH, accepts_gzip, gzip_body, \
+    not_modified
 from pylons.decorators.util import get_pylons
+from pylons.i18n.translation import get_lang
     
 log = logging.getLogger(__name__)
 
+__all__ = ['beaker_cache', 'create_cache_key', 'invalidate_namespace',
+           'invalidate_tag', 'make_key_dict_builder']
+
+# Longest cache key used before hashing the key's items, leaving room
+# for the namespace in backends limiting the key length (memcached's
+# limit is 250 bytes)
+MAX_KEY_LENGTH = 150
+
 def beaker_cache(key="cache_default", expire="never", type=None,
                  query_args=False,
                  cache_headers=('content-type', 'content-length'),
                  invalidate_on_startup=False, 
-                 cache_response=True, **b_kwargs):
+                 cache_response=True, local_expire=None, stale_grace=None,
+                 conditional=False, tags=None, vary=None, compress=False,
+                 **b_kwargs):
     """Cache decorator utilizing Beaker. Caches action or other
     function that returns a pickle-able object as a result.
 
@@ -46,6 +68,49 @@ def beaker_cache(key="cache_default", expire="never", type=None,
         .. note::
             When cache_response is set to False, the cache_headers
             argument is ignored as none of the response is cached.
+    ``local_expire``
+        Time in seconds to also keep the cached copy in the
+        per-process :data:`~pylons.caching.local_cache`, which is
+        checked before Beaker. Defaults to None, which doesn't use it.
+        The local copy never outlives the Beaker copy.
+    ``stale_grace``
+        Time in seconds to keep serving the cached copy for after it
+        expires, while a single caller regenerates it. Defaults to
+        None, where every caller missing the cache waits for Beaker's
+        creation lock instead. Requires an ``expire`` time.
+    ``conditional``
+        If True, responses of actions returning strings get ETag (a
+        hash of the content) and Last-Modified (when it was cached)
+        headers, and GET requests with a matching If-None-Match or
+        If-Modified-Since header get a 304 Not Modified response.
+        The content is cached apart from the rest of the response, so
+        a 304 doesn't need to load it. Defaults to False.
+    ``tags``
+        A list of tags for the cached copy, which can then be
+        invalidated along with all the others sharing one of its tags
+        with :func:`invalidate_tag`, or with all those of its namespace
+        with :func:`invalidate_namespace`. Tags are formatted with the
+        function arguments, as in ``'product-%(id)s'``. Or a function
+        returning the tags, called with the function arguments.
+        Defaults to None, which doesn't allow either; otherwise the
+        generations of the tags and namespace are looked up in the
+        cache on each call.
+    ``vary``
+        A list of request headers whose values are also used as the
+        key, such as ``['Accept-Language']``, which are listed in the
+        Vary header of the response. Header values are compared
+        ignoring case and whitespace. Use ``'Cookie:name'`` to only use
+        the value of the cookie ``name``, and ``'lang'`` to use the
+        language set with :func:`~pylons.i18n.translation.set_lang`
+        (which isn't a header, so isn't listed in the Vary header).
+    ``compress``
+        If True, the results of actions returning strings are cached
+        gzip compressed, and sent as they are (with a gzip
+        Content-Encoding) to clients accepting it. Other clients get
+        them decompressed. Unicode results are encoded with the
+        response charset first. Both are sent with Accept-Encoding in
+        the Vary header, and with ``conditional`` the compressed copy
+        gets its own ETag. Defaults to False.
 
     If cache_enabled is set to False in the .ini file, then cache is
     disabled globally.
@@ -56,9 +121,25 @@ def beaker_cache(key="cache_default", expire="never", type=None,
     else:
         starttime = None
     cache_headers = set(cache_headers)
+    if vary:
+        vary_keys, vary_header = _parse_vary(vary)
+    else:
+        vary_keys = vary_header = None
 
-    def wrapper(func, *args, **kwargs):
-        """Decorator wrapper"""
+    def cache_decorator(func):
+        """Decorate ``func``, precomputing how to build its cache keys"""
+        build_key_dict = make_key_dict_builder(func, key, query_args)
+        if tags is None or callable(tags):
+            build_tag_args = None
+        else:
+            build_tag_args = make_key_dict_builder(func)
+        def wrapper(func, *args, **kwargs):
+            """Decorator wrapper"""
+            return _cached_call(func, args, kwargs, build_key_dict,
+                                build_tag_args)
+        return decorator(wrapper)(func)
+
+    def _cached_call(func, args, kwargs, build_key_dict, build_tag_args):
         pylons = get_pylons(args)
         log.debug("Wrapped with key: %s, expire: %s, type: %s, query_args: %s",
                   key, expire, type, query_args)
@@ -67,19 +148,15 @@ def beaker_cache(key="cache_default", expire="never", type=None,
             log.debug("Caching disabled, skipping cache lookup")
             return func(*args, **kwargs)
 
-        if key:
-            key_dict = kwargs.copy()
-            key_dict.update(_make_dict_from_args(func, args))
-            if query_args:
-                key_dict.update(pylons.request.GET.mixed())
-            
-            if key != "cache_default":
-                if isinstance(key, list):
-                    key_dict = dict((k, key_dict[k]) for k in key)
-                else:
-                    key_dict = {key: key_dict[key]}
+        if build_key_dict is not None:
+            key_dict = build_key_dict(args, kwargs, pylons)
         else:
             key_dict = None
+        if vary_keys:
+            key_dict = dict(key_dict or ())
+            key_dict.update(_vary_key_dict(pylons, vary_keys))
+            if vary_header:
+                _add_vary(pylons.response, vary_header)
 
         self = None
         if args:
@@ -88,47 +165,170 @@ def beaker_cache(key="cache_default", expire="never", type=None,
 
         if type:
             b_kwargs['type'] = type
+
+        if tags is not None:
+            if build_tag_args is None:
+                names = tags(*args, **kwargs)
+            else:
+                tag_args = build_tag_args(args, kwargs, pylons)
+                names = [tag % tag_args for tag in tags]
+            names = ['namespace %s' % namespace] + \
+                ['tag %s' % name for name in names]
+            generations = get_generations(_get_cache_manager(pylons), names,
+                                          **b_kwargs)
+            cache_key = _join_generations(cache_key, generations)
         
-        cache_obj = getattr(pylons.app_globals, 'cache', None)
-        if not cache_obj:
-            cache_obj = getattr(pylons, 'cache', None)
-        if not cache_obj:
-            raise Exception('No CacheMiddleware or cache object on '
-                            ' app_globals was found')
-        
-        my_cache = cache_obj.get_cache(namespace, **b_kwargs)
-            
         if expire == "never":
             cache_expire = None
         else:
             cache_expire = expire
         
-        def create_func():
-            log.debug("Creating new cache copy with key: %s, type: %s",
-                      cache_key, type)
-            result = func(*args, **kwargs)
-            glob_response = pylons.response
-            headers = glob_response.headerlist
-            status = glob_response.status
-            full_response = dict(headers=headers, status=status,
-                                 cookies=None, content=result)
-            return full_response
+        response = None
+        if local_expire:
+            try:
+                response = get_local(namespace, cache_key, type)
+            except KeyError:
+                pass
+            else:
+                cache_stats.hit(namespace, local=True)
+                if conditional:
+                    _check_conditional(pylons, response)
         
-        response = my_cache.get_value(cache_key, createfunc=create_func,
-                                      expiretime=cache_expire,
-                                      starttime=starttime)
+        if response is None:
+            cache_obj = _get_cache_manager(pylons)
+            my_cache = cache_obj.get_cache(namespace, **b_kwargs)
+            if stale_grace and cache_expire is not None:
+                content_expire = cache_expire + stale_grace
+            else:
+                content_expire = cache_expire
+            content_key = cache_key + ' content'
+            created_content = []
+            created = []
+            
+            def create_func():
+                log.debug("Creating new cache copy with key: %s, type: %s",
+                          cache_key, type)
+                start = time.time()
+                result = func(*args, **kwargs)
+                cache_stats.miss(namespace, time.time() - start,
+                                 estimate_size(result))
+                created.append(True)
+                glob_response = pylons.response
+                headers = glob_response.headerlist
+                status = glob_response.status
+                full_response = dict(headers=headers, status=status,
+                                     cookies=None, content=result,
+                                     created=time.time())
+                if compress and isinstance(result, basestring):
+                    content = result
+                    if isinstance(content, unicode):
+                        charset = glob_response.charset or 'utf-8'
+                        full_response['charset'] = charset
+                        content = content.encode(charset)
+                    full_response['content'] = gzip_body(content)
+                    full_response['gzip'] = True
+                if conditional and isinstance(result, basestring):
+                    # Keep the content apart from the rest, so
+                    # conditional requests don't load it
+                    full_response['etag'] = _content_etag(result)
+                    content = full_response.pop('content')
+                    my_cache.put(content_key, content,
+                                 expiretime=content_expire)
+                    created_content.append(content)
+                return full_response
+            
+            if stale_grace and cache_expire is not None:
+                response = get_with_grace(my_cache, cache_key, create_func,
+                                          cache_expire, stale_grace,
+                                          starttime)
+            else:
+                response = my_cache.get_value(cache_key,
+                                              createfunc=create_func,
+                                              expiretime=cache_expire,
+                                              starttime=starttime)
+            if not created:
+                cache_stats.hit(namespace)
+            if 'content' not in response:
+                if conditional:
+                    _check_conditional(pylons, response)
+                if created_content:
+                    content = created_content[0]
+                else:
+                    try:
+                        content = my_cache.get_value(content_key)
+                    except KeyError:
+                        # The content was dropped before the rest,
+                        # create both again under the creation lock
+                        response, content = _recreate_content(
+                            my_cache, cache_key, content_key, create_func,
+                            created_content, content_expire)
+                response = dict(response, content=content)
+            if local_expire:
+                put_local(namespace, cache_key, response, local_expire, type,
+                          cache_expire, response.get('created'))
         if cache_response:
             glob_response = pylons.response
             glob_response.headerlist = [header for header in response['headers']
                                         if header[0].lower() in cache_headers]
             glob_response.status = response['status']
+            if vary_header:
+                _add_vary(glob_response, vary_header)
+        if conditional and 'etag' in response:
+            glob_response = pylons.response
+            glob_response.headers['ETag'] = '"%s"' % _variant_etag(pylons,
+                                                                  response)
+            glob_response.headers['Last-Modified'] = formatdate(
+                response['created'], usegmt=True)
+        if response.get('gzip'):
+            return _gzip_content(pylons, response)
 
         return response['content']
-    return decorator(wrapper)
+    return cache_decorator
+
+def invalidate_tag(tag, type=None, **b_kwargs):
+    """Invalidate the copies cached by :func:`beaker_cache` with
+    ``tag``
+
+    ``type`` and ``b_kwargs`` are the Beaker options of the cached
+    copies.
+
+    Example::
+
+        from pylons.decorators.cache import invalidate_tag
+        invalidate_tag('product-%s' % product.id)
+
+    """
+    if type:
+        b_kwargs['type'] = type
+    new_generation(_get_cache_manager(pylons), 'tag %s' % tag, **b_kwargs)
+
+def invalidate_namespace(namespace, type=None, **b_kwargs):
+    """Invalidate the copies cached by :func:`beaker_cache` with tags in
+    ``namespace``, which is the name returned by
+    :func:`create_cache_key`, or the controller class (or module) whose
+    methods were cached
+
+    ``type`` and ``b_kwargs`` are the Beaker options of the cached
+    copies.
+
+    """
+    if not isinstance(namespace, basestring):
+        if hasattr(namespace, '__module__'):
+            namespace = '%s.%s' % (namespace.__module__, namespace.__name__)
+        else:
+            namespace = namespace.__name__
+    if type:
+        b_kwargs['type'] = type
+    new_generation(_get_cache_manager(pylons), 'namespace %s' % namespace,
+                   **b_kwargs)
 
 def create_cache_key(func, key_dict=None, self=None):
     """Get a cache namespace and key used by the beaker_cache decorator.
     
+    The key is the function name followed by the ``key_dict`` items,
+    sorted by name. Keys longer than :data:`MAX_KEY_LENGTH` have their
+    items replaced by an md5 hash of them.
+    
     Example::
         from pylons import cache
         from pylons.decorators.cache import create_cache_key
@@ -144,8 +344,7 @@ def create_cache_key(func, key_dict=None, self=None):
     else:
         cache_key = func.__name__
     if key_dict:
-        cache_key += " " + " ".join("%s=%s" % (k, v)
-                                    for k, v in key_dict.iteritems())
+        cache_key = _join_key(cache_key, key_dict)
 
     if not kls and self:
         kls = getattr(self, '__class__', None)
@@ -155,10 +354,193 @@ def create_cache_key(func, key_dict=None, self=None):
     else:
         return func.__module__, cache_key
 
-def _make_dict_from_args(func, args):
-    """Inspects function for name of args"""
-    args_keys = {}
-    for i, arg in enumerate(inspect.getargspec(func)[0]):
-        if arg != "self":
-            args_keys[arg] = args[i]
-    return args_keys
+def make_key_dict_builder(func, key="cache_default", query_args=False):
+    """Create a function building the key dict for calls to ``func``,
+    as used by the beaker_cache decorator with the ``key`` and
+    ``query_args`` options, or None if the key has no items
+    
+    The function is called with the positional and keyword arguments
+    of a call and the Pylons context (for the query args).
+    
+    """
+    if not key:
+        return None
+    argnames = [(i, name) for i, name in
+                enumerate(inspect.getargspec(func)[0]) if name != 'self']
+    if key == "cache_default":
+        keys = None
+    elif isinstance(key, list):
+        keys = key
+    else:
+        keys = [key]
+    def build_key_dict(args, kwargs, pylons):
+        key_dict = kwargs.copy()
+        for i, name in argnames:
+            key_dict[name] = args[i]
+        if query_args:
+            key_dict.update(pylons.request.GET.mixed())
+        if keys is not None:
+            key_dict = dict((k, key_dict[k]) for k in keys)
+        return key_dict
+    return build_key_dict
+
+def _content_etag(content):
+    """Return the ETag for the cached ``content``"""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return md5(content).hexdigest()
+
+def _check_conditional(pylons, response):
+    """Raise a 304 Not Modified if the request's conditional headers
+    match the cached ``response``"""
+    if 'etag' not in response:
+        return
+    environ = pylons.request.environ
+    if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+        return
+    etag = _variant_etag(pylons, response)
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is given
+        matched = if_none_match.strip() == '*' or \
+            etag in IF_NONE_MATCH.findall(if_none_match)
+    else:
+        if_modified_since = parsedate_tz(
+            environ.get('HTTP_IF_MODIFIED_SINCE', ''))
+        matched = if_modified_since is not None and \
+            int(response['created']) <= mktime_tz(if_modified_since)
+    if matched:
+        log.debug("Cached response not modified, returning 304 HTTP Not "
+                  "Modified Response")
+        glob_response = pylons.response
+        glob_response.headers['ETag'] = '"%s"' % etag
+        glob_response.headers['Last-Modified'] = formatdate(
+            response['created'], usegmt=True)
+        not_modified(glob_response)
+
+def _recreate_content(cache, key, content_key, createfunc, created_content,
+                      expire):
+    """Return the entry and content cached for ``key`` with
+    ``conditional``, creating them again unless another caller did
+    while waiting for the creation lock"""
+    lock = cache.namespace.get_creation_lock(_lock_key(key))
+    lock.acquire()
+    try:
+        try:
+            return cache.get_value(key), cache.get_value(content_key)
+        except KeyError:
+            pass
+        response = createfunc()
+        cache.put(key, response, expiretime=expire)
+        return response, created_content[0]
+    finally:
+        lock.release()
+
+def _variant_etag(pylons, response):
+    """Return the ETag of the variant of the cached ``response`` sent
+    to the client
+    
+    The gzip compressed variant of a compressed response gets its own
+    ETag, and both variants list Accept-Encoding in the Vary header.
+    
+    """
+    if not response.get('gzip'):
+        return response['etag']
+    _add_vary(pylons.response, ['Accept-Encoding'])
+    if _accepts_gzip(pylons):
+        return response['etag'] + '-gzip'
+    return response['etag']
+
+def _parse_vary(vary):
+    """Return the ``(name, kind, value)`` keys of the ``vary`` option of
+    beaker_cache, and the headers to list in the Vary header"""
+    vary_keys = []
+    vary_header = []
+    for name in vary:
+        if name == 'lang':
+            vary_keys.append(('vary lang', 'lang', None))
+            continue
+        if name.lower().startswith('cookie:'):
+            cookie = name.split(':', 1)[1].strip()
+            vary_keys.append(('vary cookie %s' % cookie, 'cookie', cookie))
+            name = 'Cookie'
+        else:
+            environ_key = 'HTTP_%s' % name.upper().replace('-', '_')
+            vary_keys.append(('vary %s' % name.lower(), 'header',
+                              environ_key))
+        if name.lower() not in [header.lower() for header in vary_header]:
+            vary_header.append(name)
+    return vary_keys, vary_header
+
+def _vary_key_dict(pylons, vary_keys):
+    """Return the key dict items of the request for the ``vary_keys``
+    made by :func:`_parse_vary`"""
+    request = pylons.request
+    key_dict = {}
+    for name, kind, value in vary_keys:
+        if kind == 'header':
+            value = ''.join(request.environ.get(value, '').lower().split())
+        elif kind == 'cookie':
+            value = request.cookies.get(value, '')
+        else:
+            value = ','.join(get_lang() or ())
+        key_dict[name] = value
+    return key_dict
+
+def _gzip_content(pylons, response):
+    """Return the gzip compressed content of the cached ``response``,
+    or decompress it when the client doesn't accept gzip"""
+    glob_response = pylons.response
+    _add_vary(glob_response, ['Accept-Encoding'])
+    if _accepts_gzip(pylons):
+        glob_response.headers['Content-Encoding'] = 'gzip'
+        return response['content']
+    content = zlib.decompress(response['content'], 16 + zlib.MAX_WBITS)
+    if 'charset' in response:
+        content = content.decode(response['charset'])
+    return content
+
+def _accepts_gzip(pylons):
+    """Return whether the client accepts gzip compressed responses"""
+    return accepts_gzip(pylons.request.environ.get('HTTP_ACCEPT_ENCODING',
+                                                   ''))
+
+def _add_vary(response, names):
+    """Add the headers ``names`` to the Vary header of ``response``"""
+    current = response.headers.get('Vary')
+    if current:
+        listed = [name.strip().lower() for name in current.split(',')]
+        names = [name for name in names if name.lower() not in listed]
+        if not names:
+            return
+        names = [current] + names
+    response.headers['Vary'] = ', '.join(names)
+
+def _get_cache_manager(pylons):
+    """Return the Beaker CacheManager of the app"""
+    cache_obj = getattr(pylons.app_globals, 'cache', None)
+    if not cache_obj:
+        cache_obj = getattr(pylons, 'cache', None)
+    if not cache_obj:
+        raise Exception('No CacheMiddleware or cache object on '
+                        ' app_globals was found')
+    return cache_obj
+
+def _join_generations(cache_key, generations):
+    """Add the ``generations`` of the namespace and tags to
+    ``cache_key``, hashing them when there are more than two tags"""
+    # One generation for the namespace, and one per tag
+    if generations.count('.') > 2:
+        generations = md5(generations).hexdigest()
+    return '%s gen=%s' % (cache_key, generations)
+
+def _join_key(name, key_dict):
+    """Join the function ``name`` and sorted ``key_dict`` items into a
+    cache key, hashing the items when it's too long"""
+    cache_key = name + " " + " ".join(["%s=%s" % (k, key_dict[k])
+                                       for k in sorted(key_dict)])
+    if len(cache_key) > MAX_KEY_LENGTH:
+        if isinstance(cache_key, unicode):
+            cache_key = cache_key.encode('utf-8')
+        cache_key = '%s %s' % (name, md5(cache_key).hexdigest())
+    return cache_key
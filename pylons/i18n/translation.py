@@ -5,10 +5,12 @@ Provides :mod:`gettext` translation functions via an app's
 translated to.
 
 """
+import copy
 import os
 from gettext import NullTranslations, translation
 
 import pylons
+from pylons.context import current_context
 
 __all__ = ['_', 'add_fallback', 'get_lang', 'gettext', 'gettext_noop',
            'lazy_gettext', 'lazy_ngettext', 'lazy_ugettext', 'lazy_ungettext',
@@ -146,9 +148,19 @@ def ungettext(singular, plural, n):
 lazy_ungettext = lazify(ungettext)
 
 
+# Translators built by _get_translator, keyed by package, localedir,
+# languages and gettext.translation keyword arguments
+_translators = {}
+
 def _get_translator(lang, **kwargs):
     """Utility method to get a valid translator object from a language
-    name"""
+    name
+    
+    Translators are built once per process and cached, each call
+    returns a copy of the cached translator (and its fallbacks) that
+    may be modified with ``add_fallback``.
+    
+    """
     if not lang:
         return NullTranslations()
     if 'pylons_config' in kwargs:
@@ -158,15 +170,54 @@ def _get_translator(lang, **kwargs):
     localedir = os.path.join(conf['pylons.paths']['root'], 'i18n')
     if not isinstance(lang, list):
         lang = [lang]
+    key = (conf['pylons.package'], localedir, tuple(lang),
+           tuple(sorted(kwargs.items())))
     try:
-        translator = translation(conf['pylons.package'], localedir,
-                                 languages=lang, **kwargs)
-    except IOError, ioe:
-        raise LanguageError('IOError: %s' % ioe)
+        translator = _translators.get(key)
+    except TypeError:
+        # Unhashable translation arguments, don't cache
+        key = translator = None
+    if translator is None:
+        try:
+            translator = translation(conf['pylons.package'], localedir,
+                                     languages=lang, **kwargs)
+        except IOError, ioe:
+            raise LanguageError('IOError: %s' % ioe)
+        if key is not None:
+            # setdefault is atomic, a translator built by another
+            # thread in the meantime wins
+            translator = _translators.setdefault(key, translator)
+    translator = _copy_translator(translator)
     translator.pylons_lang = lang
     return translator
 
 
+def _copy_translator(translator):
+    """Copy a translator along with its chain of fallbacks"""
+    translator = current = copy.copy(translator)
+    while getattr(current, '_fallback', None) is not None:
+        current._fallback = copy.copy(current._fallback)
+        current = current._fallback
+    return translator
+
+
+def _preload_translators(conf):
+    """Build and cache the translators for every language with a
+    catalog in the application's ``i18n`` directory, returning the
+    list of languages"""
+    localedir = os.path.join(conf['pylons.paths']['root'], 'i18n')
+    mofile = conf['pylons.package'] + '.mo'
+    langs = []
+    if not os.path.isdir(localedir):
+        return langs
+    for lang in sorted(os.listdir(localedir)):
+        if os.path.exists(os.path.join(localedir, lang, 'LC_MESSAGES',
+                                       mofile)):
+            _get_translator(lang, pylons_config=conf)
+            langs.append(lang)
+    return langs
+
+
 def set_lang(lang, **kwargs):
     """Set the current language used for translations.
 
@@ -176,7 +227,13 @@ def set_lang(lang, **kwargs):
     """
     translator = _get_translator(lang, **kwargs)
     environ = pylons.request.environ
-    environ['pylons.pylons'].translator = translator
+    pylons_obj = environ.get('pylons.pylons')
+    if pylons_obj is None:
+        # Streaming the response, after the request was handled; the
+        # globals resolve to the bound context
+        current_context().translator = translator
+        return
+    pylons_obj.translator = translator
     if 'paste.registry' in environ:
         environ['paste.registry'].replace(pylons.translator, translator)
 
@@ -1,7 +1,14 @@
 """Pylons' WSGI middlewares"""
 import logging
 import os.path
+import random
+import re
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
+from beaker.cache import CacheManager
 from paste.deploy.converters import asbool
 from paste.urlparser import StaticURLParser
 from weberror.evalexception import EvalException
@@ -13,8 +20,9 @@ import pylons
 from pylons.error import template_error_formatters
 from pylons.util import call_wsgi_application
 
-__all__ = ['ErrorHandler', 'StaticJavascripts', 'error_document_template',
-           'footer_html', 'head_html', 'media_path']
+__all__ = ['ErrorHandler', 'PageCacheMiddleware', 'StaticJavascripts',
+           'error_document_template', 'footer_html', 'head_html',
+           'media_path']
 
 log = logging.getLogger(__name__)
 
@@ -165,6 +173,221 @@ class StatusCodeRedirect(object):
         return app_iter
 
 
+class PageCacheMiddleware(object):
+    """Caches full responses to anonymous GET requests
+    
+    PageCacheMiddleware serves the responses it cached straight from
+    the cache, as the status, header list and body the app returned,
+    without calling the app it wraps. Placed outside of the
+    RegistryManager, a cache hit builds none of the Pylons objects::
+    
+        app = RegistryManager(app)
+        app = PageCacheMiddleware(app, rules=[('/$', 60), ('/news/', 10)])
+    
+    Only GET (and HEAD) requests without an Authorization header or
+    any of the ``bypass_cookies`` are served from the cache, and only
+    their ``200 OK`` responses are cached, unless they set cookies or
+    have a ``private``, ``no-cache`` or ``no-store`` Cache-Control.
+    An app can also keep a response out of the cache by setting
+    ``environ['pylons.page_cache.bypass'] = True``.
+    
+    Responses with a Vary header are cached per value of the request
+    headers it names (compared ignoring case and whitespace), and
+    aren't cached at all for ``Vary: *``. Responses with a
+    Content-Encoding are only cached when Accept-Encoding is listed in
+    their Vary header, so a compressed page isn't sent to clients that
+    don't accept it.
+    
+    The middleware is available as ``environ['pylons.page_cache']``,
+    for the app to :meth:`invalidate` pages when their content
+    changes.
+    
+    """
+    def __init__(self, app, rules=None, expire=60, cache_manager=None,
+                 bypass_cookies=('beaker.session.id',), vary_host=False,
+                 namespace='pylons.page_cache', type='memory', **b_kwargs):
+        """Initialize the PageCacheMiddleware
+        
+        ``rules``
+            A sequence of ``(pattern, expire)`` pairs. Pages are cached
+            for the ``expire`` time (in seconds) of the first pattern
+            (a regular expression) matching the start of their path,
+            or not at all when it's None or no pattern matches.
+            Defaults to None, which caches all the pages.
+        ``expire``
+            Time in seconds to cache pages for without ``rules``.
+        ``cache_manager``
+            The Beaker CacheManager to store pages with, by default one
+            created with ``type`` and the other Beaker options in
+            ``b_kwargs``. The ``memory`` type doesn't need to unpickle
+            the pages.
+        ``bypass_cookies``
+            Names of the cookies whose requests aren't served from the
+            cache, by default Beaker's session cookie.
+        ``vary_host``
+            Whether the page depends on the Host of the request, for
+            apps serving several sites.
+        ``namespace``
+            The Beaker namespace the pages are stored in.
+        
+        """
+        self.app = app
+        if rules is None:
+            rules = [('', expire)]
+        self.rules = [(re.compile(pattern), expire)
+                      for pattern, expire in rules]
+        if cache_manager is None:
+            cache_manager = CacheManager(type=type, **b_kwargs)
+        self.cache = cache_manager.get_cache(namespace, **b_kwargs)
+        self.bypass_cookies = tuple(bypass_cookies)
+        self.vary_host = vary_host
+    
+    def __call__(self, environ, start_response):
+        environ['pylons.page_cache'] = self
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD') or self._bypass(environ):
+            return self.app(environ, start_response)
+        expire = self._get_expire(environ.get('PATH_INFO', ''))
+        if expire is None:
+            return self.app(environ, start_response)
+        
+        key = self._make_key(environ.get('SCRIPT_NAME', ''),
+                             environ.get('PATH_INFO', ''),
+                             environ.get('QUERY_STRING', ''),
+                             environ.get('HTTP_HOST'))
+        page = self._get(key)
+        variants = None
+        if page is not None and page[0] is None:
+            # The page varies on request headers, get the variant of
+            # this request
+            variants = page
+            page = self._get(self._make_variant_key(key, variants, environ))
+        if page is not None:
+            status, headers, body = page
+            start_response(status, headers)
+            if method == 'HEAD':
+                return []
+            return [body]
+        
+        if method == 'HEAD':
+            return self.app(environ, start_response)
+        status, headers, app_iter, exc_info = call_wsgi_application(
+            self.app, environ, catch_exc_info=True)
+        if exc_info is None and status[:3] == '200' and \
+            not environ.get('pylons.page_cache.bypass') and \
+            self._cacheable(headers):
+            try:
+                body = ''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            vary = self._get_vary(headers)
+            if vary:
+                if variants is None or variants[1] != vary:
+                    # A new token, so variants cached before the page
+                    # was invalidated aren't used
+                    variants = (None, vary, '%x' % random.getrandbits(32))
+                self.cache.put(key, variants, expiretime=expire)
+                self.cache.put(self._make_variant_key(key, variants, environ),
+                               (status, headers, body), expiretime=expire)
+            else:
+                self.cache.put(key, (status, headers, body),
+                               expiretime=expire)
+            app_iter = [body]
+        start_response(status, headers, exc_info)
+        return app_iter
+    
+    def invalidate(self, path, query_string='', host=None,
+                   script_name=''):
+        """Remove the cached page for ``path`` (and ``query_string``,
+        and ``host`` with ``vary_host``), including all its variants"""
+        self.cache.remove_value(self._make_key(script_name, path,
+                                               query_string, host))
+    
+    def clear(self):
+        """Remove all the cached pages
+        
+        .. note::
+            With memcached, this flushes the whole server.
+        
+        """
+        self.cache.clear()
+    
+    def _get(self, key):
+        try:
+            return self.cache.get_value(key)
+        except KeyError:
+            return None
+    
+    def _bypass(self, environ):
+        if 'HTTP_AUTHORIZATION' in environ:
+            return True
+        cookie = environ.get('HTTP_COOKIE')
+        if cookie:
+            names = [item.split('=', 1)[0].strip()
+                     for item in cookie.split(';')]
+            for name in self.bypass_cookies:
+                if name in names:
+                    return True
+        return False
+    
+    def _get_expire(self, path):
+        for pattern, expire in self.rules:
+            if pattern.match(path):
+                return expire
+        return None
+    
+    def _make_key(self, script_name, path, query_string, host):
+        key = script_name + path
+        if query_string:
+            key += '?' + query_string
+        if self.vary_host:
+            key = '%s %s' % (host, key)
+        if len(key) > 200:
+            key = md5(key).hexdigest()
+        return key
+    
+    def _make_variant_key(self, key, variants, environ):
+        """Return the key of the variant of the page cached under
+        ``key`` for the request headers named by ``variants``"""
+        values = []
+        for name in variants[1]:
+            value = environ.get('HTTP_%s' % name.upper().replace('-', '_'),
+                                '')
+            values.append(''.join(value.lower().split()))
+        return '%s %s %s' % (key, variants[2],
+                             md5('\n'.join(values)).hexdigest())
+    
+    def _get_vary(self, headers):
+        """Return the sorted, lowercased names of the headers listed in
+        the Vary header of the response"""
+        vary = set()
+        for name, value in headers:
+            if name.lower() == 'vary':
+                vary.update([item.strip().lower()
+                             for item in value.split(',') if item.strip()])
+        return sorted(vary)
+    
+    def _cacheable(self, headers):
+        vary = self._get_vary(headers)
+        if '*' in vary:
+            return False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+            if name == 'cache-control':
+                value = value.lower()
+                for directive in ('private', 'no-cache', 'no-store'):
+                    if directive in value:
+                        return False
+            if name == 'content-encoding' and \
+               value.strip().lower() != 'identity' and \
+               'accept-encoding' not in vary:
+                return False
+        return True
+
+
 error_document_template = literal("""\
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
 <html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
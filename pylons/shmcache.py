@@ -0,0 +1,593 @@
+"""Shared memory Beaker cache backend
+
+Beaker's ``memory`` backend keeps a copy of the cache in each process,
+so the workers of a prefork server each have their own. The ``shm``
+backend defined here keeps the cache in a file mapped into the memory
+of every process using it (see :class:`SharedSegment`), so the
+processes on a host share one cache without a network round trip.
+
+Importing :mod:`pylons.caching` registers the backend with Beaker. Use
+it by setting the cache type to ``shm``, as with the ``type`` argument
+of :func:`~pylons.decorators.cache.beaker_cache`, or for the whole
+app in the config file::
+
+    cache_dir = %(here)s/data
+    beaker.cache.type = shm
+    beaker.cache.shm_file = /dev/shm/myapp-cache
+    beaker.cache.shm_size = 67108864
+
+A file on a memory backed file system, like ``/dev/shm`` on Linux, is
+best. Without ``shm_file``, the file is created in the ``data_dir``.
+
+"""
+import cPickle as pickle
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from beaker import util
+from beaker.container import NamespaceManager
+from beaker.exceptions import MissingCacheParameter
+from beaker.synchronization import NameLock, file_synchronizer
+
+__all__ = ['SharedMemoryNamespaceManager', 'SharedSegment', 'get_segment']
+
+log = logging.getLogger(__name__)
+
+MAGIC = 'PYSHM002'
+
+# Header: magic, buckets, slots, page size, pages, pages used, first
+# free slot, next page to move to another class
+HEADER_FORMAT = '<8sqqqqqqq'
+HEADER_SIZE = 64
+PAGES_USED_OFFSET = 40
+FREE_SLOT_OFFSET = 48
+MOVE_PAGE_OFFSET = 56
+
+# Size classes: chunk size, first free chunk, most and least recently
+# used slots
+CLASS_FORMAT = '<qqqq'
+CLASS_SIZE = 32
+MAX_CLASSES = 64
+CLASSES_OFFSET = HEADER_SIZE
+BUCKETS_OFFSET = CLASSES_OFFSET + MAX_CLASSES * CLASS_SIZE
+
+# Slots: next slot in the bucket, previous and next slots in the LRU
+# list of the class, chunk, class, key length, value length, key hash
+SLOT_FORMAT = '<qqqqiiiI'
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+NEXT, LRU_PREV, LRU_NEXT, CHUNK, CLASS, KEY_LEN, VALUE_LEN, HASH = range(8)
+
+MIN_CHUNK_SIZE = 64
+CHUNK_GROWTH = 1.25
+
+def chunk_sizes(page_size):
+    """Return the chunk sizes of the size classes for ``page_size``"""
+    sizes = []
+    size = MIN_CHUNK_SIZE
+    while size < page_size:
+        sizes.append(size)
+        size = (int(size * CHUNK_GROWTH) + 7) & ~7
+    sizes.append(page_size)
+    return sizes
+
+
+class SharedSegment(object):
+    """Hash table of byte strings in a memory mapped file, shared by
+    the processes mapping it
+
+    The file holds a header, the size classes, the hash buckets, the
+    slots (one per entry), the class of each page and the pages
+    holding the entries. As in memcached, each entry is stored in a
+    chunk of the smallest size class that fits it. Pages are divided
+    into the chunks of a class when the class needs more. When a class
+    has no free chunk and no page is left, or all the slots are used,
+    its least recently used entry is evicted. A class without entries
+    to evict takes a page from another class instead (the pages are
+    taken in turn), evicting the entries on it. Entries larger than a
+    page aren't stored.
+
+    Every operation holds a lock on the file, and a thread lock.
+
+    ``size``
+        Size of the file in bytes.
+    ``slots``
+        Maximum number of entries.
+    ``page_size``
+        Size in bytes of the pages, and so of the largest entry.
+
+    A file already initialized by another process keeps its size.
+
+    """
+    def __init__(self, path, size=64 * 1024 * 1024, slots=65536,
+                 page_size=1024 * 1024):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._acquire()
+        try:
+            self._map = None
+            if not self._open():
+                self._initialize(size, slots, page_size)
+        finally:
+            self._release()
+
+    def get(self, key):
+        """Return the value stored under ``key``, or None"""
+        h = zlib.crc32(key) & 0xffffffff
+        self._acquire()
+        try:
+            i, prev, slot = self._find(key, h)
+            if i == -1:
+                return None
+            cls = slot[CLASS]
+            if self._get_class(cls)[2] != i:
+                self._lru_unlink(slot)
+                self._lru_push(i, slot)
+                self._set_slot(i, slot)
+            start = slot[CHUNK] + slot[KEY_LEN]
+            return self._map[start:start + slot[VALUE_LEN]]
+        finally:
+            self._release()
+
+    def __contains__(self, key):
+        h = zlib.crc32(key) & 0xffffffff
+        self._acquire()
+        try:
+            return self._find(key, h)[0] != -1
+        finally:
+            self._release()
+
+    def put(self, key, value):
+        """Store ``value`` under ``key``, returning whether it was
+        stored (or too large)"""
+        h = zlib.crc32(key) & 0xffffffff
+        size = len(key) + len(value)
+        self._acquire()
+        try:
+            i, prev, slot = self._find(key, h)
+            if i != -1:
+                self._unlink(i, prev, slot)
+            cls = self._class_for(size)
+            if cls is None:
+                log.debug("Not storing %r, %d bytes don't fit a page", key,
+                          size)
+                return False
+            chunk = self._alloc_chunk(cls)
+            if chunk is None:
+                return False
+            i = self._alloc_slot(cls)
+            self._map[chunk:chunk + size] = key + value
+            bucket = BUCKETS_OFFSET + (h % self.buckets) * 8
+            slot = [self._getq(bucket), -1, -1, chunk, cls, len(key),
+                    len(value), h]
+            self._lru_push(i, slot)
+            self._set_slot(i, slot)
+            self._setq(bucket, i)
+            return True
+        finally:
+            self._release()
+
+    def delete(self, key):
+        """Remove the entry stored under ``key``, returning whether
+        there was one"""
+        h = zlib.crc32(key) & 0xffffffff
+        self._acquire()
+        try:
+            i, prev, slot = self._find(key, h)
+            if i == -1:
+                return False
+            self._unlink(i, prev, slot)
+            return True
+        finally:
+            self._release()
+
+    def keys(self, prefix=''):
+        """Return the keys starting with ``prefix``"""
+        self._acquire()
+        try:
+            return [key for i, key in self._iter_keys()
+                    if key.startswith(prefix)]
+        finally:
+            self._release()
+
+    def delete_prefix(self, prefix):
+        """Remove the entries whose keys start with ``prefix``"""
+        self._acquire()
+        try:
+            for i, key in self._iter_keys():
+                if key.startswith(prefix):
+                    h = zlib.crc32(key) & 0xffffffff
+                    self._unlink(*self._find(key, h))
+        finally:
+            self._release()
+
+    def close(self):
+        """Unmap and close the file"""
+        self._map.close()
+        os.close(self._fd)
+
+    def _acquire(self):
+        self._lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        except:
+            self._lock.release()
+            raise
+
+    def _release(self):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def _open(self):
+        """Map an initialized file, returning whether it was"""
+        file_size = os.fstat(self._fd).st_size
+        if file_size < HEADER_SIZE:
+            return False
+        os.lseek(self._fd, 0, 0)
+        header = struct.unpack(HEADER_FORMAT, os.read(
+            self._fd, struct.calcsize(HEADER_FORMAT)))
+        if header[0] != MAGIC:
+            return False
+        self._set_geometry(*header[1:5])
+        if file_size < self.size:
+            return False
+        self._map = mmap.mmap(self._fd, self.size)
+        return True
+
+    def _initialize(self, size, slots, page_size):
+        if self._map is not None:
+            self._map.close()
+        buckets = slots
+        page_table_offset = BUCKETS_OFFSET + buckets * 8 + slots * SLOT_SIZE
+        pages = (size - page_table_offset) // page_size
+        while pages > 0 and ((page_table_offset + pages * 8 + 4095) &
+                             ~4095) + pages * page_size > size:
+            pages -= 1
+        if pages < 1:
+            raise ValueError("Shared memory cache size %d is too small for "
+                             "%d slots and %d byte pages" %
+                             (size, slots, page_size))
+        self._set_geometry(buckets, slots, page_size, pages)
+        log.debug("Initializing shared memory cache %s of %d bytes",
+                  self.path, self.size)
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, self.size)
+        self._map = mmap.mmap(self._fd, self.size)
+        m = self._map
+        m[:HEADER_SIZE] = struct.pack(HEADER_FORMAT, MAGIC, buckets, slots,
+                                      page_size, pages, 0, 0, 0)
+        for cls, chunk_size in enumerate(self.chunk_sizes):
+            self._set_class(cls, [chunk_size, -1, -1, -1])
+        m[BUCKETS_OFFSET:self.slots_offset] = '\xff' * (buckets * 8)
+        free_slots = [struct.pack(SLOT_FORMAT, i + 1, -1, -1, -1, 0, 0, 0, 0)
+                      for i in xrange(slots - 1)]
+        free_slots.append(struct.pack(SLOT_FORMAT, -1, -1, -1, -1, 0, 0, 0,
+                                      0))
+        m[self.slots_offset:self.slots_offset + slots * SLOT_SIZE] = \
+            ''.join(free_slots)
+        m[self.page_table_offset:self.page_table_offset + pages * 8] = \
+            '\xff' * (pages * 8)
+
+    def _set_geometry(self, buckets, slots, page_size, pages):
+        self.buckets = buckets
+        self.slots = slots
+        self.page_size = page_size
+        self.pages = pages
+        self.chunk_sizes = chunk_sizes(page_size)
+        if len(self.chunk_sizes) > MAX_CLASSES:
+            raise ValueError("Shared memory cache page size %d is too large" %
+                             page_size)
+        self.slots_offset = BUCKETS_OFFSET + buckets * 8
+        self.page_table_offset = self.slots_offset + slots * SLOT_SIZE
+        self.pages_offset = (self.page_table_offset + pages * 8 +
+                             4095) & ~4095
+        self.size = self.pages_offset + pages * page_size
+
+    def _getq(self, offset):
+        return struct.unpack('<q', self._map[offset:offset + 8])[0]
+
+    def _setq(self, offset, value):
+        self._map[offset:offset + 8] = struct.pack('<q', value)
+
+    def _get_slot(self, i):
+        offset = self.slots_offset + i * SLOT_SIZE
+        return list(struct.unpack(SLOT_FORMAT,
+                                  self._map[offset:offset + SLOT_SIZE]))
+
+    def _set_slot(self, i, slot):
+        offset = self.slots_offset + i * SLOT_SIZE
+        self._map[offset:offset + SLOT_SIZE] = struct.pack(SLOT_FORMAT,
+                                                           *slot)
+
+    def _get_class(self, cls):
+        offset = CLASSES_OFFSET + cls * CLASS_SIZE
+        return list(struct.unpack(CLASS_FORMAT,
+                                  self._map[offset:offset + CLASS_SIZE]))
+
+    def _set_class(self, cls, entry):
+        offset = CLASSES_OFFSET + cls * CLASS_SIZE
+        self._map[offset:offset + CLASS_SIZE] = struct.pack(CLASS_FORMAT,
+                                                            *entry)
+
+    def _class_for(self, size):
+        for cls, chunk_size in enumerate(self.chunk_sizes):
+            if size <= chunk_size:
+                return cls
+        return None
+
+    def _find(self, key, h):
+        """Return the slot number of ``key``, of the previous slot in its
+        bucket, and the slot; or -1 when missing"""
+        m = self._map
+        prev = -1
+        i = self._getq(BUCKETS_OFFSET + (h % self.buckets) * 8)
+        while i != -1:
+            slot = self._get_slot(i)
+            if slot[HASH] == h and slot[KEY_LEN] == len(key):
+                chunk = slot[CHUNK]
+                if m[chunk:chunk + len(key)] == key:
+                    return i, prev, slot
+            prev = i
+            i = slot[NEXT]
+        return -1, -1, None
+
+    def _iter_keys(self):
+        m = self._map
+        for i in xrange(self.slots):
+            slot = self._get_slot(i)
+            if slot[CHUNK] != -1:
+                chunk = slot[CHUNK]
+                yield i, m[chunk:chunk + slot[KEY_LEN]]
+
+    def _unlink(self, i, prev, slot):
+        """Remove slot ``i``, freeing its chunk and itself"""
+        if prev == -1:
+            bucket = BUCKETS_OFFSET + (slot[HASH] % self.buckets) * 8
+            self._setq(bucket, slot[NEXT])
+        else:
+            prev_slot = self._get_slot(prev)
+            prev_slot[NEXT] = slot[NEXT]
+            self._set_slot(prev, prev_slot)
+        self._lru_unlink(slot)
+        entry = self._get_class(slot[CLASS])
+        self._setq(slot[CHUNK], entry[1])
+        entry[1] = slot[CHUNK]
+        self._set_class(slot[CLASS], entry)
+        self._set_slot(i, [self._getq(FREE_SLOT_OFFSET), -1, -1, -1, 0, 0,
+                           0, 0])
+        self._setq(FREE_SLOT_OFFSET, i)
+
+    def _lru_unlink(self, slot):
+        cls = slot[CLASS]
+        prev, next = slot[LRU_PREV], slot[LRU_NEXT]
+        entry = self._get_class(cls)
+        if prev == -1:
+            entry[2] = next
+        else:
+            prev_slot = self._get_slot(prev)
+            prev_slot[LRU_NEXT] = next
+            self._set_slot(prev, prev_slot)
+        if next == -1:
+            entry[3] = prev
+        else:
+            next_slot = self._get_slot(next)
+            next_slot[LRU_PREV] = prev
+            self._set_slot(next, next_slot)
+        self._set_class(cls, entry)
+
+    def _lru_push(self, i, slot):
+        """Make slot ``i`` (not written yet) the most recently used of
+        its class"""
+        cls = slot[CLASS]
+        entry = self._get_class(cls)
+        head = entry[2]
+        slot[LRU_PREV] = -1
+        slot[LRU_NEXT] = head
+        if head == -1:
+            entry[3] = i
+        else:
+            head_slot = self._get_slot(head)
+            head_slot[LRU_PREV] = i
+            self._set_slot(head, head_slot)
+        entry[2] = i
+        self._set_class(cls, entry)
+
+    def _evict(self, cls):
+        """Evict the least recently used entry of ``cls``, returning
+        whether there was one"""
+        i = self._get_class(cls)[3]
+        if i == -1:
+            return False
+        slot = self._get_slot(i)
+        chunk = slot[CHUNK]
+        key = self._map[chunk:chunk + slot[KEY_LEN]]
+        self._unlink(*self._find(key, slot[HASH]))
+        return True
+
+    def _alloc_chunk(self, cls):
+        entry = self._get_class(cls)
+        if entry[1] == -1:
+            pages_used = self._getq(PAGES_USED_OFFSET)
+            if pages_used < self.pages:
+                self._setq(PAGES_USED_OFFSET, pages_used + 1)
+                self._carve_page(cls, entry, pages_used)
+            elif not self._evict(cls) and not self._move_page(cls):
+                return None
+            entry = self._get_class(cls)
+        chunk = entry[1]
+        entry[1] = self._getq(chunk)
+        self._set_class(cls, entry)
+        return chunk
+
+    def _carve_page(self, cls, entry, page):
+        """Divide ``page`` into free chunks of ``cls``"""
+        chunk_size = entry[0]
+        start = self.pages_offset + page * self.page_size
+        chunks = range(start, start + self.page_size - chunk_size + 1,
+                       chunk_size)
+        next = entry[1]
+        for chunk in reversed(chunks):
+            self._setq(chunk, next)
+            next = chunk
+        entry[1] = next
+        self._set_class(cls, entry)
+        self._setq(self.page_table_offset + page * 8, cls)
+
+    def _move_page(self, cls):
+        """Take the next page of another class for ``cls``, evicting
+        the entries on it, returning whether there was one"""
+        page = self._getq(MOVE_PAGE_OFFSET)
+        for page in range(page, self.pages) + range(page):
+            owner = self._getq(self.page_table_offset + page * 8)
+            if owner != cls:
+                break
+        else:
+            return False
+        self._setq(MOVE_PAGE_OFFSET, (page + 1) % self.pages)
+        log.debug("Moving shared memory cache page %d from class %d to %d",
+                  page, owner, cls)
+        start = self.pages_offset + page * self.page_size
+        end = start + self.page_size
+        m = self._map
+        for i in xrange(self.slots):
+            slot = self._get_slot(i)
+            chunk = slot[CHUNK]
+            if start <= chunk < end:
+                key = m[chunk:chunk + slot[KEY_LEN]]
+                self._unlink(*self._find(key, slot[HASH]))
+        # Drop the chunks of the page from the free list of its class
+        entry = self._get_class(owner)
+        chunks = []
+        chunk = entry[1]
+        while chunk != -1:
+            if not start <= chunk < end:
+                chunks.append(chunk)
+            chunk = self._getq(chunk)
+        next = -1
+        for chunk in reversed(chunks):
+            self._setq(chunk, next)
+            next = chunk
+        entry[1] = next
+        self._set_class(owner, entry)
+        self._carve_page(cls, self._get_class(cls), page)
+        return True
+
+    def _alloc_slot(self, cls):
+        i = self._getq(FREE_SLOT_OFFSET)
+        if i == -1:
+            if not self._evict(cls):
+                for other in range(len(self.chunk_sizes)):
+                    if self._evict(other):
+                        break
+            i = self._getq(FREE_SLOT_OFFSET)
+        self._setq(FREE_SLOT_OFFSET, self._get_slot(i)[NEXT])
+        return i
+
+
+_segments = {}
+_segments_lock = threading.Lock()
+
+def get_segment(path, size=64 * 1024 * 1024, slots=65536,
+                page_size=1024 * 1024):
+    """Return the :class:`SharedSegment` of the file ``path``, shared by
+    the users of the file in this process"""
+    path = os.path.abspath(path)
+    _segments_lock.acquire()
+    try:
+        segment = _segments.get(path)
+        if segment is None:
+            segment = _segments[path] = SharedSegment(path, size, slots,
+                                                      page_size)
+        return segment
+    finally:
+        _segments_lock.release()
+
+
+class SharedMemoryNamespaceManager(NamespaceManager):
+    """Beaker NamespaceManager storing the cache in a
+    :class:`SharedSegment`
+
+    ``shm_file``
+        Path of the file holding the cache, defaults to one in the
+        ``data_dir``.
+    ``shm_size``, ``shm_slots``, ``shm_page_size``
+        The ``size``, ``slots`` and ``page_size`` of the
+        :class:`SharedSegment`.
+    ``lock_dir``
+        Directory of the creation lock files, defaults to one in the
+        ``data_dir``. Without either, creation locks only work within
+        a process.
+
+    """
+    def __init__(self, namespace, shm_file=None, shm_size=None,
+                 shm_slots=None, shm_page_size=None, data_dir=None,
+                 lock_dir=None, **kwargs):
+        NamespaceManager.__init__(self, namespace)
+        if not shm_file:
+            if not data_dir:
+                raise MissingCacheParameter("shm_file or data_dir is "
+                                            "required")
+            util.verify_directory(data_dir + "/container_shm")
+            shm_file = data_dir + "/container_shm/cache.shm"
+        if not lock_dir and data_dir:
+            lock_dir = data_dir + "/container_shm_lock"
+        if lock_dir:
+            util.verify_directory(lock_dir)
+        self.lock_dir = lock_dir
+        self.segment = get_segment(shm_file,
+                                   int(shm_size or 64 * 1024 * 1024),
+                                   int(shm_slots or 65536),
+                                   int(shm_page_size or 1024 * 1024))
+        namespace = self.namespace
+        if isinstance(namespace, unicode):
+            namespace = namespace.encode('utf-8')
+        self.prefix = namespace + '\0'
+
+    def get_creation_lock(self, key):
+        if self.lock_dir:
+            return file_synchronizer(
+                identifier="shmcontainer/funclock/%s/%s" % (self.namespace,
+                                                            key),
+                lock_dir=self.lock_dir)
+        return NameLock(
+            identifier="shmcontainer/funclock/%s/%s" % (self.namespace, key),
+            reentrant=True)
+
+    def _key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return self.prefix + key
+
+    def __getitem__(self, key):
+        value = self.segment.get(self._key(key))
+        if value is None:
+            raise KeyError(key)
+        return pickle.loads(value)
+
+    def __contains__(self, key):
+        return self._key(key) in self.segment
+
+    def has_key(self, key):
+        return self._key(key) in self.segment
+
+    def __setitem__(self, key, value):
+        self.segment.put(self._key(key),
+                         pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def __delitem__(self, key):
+        if not self.segment.delete(self._key(key)):
+            raise KeyError(key)
+
+    def do_remove(self):
+        self.segment.delete_prefix(self.prefix)
+
+    def keys(self):
+        return [key[len(self.prefix):]
+                for key in self.segment.keys(self.prefix)]
@@ -102,10 +102,13 @@ template engine, and are used by the render functions.
 
 """
 import logging
+import time
 
 from webhelpers.html import literal
 
 import pylons
+from pylons.caching import cache_stats, estimate_size, get_local, \
+    get_with_grace, put_local
 
 __all__ = ['render_genshi', 'render_jinja2', 'render_mako', 'render_response']
 
@@ -159,7 +162,7 @@ def pylons_globals():
 
 def cached_template(template_name, render_func, ns_options=(),
                     cache_key=None, cache_type=None, cache_expire=None,
-                    **kwargs):
+                    local_expire=None, stale_grace=None, **kwargs):
     """Cache and render a template
     
     Cache a template to the namespace ``template_name``, along with a
@@ -191,6 +194,16 @@ def cached_template(template_name, render_func, ns_options=(),
         Time in seconds to cache this template with this ``cache_key``
         for. Or use 'never' to designate that the cache should never
         expire.
+    ``local_expire``
+        Time in seconds to also keep the rendered template in the
+        per-process :data:`~pylons.caching.local_cache`, which is
+        checked before Beaker. The local copy is kept for no longer
+        than ``cache_expire`` from when it was rendered (with
+        ``stale_grace``) or fetched.
+    ``stale_grace``
+        Time in seconds to keep serving the cached template for after
+        it expires, while a single caller renders it again. Requires
+        a ``cache_expire`` time.
     
     The minimum key required to trigger caching is
     ``cache_expire='never'`` which will cache the template forever
@@ -210,20 +223,52 @@ def cached_template(template_name, render_func, ns_options=(),
         namespace = template_name
         for name in ns_options:
             namespace += str(kwargs.get(name))
+        if local_expire:
+            try:
+                content = get_local(namespace, cache_key, cache_type)
+            except KeyError:
+                pass
+            else:
+                cache_stats.hit(namespace, local=True)
+                return content
         cache = pylons.cache.get_cache(namespace, type=cache_type)
-        content = cache.get_value(cache_key, createfunc=render_func, 
-            expiretime=cache_expire)
+        created = []
+        def render():
+            start = time.time()
+            content = render_func()
+            cache_stats.miss(namespace, time.time() - start,
+                             estimate_size(content))
+            created.append(True)
+            return content
+        created_at = None
+        if stale_grace and cache_expire is not None:
+            def create_func():
+                return dict(content=render(), created=time.time())
+            entry = get_with_grace(cache, cache_key, create_func,
+                                   cache_expire, stale_grace)
+            content = entry['content']
+            created_at = entry['created']
+        else:
+            content = cache.get_value(cache_key, createfunc=render, 
+                expiretime=cache_expire)
+        if not created:
+            cache_stats.hit(namespace)
+        if local_expire:
+            put_local(namespace, cache_key, content, local_expire,
+                      cache_type, cache_expire, created_at)
         return content
     else:
         return render_func()
 
 
 def render_mako(template_name, extra_vars=None, cache_key=None, 
-                cache_type=None, cache_expire=None):
+                cache_type=None, cache_expire=None, local_expire=None,
+                stale_grace=None):
     """Render a template with Mako
     
-    Accepts the cache options ``cache_key``, ``cache_type``, and
-    ``cache_expire``.
+    Accepts the cache options ``cache_key``, ``cache_type``,
+    ``cache_expire``, ``local_expire`` and ``stale_grace`` (see
+    :func:`cached_template`).
     
     """    
     # Create a render callable for the cache function
@@ -240,11 +285,13 @@ def render_mako(template_name, extra_vars=None, cache_key=None,
         return literal(template.render_unicode(**globs))
     
     return cached_template(template_name, render_template, cache_key=cache_key,
-                           cache_type=cache_type, cache_expire=cache_expire)
+                           cache_type=cache_type, cache_expire=cache_expire,
+                           local_expire=local_expire, stale_grace=stale_grace)
 
 
 def render_mako_def(template_name, def_name, cache_key=None,
-                    cache_type=None, cache_expire=None, **kwargs):
+                    cache_type=None, cache_expire=None, local_expire=None,
+                    stale_grace=None, **kwargs):
     """Render a def block within a Mako template
     
     Takes the template name, and the name of the def within it to call.
@@ -257,8 +304,9 @@ def render_mako_def(template_name, def_name, cache_key=None,
         # with a title argument
         render_mako_def('layout.mako', 'header', title='Testing')
     
-    Also accepts the cache options ``cache_key``, ``cache_type``, and
-    ``cache_expire``.
+    Also accepts the cache options ``cache_key``, ``cache_type``,
+    ``cache_expire``, ``local_expire`` and ``stale_grace`` (see
+    :func:`cached_template`).
     
     """
     # Create a render callable for the cache function
@@ -276,16 +324,19 @@ def render_mako_def(template_name, def_name, cache_key=None,
         return literal(template.render_unicode(**globs))
     
     return cached_template(template_name, render_template, cache_key=cache_key,
-                           cache_type=cache_type, cache_expire=cache_expire)
+                           cache_type=cache_type, cache_expire=cache_expire,
+                           local_expire=local_expire, stale_grace=stale_grace)
 
 
 def render_genshi(template_name, extra_vars=None, cache_key=None, 
-                  cache_type=None, cache_expire=None, method='xhtml'):
+                  cache_type=None, cache_expire=None, method='xhtml',
+                  local_expire=None, stale_grace=None):
     """Render a template with Genshi
     
-    Accepts the cache options ``cache_key``, ``cache_type``, and
-    ``cache_expire`` in addition to method which are passed to Genshi's
-    render function.
+    Accepts the cache options ``cache_key``, ``cache_type``,
+    ``cache_expire``, ``local_expire`` and ``stale_grace`` (see
+    :func:`cached_template`) in addition to method which are passed to
+    Genshi's render function.
     
     """
     # Create a render callable for the cache function
@@ -304,15 +355,18 @@ def render_genshi(template_name, extra_vars=None, cache_key=None,
     
     return cached_template(template_name, render_template, cache_key=cache_key,
                            cache_type=cache_type, cache_expire=cache_expire,
+                           local_expire=local_expire, stale_grace=stale_grace,
                            ns_options=('method'), method=method)
 
 
 def render_jinja2(template_name, extra_vars=None, cache_key=None, 
-                 cache_type=None, cache_expire=None):
+                 cache_type=None, cache_expire=None, local_expire=None,
+                 stale_grace=None):
     """Render a template with Jinja2
 
-    Accepts the cache options ``cache_key``, ``cache_type``, and
-    ``cache_expire``.
+    Accepts the cache options ``cache_key``, ``cache_type``,
+    ``cache_expire``, ``local_expire`` and ``stale_grace`` (see
+    :func:`cached_template`).
 
     """    
     # Create a render callable for the cache function
@@ -330,4 +384,5 @@ def render_jinja2(template_name, extra_vars=None, cache_key=None,
         return literal(template.render(**globs))
 
     return cached_template(template_name, render_template, cache_key=cache_key,
-                           cache_type=cache_type, cache_expire=cache_expire)
+                           cache_type=cache_type, cache_expire=cache_expire,
+                           local_expire=local_expire, stale_grace=stale_grace)
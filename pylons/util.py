@@ -96,8 +96,21 @@ class PylonsContext(object):
                 pyobj = self._py_object
                 return "Environ is %s" % pyobj.request.environ
     
+    Attributes that aren't needed by every request may be set up with
+    :meth:`set_lazy`, they are then only created when first accessed.
+    
     """
-    pass
+    def set_lazy(self, name, factory):
+        """Create the attribute ``name`` by calling ``factory`` when
+        it's first accessed (unless it has been set already)"""
+        self.__dict__.setdefault('_lazy_attrs', {})[name] = factory
+
+    def __getattr__(self, name):
+        lazy_attrs = self.__dict__.get('_lazy_attrs')
+        if lazy_attrs is None or name not in lazy_attrs:
+            raise AttributeError(name)
+        value = self.__dict__[name] = lazy_attrs.pop(name)()
+        return value
 
 
 class ContextObj(object):
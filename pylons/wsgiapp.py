@@ -7,23 +7,33 @@ well.
 
 """
 import logging
+import os
 import sys
+import threading
+import time
 
 import paste.registry
 import pkg_resources
+from paste.deploy.converters import asbool
 from webob.exc import HTTPFound, HTTPNotFound
 
 import pylons
 import pylons.templating
-from pylons.controllers.util import Request, Response
-from pylons.i18n.translation import _get_translator
+from pylons.caching import local_cache
+from pylons.context import ContextAttribute, bind_context
+from pylons.controllers.util import (Request, Response, StreamingBody,
+                                     _is_file_wrapper)
+from pylons.i18n.translation import _get_translator, _preload_translators
 from pylons.util import (AttribSafeContextObj, ContextObj, PylonsContext,
-                         class_name_from_module_name)
+                         call_wsgi_application, class_name_from_module_name)
 
-__all__ = ['PylonsApp']
+__all__ = ['PylonsApp', 'warmup']
 
 log = logging.getLogger(__name__)
 
+# Depth of the requests handled by PylonsApp in this thread
+_handling = threading.local()
+
 class PylonsApp(object):
     """Pylons WSGI Application
 
@@ -60,6 +70,12 @@ class PylonsApp(object):
         self.request_options = config['pylons.request_options']
         self.response_options = config['pylons.response_options']
         self.controller_classes = {}
+        self.controller_failure_ttl = float(
+            config.get('controller_failure_ttl', 5))
+        self._controller_failures = {}
+        self._controller_locks = {}
+        self._controller_locks_lock = threading.Lock()
+        self._controller_instances = threading.local()
         self.log_debug = False
         self.config.setdefault('lang', None)
         
@@ -72,6 +88,23 @@ class PylonsApp(object):
         # Cache some options for use during requests
         self._session_key = self.environ_config.get('session', 'beaker.session')
         self._cache_key = self.environ_config.get('cache', 'beaker.cache')
+        
+        self.context_globals = asbool(config.get('pylons.context_globals',
+                                                 False))
+        
+        # Size the per-process cache, 0 meaning no limit
+        if 'cache_local_max_entries' in config or \
+           'cache_local_max_bytes' in config:
+            local_cache.resize(
+                int(config.get('cache_local_max_entries', 1000)) or None,
+                int(config.get('cache_local_max_bytes',
+                               16 * 1024 * 1024)) or None)
+        if asbool(config.get('preload_controllers', False)):
+            self.preload_controllers()
+        if asbool(config.get('preload_translations', False)) and \
+           config['pylons.paths'].get('root'):
+            langs = _preload_translators(config)
+            log.debug("Preloaded translations: %r", langs)
     
     def __call__(self, environ, start_response):
         """Setup and handle a web request
@@ -82,10 +115,17 @@ class PylonsApp(object):
         The methods are called in the following order:
         
         1. :meth:`~PylonsApp.setup_app_env`
-        2. :meth:`~PylonsApp.load_test_env` (Only if operating in
-           testing mode)
-        3. :meth:`~PylonsApp.resolve`
-        4. :meth:`~PylonsApp.dispatch`
+        2. :meth:`~PylonsApp.handle_request`, which calls:
+        
+           1. :meth:`~PylonsApp.load_test_env` (Only if operating in
+              testing mode)
+           2. :meth:`~PylonsApp.resolve`
+           3. :meth:`~PylonsApp.dispatch`
+        
+        When the ``pylons.context_globals`` option is enabled, the
+        request's :class:`~pylons.util.PylonsContext` is bound to the
+        thread (see :mod:`pylons.context`) until the response has been
+        sent, i.e. until the returned iterable is closed.
         
         The response from :meth:`~PylonsApp.dispatch` is expected to be
         an iterable (valid :pep:`333` WSGI response), which is then
@@ -93,9 +133,36 @@ class PylonsApp(object):
         
         """
         # Cache the logging level for the request
-        log_debug = self.log_debug = logging.DEBUG >= log.getEffectiveLevel()
+        self.log_debug = logging.DEBUG >= log.getEffectiveLevel()
 
         self.setup_app_env(environ, start_response)
+        if not self.context_globals:
+            return self.handle_request(environ, start_response)
+
+        depth = getattr(_handling, 'depth', 0)
+        previous_context = bind_context(environ['pylons.pylons'])
+        if not depth:
+            # Not a nested request, so a context still bound is left
+            # over from a response that was never closed
+            previous_context = None
+        def unbind():
+            bind_context(previous_context)
+        _handling.depth = depth + 1
+        try:
+            try:
+                app_iter = self.handle_request(environ, start_response)
+            except:
+                unbind()
+                raise
+        finally:
+            _handling.depth = depth
+        return _call_on_close(environ, app_iter, unbind)
+    
+    def handle_request(self, environ, start_response):
+        """Resolve and dispatch a request once
+        :meth:`~PylonsApp.setup_app_env` has run, returning the WSGI
+        response"""
+        log_debug = self.log_debug
         if 'paste.testing_variables' in environ:
             self.load_test_env(environ)
             if environ['PATH_INFO'] == '/_test_vars':
@@ -146,8 +213,10 @@ class PylonsApp(object):
         
         registry.register(pylons.app_globals, self.globals)
         registry.register(pylons.config, self.config)
-        registry.register(pylons.tmpl_context, pylons_obj.tmpl_context)
-        registry.register(pylons.translator, pylons_obj.translator)
+        registry.register(pylons.tmpl_context,
+                          ContextAttribute(pylons_obj, 'tmpl_context'))
+        registry.register(pylons.translator,
+                          ContextAttribute(pylons_obj, 'translator'))
         
         if 'session' in pylons_obj.__dict__:
             registry.register(pylons.session, pylons_obj.session)
@@ -164,7 +233,9 @@ class PylonsApp(object):
         
         After creating all the global objects for use in the request,
         :meth:`~PylonsApp.register_globals` is called to register them
-        in the environment.
+        in the environment. The translator and tmpl_context are only
+        created (by :meth:`~PylonsApp.make_translator` and
+        :meth:`~PylonsApp.make_tmpl_context`) when first used.
         
         """
         if self.log_debug:
@@ -198,15 +269,9 @@ class PylonsApp(object):
         
         environ['pylons.environ_config'] = self.environ_config
         
-        # Setup the translator object
-        lang = self.config['lang']
-        pylons_obj.translator = _get_translator(lang, pylons_config=self.config)
-        
-        if self.config['pylons.strict_tmpl_context']:
-            tmpl_context = ContextObj()
-        else:
-            tmpl_context = AttribSafeContextObj()
-        pylons_obj.tmpl_context = tmpl_context
+        # The translator and tmpl_context are created on first use
+        pylons_obj.set_lazy('translator', self.make_translator)
+        pylons_obj.set_lazy('tmpl_context', self.make_tmpl_context)
         
         econf = self.config['pylons.environ_config']
         if self._session_key in environ:
@@ -214,10 +279,27 @@ class PylonsApp(object):
         if self._cache_key in environ:
             pylons_obj.cache = environ[self._cache_key]
         
-        # Load the globals with the registry if around
-        if 'paste.registry' in environ:
+        if self.context_globals:
+            # The globals resolve from pylons_obj once it's bound, make
+            # the app_globals cache available as the cache global
+            if 'cache' not in pylons_obj.__dict__ and \
+               'cache' in self.globals.__dict__:
+                pylons_obj.cache = self.globals.cache
+        elif 'paste.registry' in environ:
+            # Load the globals with the registry if around
             self.register_globals(environ)
     
+    def make_translator(self):
+        """Create the translator for a request, using the ``lang``
+        config option"""
+        return _get_translator(self.config['lang'], pylons_config=self.config)
+    
+    def make_tmpl_context(self):
+        """Create the :term:`tmpl_context` object for a request"""
+        if self.config['pylons.strict_tmpl_context']:
+            return ContextObj()
+        return AttribSafeContextObj()
+    
     def resolve(self, environ, start_response):
         """Uses dispatching information found in 
         ``environ['wsgiorg.routing_args']`` to retrieve a controller
@@ -247,20 +329,64 @@ class PylonsApp(object):
         to be a dotted path to the module and name of the controller
         object.
         
+        Only one thread loads a given controller, other threads asking
+        for it wait for the result. A controller that fails to load
+        raises the same exception again without retrying the import
+        for ``controller_failure_ttl`` seconds (5 by default, 0
+        disables this).
+        
         Override this to change how the controller object is found once
         the URL has been resolved.
         
         """
         # Check to see if we've cached the class instance for this name
-        if controller in self.controller_classes:
+        try:
             return self.controller_classes[controller]
+        except KeyError:
+            pass
         
+        # The lock for each name is kept, so threads waiting on it and
+        # threads arriving later all load the controller one at a time
+        self._controller_locks_lock.acquire()
+        try:
+            lock = self._controller_locks.setdefault(controller,
+                                                     threading.Lock())
+        finally:
+            self._controller_locks_lock.release()
+        
+        lock.acquire()
+        try:
+            # Another thread may have loaded it while we waited
+            if controller in self.controller_classes:
+                return self.controller_classes[controller]
+            
+            failure = self._controller_failures.get(controller)
+            if failure is not None and failure[0] > time.time():
+                if self.log_debug:
+                    log.debug("Controller %r recently failed to load, "
+                              "re-raising the failure", controller)
+                exc_info = failure[1]
+                raise exc_info[0], exc_info[1], exc_info[2]
+            
+            try:
+                mycontroller = self.load_controller(controller)
+            except Exception:
+                if self.controller_failure_ttl > 0:
+                    self._cache_controller_failure(controller, sys.exc_info())
+                raise
+            self._controller_failures.pop(controller, None)
+            self.controller_classes[controller] = mycontroller
+            return mycontroller
+        finally:
+            lock.release()
+    
+    def load_controller(self, controller):
+        """Import and return the controller named ``controller``, called
+        by :meth:`~PylonsApp.find_controller` when it isn't cached"""
         # Check to see if its a dotted name
         if '.' in controller or ':' in controller:
-            mycontroller = pkg_resources.EntryPoint.parse(
+            return pkg_resources.EntryPoint.parse(
                 'x=%s' % controller).load(False)
-            self.controller_classes[controller] = mycontroller
-            return mycontroller
         
         # Pull the controllers class name, import controller
         full_module_name = self.package_name + '.controllers.' \
@@ -280,9 +406,61 @@ class PylonsApp(object):
                 log.debug("Found controller, module: '%s', class: '%s'",
                           full_module_name, class_name)
             mycontroller = getattr(sys.modules[full_module_name], class_name)
-        self.controller_classes[controller] = mycontroller
         return mycontroller
+    
+    def _cache_controller_failure(self, controller, exc_info):
+        """Remember a failed controller load, dropping expired
+        failures"""
+        now = time.time()
+        failures = self._controller_failures
+        for name, failure in failures.items():
+            if failure[0] <= now:
+                failures.pop(name, None)
+        failures[controller] = (now + self.controller_failure_ttl, exc_info)
+    
+    def preload_controllers(self):
+        """Import every controller module in the
+        ``pylons.paths['controllers']`` directory and resolve its
+        controller with :meth:`~PylonsApp.find_controller`
         
+        Called during initialization when the ``preload_controllers``
+        option is enabled, so that controller imports happen before the
+        first request (and before a prefork server forks its workers).
+        Modules not defining a controller are skipped.
+        
+        Returns a list of the controller names loaded.
+        
+        """
+        directory = self.config['pylons.paths']['controllers']
+        loaded = []
+        if not directory or not os.path.isdir(directory):
+            return loaded
+
+        for dirpath, dirnames, filenames in os.walk(directory):
+            # Only descend into sub-packages
+            dirnames[:] = sorted(
+                name for name in dirnames
+                if os.path.exists(os.path.join(dirpath, name, '__init__.py')))
+            prefix = dirpath[len(directory):].strip(os.sep).replace(os.sep,
+                                                                    '/')
+            for filename in sorted(filenames):
+                module_name, ext = os.path.splitext(filename)
+                if ext != '.py' or module_name == '__init__':
+                    continue
+                if prefix:
+                    controller = prefix + '/' + module_name
+                else:
+                    controller = module_name
+                try:
+                    self.find_controller(controller)
+                except AttributeError:
+                    log.debug("No controller found in module: %r, skipping",
+                              controller)
+                    continue
+                loaded.append(controller)
+        log.debug("Preloaded controllers: %r", loaded)
+        return loaded
+    
     def dispatch(self, controller, environ, start_response):
         """Dispatches to a controller, will instantiate the controller
         if necessary.
@@ -297,10 +475,17 @@ class PylonsApp(object):
             return HTTPNotFound()(environ, start_response)
 
         # If it's a class, instantiate it
+        reused = False
         if hasattr(controller, '__bases__'):
-            if log_debug:
-                log.debug("Controller appears to be a class, instantiating")
-            controller = controller()
+            if getattr(controller, 'reuse_instances', False):
+                controller_class = controller
+                controller = self._take_controller_instance(controller_class)
+                reused = True
+            else:
+                if log_debug:
+                    log.debug("Controller appears to be a class, "
+                              "instantiating")
+                controller = controller()
             controller._pylons_log_debug = log_debug
         
         # Add a reference to the controller app located
@@ -309,7 +494,39 @@ class PylonsApp(object):
         # Controller is assumed to handle a WSGI call
         if log_debug:
             log.debug("Calling controller class with WSGI interface")
-        return controller(environ, start_response)
+        response = controller(environ, start_response)
+        if reused:
+            # Only reuse the instance once it's done with the response
+            instances = self._controller_instances.instances
+            def release():
+                # Drop the request's objects before pooling the instance
+                controller.__reset__()
+                instances[controller_class] = controller
+            response = _call_on_close(environ, response, release)
+        return response
+    
+    def _take_controller_instance(self, controller_class):
+        """Return this thread's instance of ``controller_class``, or a
+        new instance when there is none
+        
+        The instance is removed from the thread's pool until the
+        response :meth:`~PylonsApp.dispatch` returns for it is closed,
+        so a nested request to the same controller gets its own
+        instance.
+        
+        """
+        try:
+            instances = self._controller_instances.instances
+        except AttributeError:
+            instances = self._controller_instances.instances = {}
+        controller = instances.pop(controller_class, None)
+        if controller is None:
+            if self.log_debug:
+                log.debug("Creating reusable controller instance")
+            return controller_class()
+        if self.log_debug:
+            log.debug("Reusing controller instance")
+        return controller
     
     def load_test_env(self, environ):
         """Sets up our Paste testing environment"""
@@ -327,3 +544,61 @@ class PylonsApp(object):
             testenv['session'] = pylons_obj.session
         if hasattr(pylons_obj, 'cache'):
             testenv['cache'] = pylons_obj.cache
+
+
+def _call_on_close(environ, app_iter, callback):
+    """Arrange for ``callback`` to be called once the WSGI response
+    ``app_iter`` is closed, returning the iterable to respond with
+    
+    Lists, and the files of the server's ``wsgi.file_wrapper`` (left
+    unwrapped so the server can still send them efficiently), don't
+    need the request once returned; ``callback`` is called at once for
+    them.
+    
+    """
+    if isinstance(app_iter, (list, tuple)) or \
+       _is_file_wrapper(environ, app_iter):
+        callback()
+        return app_iter
+    if not isinstance(app_iter, StreamingBody):
+        app_iter = StreamingBody(app_iter, None)
+    app_iter.on_close.append(callback)
+    return app_iter
+
+
+def warmup(app, urls, extra_environ=None):
+    """Send GET requests for ``urls`` through the WSGI ``app``
+    
+    Intended to be called at the end of a project's ``make_app`` with
+    the full middleware stack, so that the first real requests don't
+    pay for importing controllers, compiling templates and such. Under
+    a prefork server this work is then done once in the parent process
+    and shared with the workers.
+    
+    ``extra_environ`` is a dict added to each request's environ.
+    Failures are logged and don't stop the remaining requests.
+    
+    Returns a list of ``(url, status)`` tuples, with a status of
+    ``None`` when the request raised an exception.
+    
+    """
+    results = []
+    for url in urls:
+        environ = Request.blank(url).environ
+        if extra_environ:
+            environ.update(extra_environ)
+        try:
+            status, headers, app_iter = call_wsgi_application(app, environ)
+            try:
+                for chunk in app_iter:
+                    pass
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        except Exception:
+            log.exception("Warmup request to %s failed", url)
+            status = None
+        else:
+            log.debug("Warmup request to %s returned %s", url, status)
+        results.append((url, status))
+    return results
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Compare the cost of the Pylons globals with ``paste.registry``
+(RegistryManager) against the ``pylons.context_globals`` option
+
+Usage::
+
+    python scripts/bench_globals.py [requests]
+
+with Pylons importable (e.g. ``PYTHONPATH=.`` from a checkout). Runs a
+minimal PylonsApp, whose action touches the request, response
+and tmpl_context globals, both ways and prints the time per request.
+
+"""
+import sys
+import time
+
+from paste.registry import RegistryManager
+from webob import Request
+
+import pylons
+from pylons.configuration import PylonsConfig
+from pylons.controllers import WSGIController
+from pylons.wsgiapp import PylonsApp
+
+class BenchController(WSGIController):
+    def index(self):
+        pylons.tmpl_context.name = pylons.request.params.get('name', 'World')
+        pylons.response.headers['X-Bench'] = 'true'
+        return 'Hello %s' % pylons.tmpl_context.name
+
+
+def make_app(context_globals):
+    config = PylonsConfig()
+    config.init_app({}, {}, package='bench', paths={})
+    config['pylons.app_globals'] = type('Globals', (object,), {})()
+    config['pylons.context_globals'] = context_globals
+    app = PylonsApp(config=config)
+    app.controller_classes['bench'] = BenchController
+    if not context_globals:
+        app = RegistryManager(app)
+    return app
+
+
+def bench(app, requests):
+    base_environ = Request.blank('/bench/index?name=Pylons').environ
+    routing_args = ((), dict(controller='bench', action='index'))
+    def start_response(status, headers, exc_info=None):
+        pass
+    start = time.time()
+    for i in xrange(requests):
+        environ = base_environ.copy()
+        environ['wsgiorg.routing_args'] = routing_args
+        ''.join(app(environ, start_response))
+    return time.time() - start
+
+
+def main():
+    requests = 20000
+    if len(sys.argv) > 1:
+        requests = int(sys.argv[1])
+    for name, context_globals in (('RegistryManager', False),
+                                  ('context_globals', True)):
+        app = make_app(context_globals)
+        bench(app, 100)
+        elapsed = bench(app, requests)
+        print '%-16s %d requests in %.3fs (%.1f usec/request)' % (
+            name, requests, elapsed, elapsed / requests * 1e6)
+
+
+if __name__ == '__main__':
+    main()
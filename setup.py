@@ -108,6 +108,7 @@ the `Pylons download page <http://pylonshq.com/download/>`_ .
     restcontroller = pylons.commands:RestControllerCommand
     routes = pylons.commands:RoutesCommand
     shell = pylons.commands:ShellCommand
+    warmcache = pylons.commands:WarmCacheCommand
 
     [paste.paster_create_template]
     pylons = pylons.util:PylonsTemplate
@@ -1,17 +1,29 @@
 import os
 import sys
+import time
+from cStringIO import StringIO
+from wsgiref.util import FileWrapper
 
 import pylons
 import pylons.configuration as configuration
 from beaker.cache import CacheManager
 from beaker.middleware import SessionMiddleware
+from mako.lookup import TemplateLookup
 from paste.fixture import TestApp
 from paste.registry import RegistryManager
 from paste.deploy.converters import asbool
 from pylons import url
+from pylons.context import bind_context, current_context
+from pylons.controllers import WSGIController
+from pylons.controllers.util import Request
+from pylons.commands import expand_urls, warm_urls
 from pylons.decorators import jsonify
+from pylons.i18n.translation import (_get_translator, _preload_translators,
+                                     _translators, get_lang, set_lang)
 from pylons.middleware import ErrorHandler, StatusCodeRedirect
-from pylons.wsgiapp import PylonsApp
+from pylons.templating import render_mako
+from pylons.util import PylonsContext
+from pylons.wsgiapp import PylonsApp, warmup
 from routes import Mapper
 from routes.middleware import RoutesMiddleware
 from routes.util import URLGenerator
@@ -92,3 +104,384 @@ class TestJsonifyDecorator(object):
         response = self.app.get(url(controller='i18nc', action='langs'), headers={
                 'Accept-Language':'fr;q=0.6, en;q=0.1, ja;q=0.3'})
         assert "['fr', 'ja', 'en', 'en-us']" in response
+
+class TestPreload(object):
+    def test_preload_controllers(self):
+        app = make_app({})
+        pylons_app = PylonsApp(config=app.config)
+        assert pylons_app.controller_classes == {}
+        loaded = pylons_app.preload_controllers()
+        assert loaded == ['hello', 'i18nc']
+        assert pylons_app.controller_classes['hello'].__name__ == \
+            'HelloController'
+
+    def test_preload_controllers_option(self):
+        app = make_app({}, preload_controllers='true')
+        try:
+            pylons_app = PylonsApp(config=app.config)
+            assert 'i18nc' in pylons_app.controller_classes
+        finally:
+            app.config.pop('preload_controllers')
+
+    def test_warmup(self):
+        app = make_app({})
+        results = warmup(app, ['/hello/index', '/hello/missing'])
+        assert results == [('/hello/index', '200 OK'),
+                           ('/hello/missing', '404 Not Found')]
+
+    def test_expand_urls(self):
+        mapper = Mapper()
+        mapper.connect('product', '/products/{id}')
+        urls = expand_urls(['/', '# comment', '',
+                            '/{controller}/index?a=1 controller=a,b x=1',
+                            'product id=1,2 page=3'], mapper)
+        assert urls == ['/', '/a/index?a=1&x=1', '/b/index?a=1&x=1',
+                        '/products/1?page=3', '/products/2?page=3']
+
+    def test_warm_urls(self):
+        app = make_app({})
+        urls = ['/hello/index', '/hello/missing'] * 3
+        results = warm_urls(app, urls, concurrency=3)
+        assert [url for url, status, elapsed in results] == urls
+        assert [status for url, status, elapsed in results] == \
+            ['200 OK', '404 Not Found'] * 3
+
+class TestFindController(object):
+    def setUp(self):
+        self.app = PylonsApp(config=make_app({}).config)
+        self.loads = []
+        load_controller = self.app.load_controller
+        def counting_load_controller(controller):
+            self.loads.append(controller)
+            return load_controller(controller)
+        self.app.load_controller = counting_load_controller
+
+    def test_cached(self):
+        controller = self.app.find_controller('hello')
+        assert self.app.find_controller('hello') is controller
+        assert self.loads == ['hello']
+
+    @raises(ImportError)
+    def test_missing(self):
+        self.app.find_controller('nonexistent')
+
+    def test_failure_cached(self):
+        for i in range(3):
+            try:
+                self.app.find_controller('nonexistent')
+            except ImportError:
+                pass
+            else:
+                assert False, 'ImportError not raised'
+        assert self.loads == ['nonexistent']
+        
+        self.app._controller_failures['nonexistent'] = \
+            (0, self.app._controller_failures['nonexistent'][1])
+        try:
+            self.app.find_controller('nonexistent')
+        except ImportError:
+            pass
+        assert self.loads == ['nonexistent', 'nonexistent']
+
+    def test_failure_not_cached(self):
+        self.app.controller_failure_ttl = 0
+        for i in range(2):
+            try:
+                self.app.find_controller('nonexistent')
+            except ImportError:
+                pass
+        assert self.loads == ['nonexistent', 'nonexistent']
+        assert not self.app._controller_failures
+
+    def test_single_flight(self):
+        import threading
+        load_controller = self.app.load_controller
+        def slow_load_controller(controller):
+            time.sleep(0.1)
+            return load_controller(controller)
+        self.app.load_controller = slow_load_controller
+        results = []
+        def find():
+            results.append(self.app.find_controller('hello'))
+        threads = [threading.Thread(target=find) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 5
+        assert self.loads == ['hello']
+        assert self.app._controller_locks.keys() == ['hello']
+
+    def test_single_flight_failures(self):
+        import threading
+        self.app.controller_failure_ttl = 0
+        active = []
+        overlaps = []
+        load_controller = self.app.load_controller
+        def slow_load_controller(controller):
+            active.append(controller)
+            overlaps.append(len(active))
+            try:
+                time.sleep(0.02)
+                return load_controller(controller)
+            finally:
+                active.remove(controller)
+        self.app.load_controller = slow_load_controller
+        def find():
+            try:
+                self.app.find_controller('nonexistent')
+            except ImportError:
+                pass
+        threads = []
+        for i in range(5):
+            threads.append(threading.Thread(target=find))
+            threads[-1].start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        assert len(overlaps) == 5
+        assert max(overlaps) == 1
+
+class ReusedController(WSGIController):
+    reuse_instances = True
+
+    def __init__(self):
+        self.resets = 0
+
+    def __reset__(self):
+        WSGIController.__reset__(self)
+        self.resets += 1
+
+    def index(self):
+        return '%s %s' % (id(self), self.resets)
+
+    def stream(self):
+        return iter([self.index()])
+
+class TestReusedControllers(object):
+    def setUp(self):
+        config = make_app({}).config
+        pylons_app = PylonsApp(config=config)
+        pylons_app.controller_classes['hello'] = ReusedController
+        self.pylons_app = pylons_app
+        app = RoutesMiddleware(pylons_app, config['routes.map'],
+                               singleton=False)
+        self.wsgi_app = RegistryManager(app)
+        self.app = TestApp(self.wsgi_app)
+
+    def test_reused(self):
+        instance, resets = self.app.get('/hello/index').body.split()
+        assert resets == '0'
+        assert self.app.get('/hello/index').body == '%s 1' % instance
+        assert self.app.get('/hello/index').body == '%s 2' % instance
+
+    def test_reset_when_pooled(self):
+        self.app.get('/hello/index')
+        instances = self.pylons_app._controller_instances.instances
+        controller = instances[ReusedController]
+        assert controller.resets == 1
+        assert '_py_object' not in controller.__dict__
+        assert 'start_response' not in controller.__dict__
+
+    def test_reused_once_closed(self):
+        environ = Request.blank('/hello/stream').environ
+        app_iter = self.wsgi_app(environ, lambda *args: None)
+        try:
+            instance = ''.join(app_iter).split()[0]
+            assert self.app.get('/hello/index').body.split()[0] != instance
+        finally:
+            app_iter.close()
+        assert self.app.get('/hello/index').body.split()[0] == instance
+
+class TestContextGlobals(object):
+    def setUp(self):
+        config = make_app({}).config
+        config['pylons.context_globals'] = True
+        try:
+            app = PylonsApp(config=config)
+        finally:
+            config['pylons.context_globals'] = False
+        self.pylons_app = app
+        app = RoutesMiddleware(app, config['routes.map'], singleton=False)
+        app = self.wsgi_app = SessionMiddleware(app, config)
+        self.app = TestApp(app)
+        url._push_object(URLGenerator(config['routes.map'], {}))
+
+    def tearDown(self):
+        url._pop_object()
+
+    def test_basic_response(self):
+        response = self.app.get('/hello/index')
+        assert 'Hello World' in response
+
+    def test_set_lang(self):
+        response = self.app.get(url(controller='i18nc', action='set_lang',
+                                    lang='ja'))
+        assert u'\u8a00\u8a9e\u8a2d\u5b9a\u3092\u300cja\u300d\u306b\u5909\u66f4\u3057\u307e\u3057\u305f'.encode('utf-8') in response
+
+    def test_unbound_after_request(self):
+        self.app.get('/hello/index')
+        assert current_context() is None
+
+    def test_bound_until_closed(self):
+        self.pylons_app.controller_classes['hello'] = StreamController
+        environ = Request.blank('/hello/chunks').environ
+        app_iter = self.wsgi_app(environ, lambda *args: None)
+        try:
+            for chunk in app_iter:
+                assert current_context() is not None
+        finally:
+            app_iter.close()
+        assert current_context() is None
+
+    def test_file_wrapper(self):
+        self.pylons_app.controller_classes['hello'] = StreamController
+        environ = Request.blank('/hello/file').environ
+        environ['wsgi.file_wrapper'] = FileWrapper
+        app_iter = self.wsgi_app(environ, lambda *args: None)
+        assert isinstance(app_iter, FileWrapper)
+        assert current_context() is None
+        assert ''.join(app_iter) == 'file body'
+
+    def test_unclosed_response(self):
+        self.pylons_app.controller_classes['hello'] = StreamController
+        environ = Request.blank('/hello/chunks').environ
+        self.wsgi_app(environ, lambda *args: None)
+        assert current_context() is not None
+        # The response is never closed; the next request doesn't
+        # restore its context once done
+        self.app.get('/hello/chunks')
+        assert current_context() is None
+        
+    def test_proxy_fallback(self):
+        py_obj = PylonsContext()
+        py_obj.request = 'bound request'
+        previous = bind_context(py_obj)
+        try:
+            assert pylons.request._current_obj() == 'bound request'
+            pylons.response._push_object('pushed response')
+            try:
+                assert pylons.response._current_obj() == 'pushed response'
+            finally:
+                pylons.response._pop_object()
+        finally:
+            bind_context(previous)
+        assert current_context() is previous
+
+class StreamController(WSGIController):
+    instances = []
+
+    def __before__(self):
+        self.events = []
+        self.instances.append(self)
+
+    def __after__(self):
+        self.events.append('after')
+
+    def index(self):
+        pylons.tmpl_context.name = 'World'
+        def stream():
+            self.events.append('stream')
+            yield 'Hello '
+            yield render_mako('name.mako')
+            yield ' %s' % self.events
+        return stream()
+
+    def chunks(self):
+        return iter(['Hello', ' World'])
+
+    def file(self):
+        environ = pylons.request.environ
+        return environ['wsgi.file_wrapper'](StringIO('file body'))
+
+    def lang(self):
+        def stream():
+            set_lang('ja')
+            yield str(get_lang())
+        return stream()
+
+class TestStreaming(object):
+    def setUp(self):
+        config = make_app({}).config
+        lookup = TemplateLookup()
+        lookup.put_string('name.mako', '${c.name}')
+        config['pylons.app_globals'].mako_lookup = lookup
+        pylons_app = PylonsApp(config=config)
+        pylons_app.controller_classes['hello'] = StreamController
+        app = RoutesMiddleware(pylons_app, config['routes.map'],
+                               singleton=False)
+        self.app = TestApp(RegistryManager(app))
+
+    def test_globals_while_streaming(self):
+        del StreamController.instances[:]
+        response = self.app.get('/hello/index')
+        assert response.body == "Hello World ['stream']"
+        assert StreamController.instances[0].events == ['stream', 'after']
+        assert current_context() is None
+
+    def test_set_lang_while_streaming(self):
+        assert self.app.get('/hello/lang').body == "['ja']"
+
+class LazyController(WSGIController):
+    def index(self):
+        return str(sorted(name for name in ('translator', 'tmpl_context')
+                          if name in self._py_object.__dict__))
+
+    def translate(self):
+        pylons.translator.ugettext('Hello')
+        return self.index()
+
+class TestLazyContext(object):
+    def setUp(self):
+        config = make_app({}).config
+        pylons_app = PylonsApp(config=config)
+        pylons_app.controller_classes['hello'] = LazyController
+        app = RoutesMiddleware(pylons_app, config['routes.map'],
+                               singleton=False)
+        self.app = TestApp(RegistryManager(app))
+
+    def test_not_created(self):
+        # load_test_env creates the tmpl_context
+        assert self.app.get('/hello/index').body == "['tmpl_context']"
+
+    def test_created_on_access(self):
+        assert self.app.get('/hello/translate').body == \
+            "['tmpl_context', 'translator']"
+
+    def test_set_lazy(self):
+        py_obj = PylonsContext()
+        calls = []
+        def factory():
+            calls.append(None)
+            return 'value'
+        py_obj.set_lazy('attr', factory)
+        py_obj.set_lazy('other', factory)
+        py_obj.other = 'set'
+        assert py_obj.attr == 'value'
+        assert py_obj.attr == 'value'
+        assert py_obj.other == 'set'
+        assert len(calls) == 1
+        assert not hasattr(py_obj, 'missing')
+
+class TestTranslatorCache(object):
+    def setUp(self):
+        self.config = make_app({}).config
+
+    def test_cached(self):
+        first = _get_translator('ja', pylons_config=self.config)
+        second = _get_translator('ja', pylons_config=self.config)
+        assert first is not second
+        assert first._catalog is second._catalog
+        assert first.pylons_lang == ['ja']
+
+    def test_add_fallback_copies(self):
+        first = _get_translator(['ja'], pylons_config=self.config)
+        first.add_fallback(_get_translator('ja', pylons_config=self.config))
+        assert first._fallback is not None
+        second = _get_translator(['ja'], pylons_config=self.config)
+        assert second._fallback is None
+
+    def test_preload(self):
+        _translators.clear()
+        assert _preload_translators(self.config) == ['ja']
+        assert len(_translators) == 1
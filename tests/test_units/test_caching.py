@@ -0,0 +1,378 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from beaker.cache import CacheManager
+from webtest import TestApp
+import simplejson
+
+import pylons
+from pylons.caching import CacheStats, LocalCache, cache_stats, \
+     cache_stats_app, estimate_size, get_generations, get_local, \
+     get_with_grace, local_cache, new_generation, put_local
+from pylons.shmcache import SharedSegment
+import pylons.templating
+from pylons.templating import cached_template, render_genshi, render_jinja2, \
+     render_mako, render_mako_def
+
+class TestLocalCache(object):
+    def test_get_put(self):
+        cache = LocalCache()
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert 'a' in cache
+        assert 'b' not in cache
+        cache.put('a', 2)
+        assert cache.get('a') == 2
+        assert len(cache) == 1
+        cache.remove('a')
+        assert 'a' not in cache
+        cache.remove('a')
+
+    def test_max_entries(self):
+        cache = LocalCache(max_entries=3)
+        for key in 'abc':
+            cache.put(key, key)
+        cache.get('a')
+        cache.put('d', 'd')
+        assert len(cache) == 3
+        assert 'b' not in cache
+        for key in 'acd':
+            assert key in cache
+
+    def test_max_bytes(self):
+        cache = LocalCache(max_entries=None, max_bytes=10)
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'x' * 4)
+        assert cache.size == 8
+        cache.put('c', 'x' * 4)
+        assert 'a' not in cache
+        assert cache.size == 8
+        cache.put('d', 'x' * 11)
+        assert 'd' not in cache
+        assert len(cache) == 2
+
+    def test_expire(self):
+        cache = LocalCache()
+        cache.put('a', 1, expire=0.1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        time.sleep(0.15)
+        assert 'a' not in cache
+        assert cache.get('b') == 2
+
+    def test_resize_clear(self):
+        cache = LocalCache(max_entries=None)
+        for i in range(10):
+            cache.put(i, i, size=1)
+        cache.resize(max_entries=5)
+        assert len(cache) == 5
+        assert 9 in cache and 4 not in cache
+        cache.clear()
+        assert len(cache) == 0 and cache.size == 0
+
+    def test_estimate_size(self):
+        assert estimate_size('abc') == 3
+        assert estimate_size(u'abc') == 6
+        assert estimate_size(dict(content='abcd', headers=[('a', 'bc')])) \
+            == 7 + 4 + 7 + 3
+
+    def test_put_local_expire(self):
+        local_cache.clear()
+        put_local('ns', 'key', 'value', 60)
+        assert get_local('ns', 'key') == 'value'
+        # Never outlives the Beaker copy
+        put_local('ns', 'key', 'value', 60, expire=10,
+                  created=time.time() - 20)
+        assert ('ns', None, 'key') not in local_cache
+
+
+class TestGetWithGrace(object):
+    def setUp(self):
+        self.cache = CacheManager(type='memory').get_cache('grace')
+        self.cache.clear()
+        self.created = 0
+
+    def create(self, delay=0):
+        self.created += 1
+        time.sleep(delay)
+        return dict(content=self.created, created=time.time())
+
+    def get(self, expire=0.2, grace=10, delay=0):
+        return get_with_grace(self.cache, 'key', lambda: self.create(delay),
+                              expire, grace)['content']
+
+    def test_fresh(self):
+        assert self.get() == 1
+        assert self.get() == 1
+
+    def test_stale_while_regenerating(self):
+        assert self.get() == 1
+        time.sleep(0.25)
+        results = []
+        regenerate = threading.Thread(
+            target=lambda: results.append(self.get(delay=0.3)))
+        regenerate.start()
+        time.sleep(0.1)
+        # Served the stale copy without waiting
+        start = time.time()
+        assert self.get() == 1
+        assert time.time() - start < 0.2
+        regenerate.join()
+        assert results == [2]
+        assert self.get() == 2
+
+    def test_single_flight(self):
+        results = []
+        def get():
+            results.append(self.get(delay=0.1))
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [1] * 5
+        assert self.created == 1
+
+    def test_expired_grace(self):
+        assert self.get(expire=0.1, grace=0.1) == 1
+        time.sleep(0.25)
+        assert self.get(expire=0.1, grace=0.1) == 2
+
+    def test_starttime(self):
+        assert self.get() == 1
+        result = get_with_grace(self.cache, 'key', self.create, 10, 10,
+                                starttime=time.time() + 1)
+        assert result['content'] == 2
+
+
+class TestGenerations(object):
+    def setUp(self):
+        self.manager = CacheManager(type='memory')
+
+    def test_generations(self):
+        first = get_generations(self.manager, ['a', 'b'])
+        assert first == get_generations(self.manager, ['a', 'b'])
+        assert len(first.split('.')) == 2
+        
+        new_generation(self.manager, 'b')
+        second = get_generations(self.manager, ['a', 'b'])
+        assert second.split('.')[0] == first.split('.')[0]
+        assert second.split('.')[1] != first.split('.')[1]
+        new_generation(self.manager, 'b')
+        assert get_generations(self.manager, ['a', 'b']) not in (first, second)
+
+
+class TestCacheStats(object):
+    def test_stats(self):
+        stats = CacheStats()
+        stats.miss('ns', 0.02, 100)
+        stats.miss('ns', 10, 50)
+        stats.hit('ns')
+        stats.hit('ns', local=True)
+        stats.hit('other')
+        result = stats.get_stats('ns')
+        assert result['hits'] == 2
+        assert result['local_hits'] == 1
+        assert result['misses'] == 2
+        assert result['create_time'] == 10.02
+        assert result['create_bytes'] == 150
+        assert result['create_histogram'] == [0, 0, 0, 1, 0, 0, 0, 0, 1]
+        assert result['buckets'] == list(CacheStats.latency_buckets)
+        assert sorted(stats.get_stats()) == ['ns', 'other']
+        stats.reset()
+        assert stats.get_stats() == {}
+
+    def test_stats_app(self):
+        cache_stats.reset()
+        cache_stats.hit('ns')
+        app = TestApp(cache_stats_app)
+        response = app.get('/')
+        assert response.content_type == 'application/json'
+        assert simplejson.loads(response.body)['ns']['hits'] == 1
+        response = app.get('/', dict(namespace='ns'))
+        assert simplejson.loads(response.body)['hits'] == 1
+
+
+class TestSharedSegment(object):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.shm')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_put(self):
+        segment = SharedSegment(self.path, 64 * 1024, slots=64,
+                                page_size=4096)
+        assert segment.get('a') is None
+        assert segment.put('a', 'value')
+        assert segment.get('a') == 'value'
+        assert 'a' in segment
+        assert segment.put('a', 'x' * 1000)
+        assert segment.get('a') == 'x' * 1000
+        assert not segment.put('b', 'x' * 5000)
+        assert 'b' not in segment
+        assert segment.delete('a')
+        assert not segment.delete('a')
+        assert segment.get('a') is None
+        segment.close()
+
+    def test_prefix(self):
+        segment = SharedSegment(self.path, 64 * 1024, slots=64,
+                                page_size=4096)
+        for key in ('ns1\0a', 'ns1\0b', 'ns2\0a'):
+            segment.put(key, key)
+        assert sorted(segment.keys('ns1\0')) == ['ns1\0a', 'ns1\0b']
+        segment.delete_prefix('ns1\0')
+        assert segment.keys() == ['ns2\0a']
+        segment.close()
+
+    def test_evict_slots(self):
+        segment = SharedSegment(self.path, 64 * 1024, slots=4,
+                                page_size=4096)
+        for key in 'abcd':
+            segment.put(key, key)
+        segment.get('a')
+        segment.put('e', 'e')
+        assert sorted(segment.keys()) == ['a', 'c', 'd', 'e']
+        segment.close()
+
+    def test_evict_pages(self):
+        segment = SharedSegment(self.path, 4096 * 3, slots=16,
+                                page_size=4096)
+        assert segment.pages == 2
+        for key in 'abc':
+            segment.put(key, key * 3000)
+            segment.get('a')
+        assert sorted(segment.keys()) == ['a', 'c']
+        # Smaller entries get their own class, which takes a page
+        assert segment.put('d', 'd')
+        assert sorted(segment.keys()) == ['c', 'd']
+        segment.close()
+
+    def test_move_pages(self):
+        segment = SharedSegment(self.path, 4096 * 9, slots=256,
+                                page_size=4096)
+        for i in range(20):
+            assert segment.put('big%d' % i, 'x' * 3000)
+        sizes = [10, 500, 3000, 100, 1500]
+        for i in range(50):
+            size = sizes[i % len(sizes)]
+            key = 'mixed%d' % i
+            assert segment.put(key, 'y' * size)
+            assert segment.get(key) == 'y' * size
+        assert segment.get('mixed49') == 'y' * 1500
+        segment.close()
+
+    def test_shared(self):
+        segment = SharedSegment(self.path, 64 * 1024, slots=64,
+                                page_size=4096)
+        segment.put('a', 'parent')
+        pid = os.fork()
+        if not pid:
+            try:
+                other = SharedSegment(self.path)
+                other.put('b', other.get('a') + ' child')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert segment.get('b') == 'parent child'
+        segment.close()
+
+    def test_backend(self):
+        manager = CacheManager(type='shm', shm_file=self.path,
+                               shm_size=64 * 1024, shm_slots=64,
+                               shm_page_size=4096)
+        cache = manager.get_cache('ns')
+        cache.put('key', dict(a=1))
+        assert cache.get('key') == dict(a=1)
+        assert cache.get_value('key', createfunc=lambda: 2) == dict(a=1)
+        cache.remove_value('key')
+        assert cache.get_value('key', createfunc=lambda: 2) == 2
+        manager.get_cache('other').put('key', 3)
+        cache.clear()
+        assert 'key' not in cache
+        assert manager.get_cache('other').get('key') == 3
+
+
+class TestCachedTemplate(object):
+    def setUp(self):
+        pylons.cache._push_object(CacheManager(type='memory'))
+        local_cache.clear()
+        self.renders = 0
+
+    def tearDown(self):
+        pylons.cache._pop_object()
+
+    def render(self):
+        self.renders += 1
+        return 'rendered %s' % self.renders
+
+    def test_local_expire(self):
+        result = cached_template('local.mako', self.render,
+                                 cache_type='memory', local_expire=60)
+        assert result == 'rendered 1'
+        pylons.cache.get_cache('local.mako', type='memory').clear()
+        result = cached_template('local.mako', self.render,
+                                 cache_type='memory', local_expire=60)
+        assert result == 'rendered 1'
+        local_cache.clear()
+        result = cached_template('local.mako', self.render,
+                                 cache_type='memory', local_expire=60)
+        assert result == 'rendered 2'
+
+    def test_stats(self):
+        cache_stats.reset()
+        for i in range(3):
+            cached_template('stats.mako', self.render, cache_type='memory',
+                            local_expire=60)
+        local_cache.clear()
+        cached_template('stats.mako', self.render, cache_type='memory',
+                        local_expire=60)
+        stats = cache_stats.get_stats('stats.mako')
+        assert stats['misses'] == 1
+        assert stats['hits'] == 3
+        assert stats['local_hits'] == 2
+        assert stats['create_bytes'] == len('rendered 1')
+
+    def test_stale_grace(self):
+        def render():
+            return cached_template('grace.mako', self.render,
+                                   cache_type='memory', cache_expire=0.1,
+                                   stale_grace=10)
+        assert render() == 'rendered 1'
+        assert render() == 'rendered 1'
+        time.sleep(0.15)
+        assert render() == 'rendered 2'
+
+    def test_stale_grace_local_expire(self):
+        def render(**kwargs):
+            return cached_template('grace_local.mako', self.render,
+                                   cache_type='memory', cache_expire=0.2,
+                                   stale_grace=10, **kwargs)
+        assert render() == 'rendered 1'
+        time.sleep(0.15)
+        # The local copy expires with the Beaker copy it was made from
+        assert render(local_expire=60) == 'rendered 1'
+        time.sleep(0.1)
+        assert render(local_expire=60) == 'rendered 2'
+
+    def test_render_options(self):
+        calls = []
+        def record(template_name, render_func, **kwargs):
+            calls.append(kwargs)
+        pylons.templating.cached_template = record
+        try:
+            for render in render_mako, render_genshi, render_jinja2:
+                render('page.html', local_expire=60, stale_grace=10)
+            render_mako_def('page.html', 'header', local_expire=60,
+                            stale_grace=10)
+        finally:
+            pylons.templating.cached_template = cached_template
+        assert len(calls) == 4
+        for kwargs in calls:
+            assert kwargs['local_expire'] == 60
+            assert kwargs['stale_grace'] == 10
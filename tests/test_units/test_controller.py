@@ -56,6 +56,18 @@ class BasicWSGIController(WSGIController):
     def list(self):
         return ['from', ' a ', 'list']
 
+    def yield_unicode(self):
+        def its():
+            yield u'\u2603'
+            yield 'snowman'
+        return its()
+
+    def write_and_return(self):
+        pylons.response.write('written ')
+        return u'returned'
+
+stream_events = []
+
 class FilteredWSGIController(WSGIController):
     def __init__(self):
         self.before = 0
@@ -69,6 +81,8 @@ class FilteredWSGIController(WSGIController):
         action = pylons.request.environ['pylons.routes_dict'].get('action')
         if action in ('after_response', 'after_string_response'):
             pylons.response.write(' from __after__')
+        elif action == 'after_stream_response':
+            stream_events.append('after')
 
     def index(self):
         return 'hi all, before is %s' % self.before
@@ -79,6 +93,12 @@ class FilteredWSGIController(WSGIController):
     def after_string_response(self):
         return 'hello'
 
+    def after_stream_response(self):
+        def its():
+            stream_events.append('stream')
+            yield 'stream'
+        return its()
+
 class TestBasicWSGI(TestWSGIController):
     def __init__(self, *args, **kargs):
         TestWSGIController.__init__(self, *args, **kargs)
@@ -167,6 +187,28 @@ class TestBasicWSGI(TestWSGIController):
         self.baseenviron['pylons.routes_dict']['action'] = 'list'
         assert 'from a list' in self.app.get('/')
 
+    def test_yield_unicode(self):
+        resp = self.get_response(action='yield_unicode')
+        assert resp.body == u'\u2603snowman'.encode('utf-8')
+        assert resp.header('Set-Cookie').startswith('big_message=goodbye')
+
+    def test_write_and_return(self):
+        resp = self.get_response(action='write_and_return')
+        assert resp.body == 'written returned'
+
+    def test_replaced_action(self):
+        resp = self.get_response(action='strme')
+        assert 'hi there' in resp
+        strme = BasicWSGIController.__dict__['strme']
+        def replaced(self, id=None):
+            return 'replaced %s' % id
+        BasicWSGIController.strme = replaced
+        try:
+            resp = self.get_response(action='strme', id='4')
+            assert 'replaced 4' in resp
+        finally:
+            BasicWSGIController.strme = strme
+
 class TestFilteredWSGI(TestWSGIController):
     def __init__(self, *args, **kargs):
         TestWSGIController.__init__(self, *args, **kargs)
@@ -193,6 +235,42 @@ class TestFilteredWSGI(TestWSGIController):
         resp = self.get_response(action='after_string_response')
         assert 'hello from __after__' in resp
 
+    def test_after_stream_response(self):
+        del stream_events[:]
+        resp = self.get_response(action='after_stream_response')
+        assert resp.body == 'stream'
+        assert stream_events == ['stream', 'after']
+
     def test_start_response(self):
         self.baseenviron['pylons.routes_dict']['action'] = 'start_response'
         self.app.get('/', status=404)
+
+class TestDispatchPlan(object):
+    def test_plan_cached_per_class(self):
+        plan = BasicWSGIController._get_dispatch_plan()
+        assert plan is BasicWSGIController._get_dispatch_plan()
+        assert plan is not FilteredWSGIController._get_dispatch_plan()
+
+    def test_plan_actions(self):
+        plan = BasicWSGIController._get_dispatch_plan()
+        assert 'index' in plan.actions
+        assert 'yield_fun' in plan.actions
+        assert '__before__' not in plan.actions
+        assert '_perform_call' not in plan.actions
+        assert 'start_response' not in plan.actions
+        assert plan.has_before and plan.has_after
+        assert not WSGIController._get_dispatch_plan().has_before
+
+    def test_plan_binders(self):
+        plan = BasicWSGIController._get_dispatch_plan()
+        bind_args = plan.get_binder(BasicWSGIController.index)
+        assert bind_args(dict(action='index', environ={})) == {}
+        class ArgsController(WSGIController):
+            def view(self, id, environ=None):
+                pass
+            def anything(self, **kwargs):
+                pass
+        plan = ArgsController._get_dispatch_plan()
+        kargs = dict(action='view', id='4', controller='args')
+        assert plan.get_binder(ArgsController.view)(kargs) == dict(id='4')
+        assert plan.get_binder(ArgsController.anything)(kargs) is kargs
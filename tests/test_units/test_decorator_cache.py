@@ -1,6 +1,7 @@
 import os
 import shutil
 import time
+import zlib
 
 from webtest import TestApp
 from paste.registry import RegistryManager
@@ -8,7 +9,10 @@ from paste.registry import RegistryManager
 from beaker.middleware import CacheMiddleware
 
 import pylons
-from pylons.decorators.cache import beaker_cache, create_cache_key
+from pylons.caching import cache_stats, local_cache
+from pylons.decorators.cache import MAX_KEY_LENGTH, beaker_cache, \
+     create_cache_key, invalidate_namespace, invalidate_tag, \
+     make_key_dict_builder, _join_generations
 
 from pylons.controllers import WSGIController, XMLRPCController
 from pylons.testutil import SetupCacheGlobal, ControllerWrap
@@ -16,6 +20,10 @@ from pylons.testutil import SetupCacheGlobal, ControllerWrap
 from __init__ import data_dir, TestWSGIController
 
 class CacheController(WSGIController):
+    def __before__(self):
+        if 'lang' in pylons.request.GET:
+            pylons.translator.pylons_lang = [pylons.request.GET['lang']]
+
     @beaker_cache(key=None, invalidate_on_startup=True)
     def test_default_cache_decorator_invalidate(self):
         pylons.app_globals.counter += 1
@@ -100,6 +108,78 @@ class CacheController(WSGIController):
     def test_cache_key_dupe(self):
         return "Hello folks, time is %s" % time.time()
 
+    @beaker_cache(key=None, local_expire=60)
+    def test_local_cache_decorator(self):
+        pylons.app_globals.counter += 1
+        return 'Counter=%s' % pylons.app_globals.counter
+
+    @beaker_cache(key=None, expire=1, stale_grace=60)
+    def test_stale_grace_cache_decorator(self):
+        pylons.app_globals.counter += 1
+        return 'Counter=%s' % pylons.app_globals.counter
+
+    @beaker_cache(key=None, conditional=True)
+    def test_conditional_cache_decorator(self):
+        pylons.app_globals.counter += 1
+        return 'Counter=%s' % pylons.app_globals.counter
+
+    def test_invalidate_conditional_cache(self):
+        ns, key = create_cache_key(
+            CacheController.test_conditional_cache_decorator)
+        pylons.cache.get_cache(ns).remove_value(key)
+
+    def test_drop_conditional_content(self):
+        ns, key = create_cache_key(
+            CacheController.test_conditional_cache_decorator)
+        pylons.cache.get_cache(ns).remove_value(key + ' content')
+
+    @beaker_cache(key='id', tags=['product-%(id)s'])
+    def test_tagged_cache_decorator(self, id):
+        pylons.app_globals.counter += 1
+        return 'Counter=%s' % pylons.app_globals.counter
+
+    @beaker_cache(key='id', tags=lambda self, id: ['product-%s' % id, 'all'])
+    def test_tags_func_cache_decorator(self, id):
+        pylons.app_globals.counter += 1
+        return 'Counter=%s' % pylons.app_globals.counter
+
+    def test_invalidate_tag(self, id):
+        invalidate_tag(id)
+        return 'Invalidated'
+
+    def test_invalidate_namespace(self):
+        invalidate_namespace(CacheController)
+        return 'Invalidated'
+
+    @beaker_cache(key=None, vary=['Accept-Language', 'Cookie:device', 'lang'])
+    def test_vary_cache_decorator(self):
+        pylons.app_globals.counter += 1
+        return 'Counter=%s' % pylons.app_globals.counter
+
+    @beaker_cache(key=None, compress=True)
+    def test_compress_cache_decorator(self):
+        pylons.app_globals.counter += 1
+        return u'Counter=%s \xe9' % pylons.app_globals.counter
+
+    def test_invalidate_compress_cache(self):
+        ns, key = create_cache_key(
+            CacheController.test_compress_cache_decorator)
+        pylons.cache.get_cache(ns).remove_value(key)
+
+    @beaker_cache(key=None, compress=True, conditional=True)
+    def test_compress_conditional_cache_decorator(self):
+        pylons.app_globals.counter += 1
+        return 'Counter=%s' % pylons.app_globals.counter
+
+    def test_invalidate_compress_conditional_cache(self):
+        ns, key = create_cache_key(
+            CacheController.test_compress_conditional_cache_decorator)
+        pylons.cache.get_cache(ns).remove_value(key)
+
+    def test_invalidate_local_cache(self):
+        ns, key = create_cache_key(CacheController.test_local_cache_decorator)
+        pylons.cache.get_cache(ns).remove_value(key)
+
 
 cache_dir = os.path.join(data_dir, 'cache')
 
@@ -271,3 +351,231 @@ class TestCacheDecorator(TestWSGIController):
         response = self.get_response(action='test_default_cache_decorator')
         assert 'Counter=2' in response
         pylons.config['cache_enabled'] = 'True'
+
+    def test_local_cache(self):
+        sap.g.counter = 0
+        local_cache.clear()
+        self.get_response(action='test_invalidate_local_cache')
+        response = self.get_response(action='test_local_cache_decorator')
+        assert 'Counter=1' in response
+        assert len(local_cache) == 1
+
+        # Served from the local cache, even with the Beaker copy gone
+        self.get_response(action='test_invalidate_local_cache')
+        response = self.get_response(action='test_local_cache_decorator')
+        assert 'Counter=1' in response
+        
+        local_cache.clear()
+        response = self.get_response(action='test_local_cache_decorator')
+        assert 'Counter=2' in response
+
+    def test_stats(self):
+        sap.g.counter = 0
+        cache_stats.reset()
+        self.get_response(action='test_invalidate_local_cache')
+        local_cache.clear()
+        for i in range(3):
+            self.get_response(action='test_local_cache_decorator')
+        local_cache.clear()
+        self.get_response(action='test_local_cache_decorator')
+        namespace = create_cache_key(
+            CacheController.test_local_cache_decorator)[0]
+        stats = cache_stats.get_stats(namespace)
+        assert stats['misses'] == 1
+        assert stats['hits'] == 3
+        assert stats['local_hits'] == 2
+        assert stats['create_bytes'] == len('Counter=1')
+
+    def test_stale_grace(self):
+        sap.g.counter = 0
+        response = self.get_response(action='test_stale_grace_cache_decorator')
+        assert 'Counter=1' in response
+        response = self.get_response(action='test_stale_grace_cache_decorator')
+        assert 'Counter=1' in response
+        time.sleep(1.1)
+        response = self.get_response(action='test_stale_grace_cache_decorator')
+        assert 'Counter=2' in response
+
+    def test_conditional(self):
+        sap.g.counter = 0
+        self.get_response(action='test_invalidate_conditional_cache')
+        response = self.get_response(action='test_conditional_cache_decorator')
+        assert 'Counter=1' in response
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        response = self.get_response(
+            action='test_conditional_cache_decorator',
+            test_args=dict(headers={'If-None-Match': etag}, status=304))
+        assert response.body == ''
+        assert response.headers['ETag'] == etag
+        response = self.get_response(
+            action='test_conditional_cache_decorator',
+            test_args=dict(headers={'If-Modified-Since': last_modified},
+                           status=304))
+        assert response.body == ''
+
+        response = self.get_response(
+            action='test_conditional_cache_decorator',
+            test_args=dict(headers={'If-None-Match': '"other"'}))
+        assert 'Counter=1' in response
+        assert response.headers['ETag'] == etag
+        response = self.get_response(
+            action='test_conditional_cache_decorator',
+            test_args=dict(headers={
+                'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}))
+        assert 'Counter=1' in response
+
+    def test_conditional_content_dropped(self):
+        sap.g.counter = 0
+        self.get_response(action='test_invalidate_conditional_cache')
+        response = self.get_response(action='test_conditional_cache_decorator')
+        assert 'Counter=1' in response
+        self.get_response(action='test_drop_conditional_content')
+        response = self.get_response(action='test_conditional_cache_decorator')
+        assert 'Counter=2' in response
+        etag = response.headers['ETag']
+        response = self.get_response(action='test_conditional_cache_decorator')
+        assert 'Counter=2' in response
+        assert response.headers['ETag'] == etag
+
+    def test_tags(self):
+        sap.g.counter = 0
+        self.get_response(action='test_invalidate_namespace')
+        for action in ('test_tagged_cache_decorator',
+                       'test_tags_func_cache_decorator'):
+            sap.g.counter = 0
+            response = self.get_response(action=action, id='1')
+            assert 'Counter=1' in response
+            response = self.get_response(action=action, id='2')
+            assert 'Counter=2' in response
+            response = self.get_response(action=action, id='1')
+            assert 'Counter=1' in response
+
+            self.get_response(action='test_invalidate_tag', id='product-1')
+            response = self.get_response(action=action, id='1')
+            assert 'Counter=3' in response
+            response = self.get_response(action=action, id='2')
+            assert 'Counter=2' in response
+
+        self.get_response(action='test_invalidate_tag', id='all')
+        response = self.get_response(action='test_tags_func_cache_decorator',
+                                     id='2')
+        assert 'Counter=4' in response
+        response = self.get_response(action='test_tagged_cache_decorator',
+                                     id='2')
+        assert 'Counter=2' in response
+
+        self.get_response(action='test_invalidate_namespace')
+        response = self.get_response(action='test_tagged_cache_decorator',
+                                     id='2')
+        assert 'Counter=5' in response
+
+    def test_vary(self):
+        sap.g.counter = 0
+        def get(headers, url='/'):
+            return self.get_response(action='test_vary_cache_decorator',
+                                     _url=url,
+                                     test_args=dict(headers=headers))
+        response = get({'Accept-Language': 'en-US, fr'})
+        assert 'Counter=1' in response
+        assert response.headers['Vary'] == 'Accept-Language, Cookie'
+        response = get({'Accept-Language': 'EN-us,fr'})
+        assert 'Counter=1' in response
+        assert response.headers['Vary'] == 'Accept-Language, Cookie'
+        response = get({'Accept-Language': 'fr'})
+        assert 'Counter=2' in response
+        response = get({'Accept-Language': 'fr', 'Cookie': 'other=1'})
+        assert 'Counter=2' in response
+        response = get({'Accept-Language': 'fr', 'Cookie': 'device=mobile'})
+        assert 'Counter=3' in response
+        response = get({'Accept-Language': 'fr'}, '/?lang=de')
+        assert 'Counter=4' in response
+
+    def test_compress(self):
+        sap.g.counter = 0
+        self.get_response(action='test_invalidate_compress_cache')
+        response = self.get_response(action='test_compress_cache_decorator')
+        assert response.unicode_body == u'Counter=1 \xe9'
+        assert 'Content-Encoding' not in response.headers
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        response = self.get_response(
+            action='test_compress_cache_decorator',
+            test_args=dict(headers={'Accept-Encoding': 'gzip, deflate'}))
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        body = zlib.decompress(response.body, 16 + zlib.MAX_WBITS)
+        assert body.decode('utf-8') == u'Counter=1 \xe9'
+        response = self.get_response(action='test_compress_cache_decorator')
+        assert response.unicode_body == u'Counter=1 \xe9'
+
+    def test_compress_conditional(self):
+        sap.g.counter = 0
+        self.get_response(
+            action='test_invalidate_compress_conditional_cache')
+        def get(headers, status=200):
+            return self.get_response(
+                action='test_compress_conditional_cache_decorator',
+                test_args=dict(headers=headers, status=status))
+        gzip_headers = {'Accept-Encoding': 'gzip'}
+        response = get({})
+        assert response.body == 'Counter=1'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        etag = response.headers['ETag']
+        response = get(gzip_headers)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        gzip_etag = response.headers['ETag']
+        assert gzip_etag == etag[:-1] + '-gzip"'
+
+        response = get({'If-None-Match': etag}, 304)
+        assert response.headers['ETag'] == etag
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        response = get(dict(gzip_headers, **{'If-None-Match': gzip_etag}),
+                       304)
+        assert response.headers['ETag'] == gzip_etag
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        response = get({'If-None-Match': gzip_etag})
+        assert response.body == 'Counter=1'
+        response = get(dict(gzip_headers, **{'If-None-Match': etag}))
+        assert response.headers['Content-Encoding'] == 'gzip'
+
+
+class TestCacheKeys(object):
+    def test_sorted(self):
+        def func():
+            pass
+        key_dict = dict(b=2, a=1, c=3)
+        namespace, key = create_cache_key(func, key_dict)
+        assert key == 'func a=1 b=2 c=3'
+        assert namespace == func.__module__
+    
+    def test_hashed(self):
+        def func():
+            pass
+        key_dict = dict(q='x' * MAX_KEY_LENGTH)
+        key = create_cache_key(func, key_dict)[1]
+        assert key.startswith('func ')
+        assert len(key) == len('func ') + 32
+        assert key == create_cache_key(func, dict(key_dict))[1]
+        assert key != create_cache_key(func, dict(q='y' * MAX_KEY_LENGTH))[1]
+        assert isinstance(create_cache_key(
+            func, dict(q=u'\u0436' * MAX_KEY_LENGTH))[1], str)
+    
+    def test_generations(self):
+        assert _join_generations('key', 'a.b.c') == 'key gen=a.b.c'
+        key = _join_generations('key', 'a.b.c.d')
+        assert key.startswith('key gen=')
+        assert len(key) == len('key gen=') + 32
+    
+    def test_key_dict_builder(self):
+        def func(self, id, id2=None, **kwargs):
+            pass
+        assert make_key_dict_builder(func, None) is None
+        build = make_key_dict_builder(func)
+        assert build(('self', 1, 2), dict(extra=3), None) == \
+            dict(id=1, id2=2, extra=3)
+        build = make_key_dict_builder(func, 'id')
+        assert build(('self', 1, 2), {}, None) == dict(id=1)
+        build = make_key_dict_builder(func, ['id2', 'id'])
+        assert build(('self', 1, 2), {}, None) == dict(id=1, id2=2)
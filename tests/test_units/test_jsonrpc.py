@@ -0,0 +1,211 @@
+from paste.fixture import TestApp
+from paste.registry import RegistryManager
+
+import pylons
+from pylons.controllers import JSONRPCController
+from pylons.controllers.xmlrpc import gzip_body
+import base64
+import simplejson
+import webob.exc as exc
+import xmlrpclib
+import zlib
+
+from __init__ import TestWSGIController, SetupCacheGlobal, ControllerWrap
+
+class BaseJSONRPCController(JSONRPCController):
+    def __init__(self):
+        self._pylons_log_debug = True
+
+    def userstatus(self):
+        return 'basic string'
+    userstatus.signature = [ ['string'] ]
+
+    def intargcheck(self, arg):
+        if not isinstance(arg, int):
+            return xmlrpclib.Fault(0, 'Integer required')
+        else:
+            return "received int"
+    intargcheck.signature = [ ['string', 'int'] ]
+
+    def add(self, a, b=0):
+        return a + b
+    add.signature = [ ['int', 'int'], ['int', 'int', 'int'] ]
+
+    def path(self):
+        return pylons.request.path_info
+
+    def broken(self):
+        raise ValueError('broken')
+
+    def date(self):
+        return xmlrpclib.DateTime((2010, 3, 4, 5, 6, 7, 0, 0, 0))
+
+    def binary(self):
+        return xmlrpclib.Binary('\x00binary\xff')
+
+    def unserializable(self):
+        return object()
+
+    def _private(self):
+        return 'private method'
+
+class ThreadedJSONRPCController(BaseJSONRPCController):
+    multicall_threads = 3
+
+class TestJSONRPCController(TestWSGIController):
+    controller = BaseJSONRPCController
+
+    def __init__(self, *args, **kargs):
+        TestWSGIController.__init__(self, *args, **kargs)
+        self.baseenviron = {}
+        self.baseenviron['pylons.routes_dict'] = {}
+        app = ControllerWrap(self.controller)
+        app = self.sap = SetupCacheGlobal(app, self.baseenviron)
+        app = RegistryManager(app)
+        self.app = TestApp(app)
+
+    def jsonreq(self, data, status=200):
+        if not isinstance(data, basestring):
+            data = simplejson.dumps(data)
+        self.response = response = self.app.post(
+            '/', params=data, status=status,
+            extra_environ=dict(CONTENT_TYPE='application/json'))
+        if response.body:
+            return simplejson.loads(response.body)
+
+    def call(self, method, params=None, id=1):
+        request = dict(jsonrpc='2.0', method=method, id=id)
+        if params is not None:
+            request['params'] = params
+        return self.jsonreq(request)
+
+    def test_call(self):
+        response = self.call('userstatus')
+        assert response == dict(jsonrpc='2.0', result='basic string', id=1)
+        assert self.response.header('Content-Type').startswith(
+            'application/json')
+
+    def test_positional_params(self):
+        assert self.call('add', [1, 2])['result'] == 3
+        assert self.call('add', [1])['result'] == 1
+
+    def test_named_params(self):
+        assert self.call('add', dict(a=1, b=2))['result'] == 3
+        assert self.call('add', dict(a=1))['result'] == 1
+        assert self.call('add', dict(b=1))['error']['code'] == -32602
+        assert self.call('add', dict(a=1, c=2))['error']['code'] == -32602
+
+    def test_bad_signature(self):
+        response = self.call('add', ['1'])
+        assert response['error']['code'] == -32602
+        assert response['id'] == 1
+
+    def test_fault(self):
+        response = self.call('intargcheck', [])
+        assert response['error']['code'] == -32602
+        response = self.call('system.methodHelp', ['nope'])
+        assert response['error'] == dict(code=0, message='No such method name')
+
+    def test_missing_method(self):
+        for method in ('doesntexist', '_private', 'start_response'):
+            response = self.call(method)
+            assert response['error']['code'] == -32601
+
+    def test_exception(self):
+        response = self.call('broken')
+        assert response['error']['code'] == -32603
+        assert 'broken' in response['error']['message']
+
+    def test_datetime(self):
+        assert self.call('date')['result'] == '2010-03-04T05:06:07'
+
+    def test_binary(self):
+        assert self.call('binary')['result'] == \
+            base64.b64encode('\x00binary\xff')
+
+    def test_unserializable(self):
+        response = self.call('unserializable', id=7)
+        assert response['error']['code'] == -32603
+        assert response['id'] == 7
+        response = self.jsonreq([
+            dict(jsonrpc='2.0', method='unserializable', id=1),
+            dict(jsonrpc='2.0', method='add', params=[1, 2], id=2)])
+        assert response[0]['error']['code'] == -32603
+        assert response[1] == dict(jsonrpc='2.0', result=3, id=2)
+
+    def test_parse_error(self):
+        response = self.jsonreq('{"jsonrpc": "2.0", "method"')
+        assert response['error']['code'] == -32700
+        assert response['id'] is None
+
+    def test_empty_body(self):
+        response = self.jsonreq('')
+        assert response['error']['code'] == -32700
+        assert response['id'] is None
+        response = simplejson.loads(self.app.get('/').body)
+        assert response['error']['code'] == -32700
+
+    def test_invalid_request(self):
+        for request in (1, dict(method='userstatus', id=1),
+                        dict(jsonrpc='2.0', method=1, id=1),
+                        dict(jsonrpc='2.0', method='userstatus', params=1,
+                             id=1), []):
+            response = self.jsonreq(request)
+            assert response['error']['code'] == -32600
+
+    def test_notification(self):
+        response = self.jsonreq(dict(jsonrpc='2.0', method='userstatus'),
+                                status=204)
+        assert response is None
+
+    def test_batch(self):
+        response = self.jsonreq([
+            dict(jsonrpc='2.0', method='add', params=[1, 2], id=1),
+            dict(jsonrpc='2.0', method='userstatus'),
+            dict(jsonrpc='2.0', method='doesntexist', id=2),
+            5,
+            dict(jsonrpc='2.0', method='path', id='three')])
+        assert len(response) == 4
+        assert response[0] == dict(jsonrpc='2.0', result=3, id=1)
+        assert response[1]['id'] == 2
+        assert response[1]['error']['code'] == -32601
+        assert response[2] == dict(jsonrpc='2.0', id=None, error=dict(
+            code=-32600, message='Request must be an object'))
+        assert response[3] == dict(jsonrpc='2.0', result='/', id='three')
+
+    def test_batch_notifications(self):
+        response = self.jsonreq([dict(jsonrpc='2.0', method='userstatus')] * 2,
+                                status=204)
+        assert response is None
+
+    def test_listmethods(self):
+        response = self.call('system.listMethods')['result']
+        assert response == ['add', 'binary', 'broken', 'date',
+                            'intargcheck', 'path', 'system.listMethods',
+                            'system.methodHelp', 'system.methodSignature',
+                            'system.multicall', 'unserializable',
+                            'userstatus']
+
+    def test_too_big(self):
+        self.assertRaises(exc.HTTPRequestEntityTooLarge, lambda: self.app.post('/', extra_environ=dict(CONTENT_LENGTH='4194314')))
+        try:
+            self.app.post('/', extra_environ=dict(CONTENT_LENGTH='4194314'))
+        except exc.HTTPRequestEntityTooLarge, e:
+            assert e.detail == 'JSON body too large'
+
+    def test_gzip(self):
+        data = gzip_body(simplejson.dumps(
+            [dict(jsonrpc='2.0', method='system.listMethods', id=i)
+             for i in range(10)]))
+        ee = dict(HTTP_CONTENT_ENCODING='gzip', HTTP_ACCEPT_ENCODING='gzip')
+        self.controller.gzip_min_length = 100
+        try:
+            response = self.app.post('/', params=data, extra_environ=ee)
+        finally:
+            del self.controller.gzip_min_length
+        assert response.header('Content-Encoding') == 'gzip'
+        body = zlib.decompress(response.body, 16 + zlib.MAX_WBITS)
+        assert len(simplejson.loads(body)) == 10
+
+class TestThreadedJSONRPCController(TestJSONRPCController):
+    controller = ThreadedJSONRPCController
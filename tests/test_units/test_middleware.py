@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import zlib
+
 from webtest import TestApp
 
-from pylons.middleware import StatusCodeRedirect, ErrorHandler
+from pylons.controllers.util import gzip_body
+from pylons.middleware import StatusCodeRedirect, ErrorHandler, \
+     PageCacheMiddleware
 
 def simple_app(environ, start_response):
     start_response('200 OK', [('Content-type', 'text/plain')])
@@ -41,4 +45,123 @@ def test_retains_request():
     res = app.get('/fredrick', status=404)
     assert 'pylons.original_request' in res.environ
     assert '/fredrick' == res.environ['pylons.original_request'].path_info
-    
\ No newline at end of file
+    
+def make_counting_app():
+    calls = []
+    def counting_app(environ, start_response):
+        calls.append(environ['PATH_INFO'])
+        headers = [('Content-type', 'text/plain')]
+        if environ['PATH_INFO'] == '/cookie':
+            headers.append(('Set-Cookie', 'a=1'))
+        elif environ['PATH_INFO'] == '/bypass':
+            environ['pylons.page_cache.bypass'] = True
+        elif environ['PATH_INFO'] == '/lang':
+            headers.append(('Vary', 'Accept-Language'))
+        elif environ['PATH_INFO'] == '/any':
+            headers.append(('Vary', '*'))
+        elif environ['PATH_INFO'] in ('/gzip', '/gzip-novary'):
+            if environ['PATH_INFO'] == '/gzip':
+                headers.append(('Vary', 'Accept-Encoding'))
+            if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+                headers.append(('Content-Encoding', 'gzip'))
+                start_response('200 OK', headers)
+                return [gzip_body('Call %s' % len(calls))]
+        start_response('200 OK', headers)
+        return ['Call %s' % len(calls)]
+    return counting_app, calls
+
+def test_page_cache():
+    counting_app, calls = make_counting_app()
+    app = TestApp(PageCacheMiddleware(counting_app, namespace='test_page'))
+    assert app.get('/').body == 'Call 1'
+    assert app.get('/').body == 'Call 1'
+    assert app.get('/').headers['Content-type'] == 'text/plain'
+    assert app.get('/?a=1').body == 'Call 2'
+    assert app.head('/').body == ''
+    assert app.post('/').body == 'Call 3'
+    assert len(calls) == 3
+
+def test_page_cache_bypass():
+    counting_app, calls = make_counting_app()
+    app = TestApp(PageCacheMiddleware(counting_app,
+                                      namespace='test_page_bypass'))
+    app.get('/')
+    assert app.get('/', headers={'Cookie': 'beaker.session.id=1'}).body == \
+        'Call 2'
+    assert app.get('/', headers={'Cookie': 'other=1'}).body == 'Call 1'
+    assert app.get('/', headers={'Authorization': 'Basic x'}).body == \
+        'Call 3'
+    for path in ('/cookie', '/bypass'):
+        app.get(path)
+        app.get(path)
+    assert len(calls) == 7
+
+def test_page_cache_rules():
+    counting_app, calls = make_counting_app()
+    app = TestApp(PageCacheMiddleware(counting_app, rules=[
+        ('/private', None), ('/$', 60), ('/news/', 1)],
+        namespace='test_page_rules'))
+    for path in ('/', '/news/1', '/private', '/other'):
+        app.get(path)
+        app.get(path)
+    assert calls == ['/', '/news/1', '/private', '/private', '/other',
+                     '/other']
+
+def test_page_cache_invalidate():
+    counting_app, calls = make_counting_app()
+    middleware = PageCacheMiddleware(counting_app,
+                                     namespace='test_page_invalidate')
+    app = TestApp(middleware)
+    app.get('/')
+    app.get('/a', {'b': 1})
+    middleware.invalidate('/')
+    assert app.get('/').body == 'Call 3'
+    assert app.get('/a', {'b': 1}).body == 'Call 2'
+    middleware.invalidate('/a', 'b=1')
+    assert app.get('/a', {'b': 1}).body == 'Call 4'
+    middleware.clear()
+    assert app.get('/').body == 'Call 5'
+
+def test_page_cache_vary():
+    counting_app, calls = make_counting_app()
+    app = TestApp(PageCacheMiddleware(counting_app,
+                                      namespace='test_page_vary'))
+    def get(path, **headers):
+        return app.get(path, headers=headers)
+    assert get('/lang', **{'Accept-Language': 'en'}).body == 'Call 1'
+    assert get('/lang', **{'Accept-Language': 'fr'}).body == 'Call 2'
+    assert get('/lang', **{'Accept-Language': 'EN'}).body == 'Call 1'
+    assert get('/lang', **{'Accept-Language': 'fr'}).body == 'Call 2'
+    assert get('/any').body == 'Call 3'
+    assert get('/any').body == 'Call 4'
+
+    gzip_headers = {'Accept-Encoding': 'gzip, deflate'}
+    response = get('/gzip', **gzip_headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert zlib.decompress(response.body, 16 + zlib.MAX_WBITS) == 'Call 5'
+    response = get('/gzip')
+    assert 'Content-Encoding' not in response.headers
+    assert response.body == 'Call 6'
+    response = get('/gzip', **{'Accept-Encoding': 'gzip,deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert get('/gzip').body == 'Call 6'
+
+    # Compressed pages without a Vary header aren't cached
+    response = get('/gzip-novary', **gzip_headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert get('/gzip-novary').body == 'Call 8'
+    assert get('/gzip-novary').body == 'Call 8'
+    assert len(calls) == 8
+
+def test_page_cache_invalidate_variants():
+    counting_app, calls = make_counting_app()
+    middleware = PageCacheMiddleware(counting_app,
+                                     namespace='test_page_invalidate_vary')
+    app = TestApp(middleware)
+    en = {'Accept-Language': 'en'}
+    fr = {'Accept-Language': 'fr'}
+    app.get('/lang', headers=en)
+    app.get('/lang', headers=fr)
+    middleware.invalidate('/lang')
+    assert app.get('/lang', headers=en).body == 'Call 3'
+    assert app.get('/lang', headers=fr).body == 'Call 4'
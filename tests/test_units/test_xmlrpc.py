@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import os
+
 from paste.fixture import TestApp
 from paste.registry import RegistryManager
+from beaker.middleware import CacheMiddleware
 
 import pylons
 from pylons.util import ContextObj
 from pylons.controllers import XMLRPCController
+from pylons.controllers.xmlrpc import XMLRPCMethodRegistry, \
+     accepts_gzip, gzip_body, make_signature_validator, _get_multicall_pool
 import webob.exc as exc
+import time
 import xmlrpclib
+import zlib
 
 from __init__ import TestWSGIController, SetupCacheGlobal, ControllerWrap
 
@@ -54,12 +61,45 @@ class BaseXMLRPCController(XMLRPCController):
     def _private(self):
         return 'private method'
     
+    def path(self):
+        return pylons.request.path_info
+    path.signature = [ ['string'] ]
+    
+    def broken(self):
+        raise ValueError('broken')
+    
+class ThreadedXMLRPCController(BaseXMLRPCController):
+    multicall_threads = 3
+    
+class CachedXMLRPCController(BaseXMLRPCController):
+    def lookup(self, id):
+        pylons.app_globals.counter += 1
+        if id < 0:
+            return xmlrpclib.Fault(1, 'Negative id')
+        return dict(id=id, counter=pylons.app_globals.counter)
+    lookup.signature = [ ['struct', 'int'] ]
+    lookup.cache_expire = 'never'
+    
+    def expiring(self):
+        pylons.app_globals.counter += 1
+        return pylons.app_globals.counter
+    expiring.cache_expire = 1
+    
+    def uncached(self):
+        pylons.app_globals.counter += 1
+        return pylons.app_globals.counter
+    
+class GzipXMLRPCController(BaseXMLRPCController):
+    gzip_min_length = 200
+    
 class TestXMLRPCController(TestWSGIController):
+    controller = BaseXMLRPCController
+    
     def __init__(self, *args, **kargs):
         TestWSGIController.__init__(self, *args, **kargs)
         self.baseenviron = {}
         self.baseenviron['pylons.routes_dict'] = {}
-        app = ControllerWrap(BaseXMLRPCController)
+        app = ControllerWrap(self.controller)
         app = self.sap = SetupCacheGlobal(app, self.baseenviron)
         app = RegistryManager(app)
         self.app = TestApp(app)
@@ -90,7 +130,7 @@ class TestXMLRPCController(TestWSGIController):
     
     def test_listmethods(self):
         response = self.xmlreq('system.listMethods')
-        assert response == ['docs', 'intargcheck', 'longdoc', 'nosig', 'structured.methodname', 'system.listMethods', 'system.methodHelp', 'system.methodSignature', 'uni', 'userstatus']    
+        assert response == ['broken', 'docs', 'intargcheck', 'longdoc', 'nosig', 'path', 'structured.methodname', 'system.listMethods', 'system.methodHelp', 'system.methodSignature', 'system.multicall', 'uni', 'userstatus']    
     
     def test_unicode(self):
         response = self.xmlreq('uni')
@@ -155,3 +195,212 @@ class TestXMLRPCController(TestWSGIController):
         self.assertRaises(xmlrpclib.Fault, self.xmlreq, 'foo')
     
 
+    
+    def test_chunked(self):
+        data = xmlrpclib.dumps(('docs',), methodname='system.methodHelp')
+        ee = dict(CONTENT_TYPE='text/xml', CONTENT_LENGTH='',
+                  HTTP_TRANSFER_ENCODING='chunked')
+        response = self.app.post('/', params=data, extra_environ=ee)
+        assert "This method has a docstring" in xmlrpclib.loads(response.body)[0][0]
+    
+    def test_chunked_too_big(self):
+        data = xmlrpclib.dumps(('x' * 4194304,), methodname='intargcheck')
+        ee = dict(CONTENT_LENGTH='', HTTP_TRANSFER_ENCODING='chunked')
+        self.assertRaises(exc.HTTPRequestEntityTooLarge, lambda: self.app.post('/', params=data, extra_environ=ee))
+    
+    def test_chunked_empty(self):
+        ee = dict(CONTENT_LENGTH='', HTTP_TRANSFER_ENCODING='chunked')
+        self.assertRaises(exc.HTTPClientError, lambda: self.app.post('/', extra_environ=ee))
+    
+    def test_small_read_chunks(self):
+        BaseXMLRPCController.read_chunk_size = 7
+        try:
+            response = self.xmlreq('system.methodHelp', ('longdoc',))
+        finally:
+            del BaseXMLRPCController.read_chunk_size
+        assert 'This function\nhas multiple lines\nin it' in response
+    
+    def test_multicall(self):
+        calls = [dict(methodName='userstatus', params=[]),
+                 dict(methodName='intargcheck', params=[12]),
+                 dict(methodName='system.methodHelp', params=['docs'])]
+        response = self.xmlreq('system.multicall', (calls,))
+        assert response == [['basic string'], ['received int'],
+                            ["This method has a docstring\n\n"
+                             "Method signature: [['struct']]"]]
+    
+    def test_multicall_faults(self):
+        calls = [dict(methodName='doesntexist', params=[]),
+                 dict(methodName='intargcheck', params=[12.5]),
+                 dict(methodName='system.methodHelp', params=['nope']),
+                 dict(methodName='broken', params=[]),
+                 dict(methodName='system.multicall', params=[[]]),
+                 dict(params=[]),
+                 dict(methodName='userstatus', params=[])]
+        response = self.xmlreq('system.multicall', (calls,))
+        assert len(response) == 7
+        for fault in response[:6]:
+            assert set(fault.keys()) == set(['faultCode', 'faultString'])
+        assert 'No such method name' == response[2]['faultString']
+        assert 'broken' in response[3]['faultString']
+        assert response[6] == ['basic string']
+    
+    def test_multicall_globals(self):
+        calls = [dict(methodName='path', params=[])] * 5
+        response = self.xmlreq('system.multicall', (calls,))
+        assert response == [['/']] * 5
+
+class TestThreadedMulticall(TestXMLRPCController):
+    controller = ThreadedXMLRPCController
+
+    def test_shared_pool(self):
+        calls = [dict(methodName='path', params=[])] * 5
+        self.xmlreq('system.multicall', (calls,))
+        pool = _get_multicall_pool()
+        self.xmlreq('system.multicall', (calls,))
+        assert _get_multicall_pool() is pool
+        assert pool.size == ThreadedXMLRPCController.multicall_threads - 1
+
+    def test_pool_after_fork(self):
+        calls = [dict(methodName='path', params=[])] * 5
+        self.xmlreq('system.multicall', (calls,))
+        pool = _get_multicall_pool()
+        # Pretend the pool was started by the parent of a forked process
+        pool.pid = -1
+        response = self.xmlreq('system.multicall', (calls,))
+        assert response == [['/']] * 5
+        assert _get_multicall_pool() is not pool
+        assert _get_multicall_pool().pid == os.getpid()
+
+class TestXMLRPCMethodRegistry(object):
+    def test_methods(self):
+        registry = BaseXMLRPCController._get_method_registry()
+        assert registry is BaseXMLRPCController._get_method_registry()
+        assert 'userstatus' in registry.methods
+        assert 'system_multicall' in registry.methods
+        assert '_private' not in registry.methods
+        assert 'foo' not in registry.methods
+        assert registry.names == sorted(registry.methods)
+    
+    def test_subclass_registry(self):
+        class SubController(BaseXMLRPCController):
+            def extra(self):
+                return 'extra'
+        registry = SubController._get_method_registry()
+        assert registry is not BaseXMLRPCController._get_method_registry()
+        assert 'extra' in registry.methods
+        assert 'extra' not in BaseXMLRPCController._get_method_registry().methods
+    
+    def test_call_info(self):
+        registry = XMLRPCMethodRegistry(BaseXMLRPCController)
+        argnames, validate = registry.get_call_info(
+            BaseXMLRPCController.intargcheck)
+        assert argnames == ['arg']
+        assert validate((1,))
+        assert not validate((1.5,))
+        assert registry.get_call_info(BaseXMLRPCController.nosig) == ([], None)
+    
+    def test_validator(self):
+        validate = make_signature_validator([['int', 'string'],
+                                             ['int', 'string', 'int'],
+                                             ('int', 'boolean')])
+        class SubStr(str):
+            pass
+        assert validate(('a',))
+        assert validate((u'a',))
+        assert validate((SubStr('a'),))
+        assert validate(('a', 1))
+        assert validate((True,))
+        assert not validate((1,))
+        assert not validate(('a', True))
+        assert not validate(())
+        assert not validate((None,))
+
+class TestXMLRPCGzip(TestXMLRPCController):
+    controller = GzipXMLRPCController
+    
+    def gzipreq(self, method, args=(), extra_environ=None, **kwargs):
+        ee = dict(CONTENT_TYPE='text/xml', HTTP_CONTENT_ENCODING='gzip')
+        ee.update(extra_environ or {})
+        data = gzip_body(xmlrpclib.dumps(args, methodname=method))
+        return self.app.post('/', params=data, extra_environ=ee, **kwargs)
+    
+    def test_gzip_request(self):
+        response = self.gzipreq('intargcheck', (12,))
+        assert xmlrpclib.loads(response.body)[0][0] == 'received int'
+    
+    def test_gzip_request_too_big(self):
+        # Compresses to well under max_body_length
+        self.assertRaises(exc.HTTPRequestEntityTooLarge, self.gzipreq,
+                          'intargcheck', ('x' * 4194304,))
+    
+    def test_bad_gzip_request(self):
+        ee = dict(HTTP_CONTENT_ENCODING='gzip')
+        self.assertRaises(exc.HTTPClientError, lambda: self.app.post('/', params='not gzip', extra_environ=ee))
+    
+    def test_unsupported_encoding(self):
+        ee = dict(HTTP_CONTENT_ENCODING='compress')
+        self.assertRaises(exc.HTTPUnsupportedMediaType, lambda: self.app.post('/', params='data', extra_environ=ee))
+    
+    def test_gzip_response(self):
+        ee = dict(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = self.gzipreq('system.listMethods', extra_environ=ee)
+        assert response.header('Content-Encoding') == 'gzip'
+        assert response.header('Vary') == 'Accept-Encoding'
+        assert int(response.header('Content-Length')) == len(response.body)
+        body = zlib.decompress(response.body, 16 + zlib.MAX_WBITS)
+        assert 'userstatus' in xmlrpclib.loads(body)[0][0]
+    
+    def test_small_response(self):
+        ee = dict(HTTP_ACCEPT_ENCODING='gzip')
+        response = self.gzipreq('userstatus', extra_environ=ee)
+        assert 'Content-Encoding' not in dict(response.headers)
+        assert xmlrpclib.loads(response.body)[0][0] == 'basic string'
+    
+    def test_not_accepted(self):
+        response = self.gzipreq('system.listMethods')
+        assert 'Content-Encoding' not in dict(response.headers)
+    
+    def test_accepts_gzip(self):
+        assert accepts_gzip('gzip')
+        assert accepts_gzip('deflate, GZIP;q=0.5')
+        assert accepts_gzip('x-gzip')
+        assert not accepts_gzip('')
+        assert not accepts_gzip('deflate')
+        assert not accepts_gzip('gzip;q=0')
+        assert not accepts_gzip('gzip;q=bad')
+
+class TestXMLRPCCache(TestWSGIController):
+    def __init__(self, *args, **kargs):
+        TestWSGIController.__init__(self, *args, **kargs)
+        self.baseenviron = {}
+        self.baseenviron['pylons.routes_dict'] = {}
+        app = ControllerWrap(CachedXMLRPCController)
+        app = self.sap = SetupCacheGlobal(app, self.baseenviron,
+                                          setup_cache=True)
+        app = CacheMiddleware(app, {}, type='memory')
+        app = RegistryManager(app)
+        self.app = TestApp(app)
+    
+    def test_cached(self):
+        self.sap.g.counter = 0
+        assert self.xmlreq('lookup', (1,)) == dict(id=1, counter=1)
+        assert self.xmlreq('lookup', (1,)) == dict(id=1, counter=1)
+        assert self.response.header('Content-Type') == 'text/xml'
+        assert self.xmlreq('lookup', (2,)) == dict(id=2, counter=2)
+        assert self.xmlreq('lookup', (1,)) == dict(id=1, counter=1)
+        assert self.xmlreq('uncached') == 3
+        assert self.xmlreq('uncached') == 4
+    
+    def test_faults_not_cached(self):
+        self.sap.g.counter = 0
+        self.assertRaises(xmlrpclib.Fault, self.xmlreq, 'lookup', (-1,))
+        self.assertRaises(xmlrpclib.Fault, self.xmlreq, 'lookup', (-1,))
+        assert self.sap.g.counter == 2
+    
+    def test_expire(self):
+        self.sap.g.counter = 0
+        assert self.xmlreq('expiring') == 1
+        assert self.xmlreq('expiring') == 1
+        time.sleep(1.1)
+        assert self.xmlreq('expiring') == 2